@@ -0,0 +1,72 @@
+"""Sends Web Push messages the way a Mastodon server does.
+
+Used by fake_server.py to push new notifications to tootgroup.py's Web Push
+receiver. Messages are encrypted with the "aesgcm" content encoding that
+Mastodon uses, for the public key and auth secret of the subscription.
+This needs the "webpush" extra of Mastodon.py (cryptography, http_ece)."""
+
+import base64
+import json
+import os
+import urllib.request
+
+import http_ece
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+# The server's VAPID key, announced with every push message
+_vapid_key = ec.generate_private_key(ec.SECP256R1())
+
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _public_bytes(private_key):
+    return private_key.public_key().public_bytes(
+        serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+    )
+
+
+def server_key():
+    """Return the server's public VAPID key, like Mastodon announces it"""
+    return _b64url(_public_bytes(_vapid_key))
+
+
+def send_push(subscription, payload, timeout=10.0):
+    """Encrypt a push message and send it to a subscription's endpoint.
+
+    "subscription" dictionary with the "endpoint" URL and the receiver's
+    "p256dh" public key and "auth" secret as bytes
+
+    "payload" JSON serializable content of the message
+
+    Returns the HTTP status the receiver answered with."""
+    sender_key = ec.generate_private_key(ec.SECP256R1())
+    salt = os.urandom(16)
+    body = http_ece.encrypt(
+        json.dumps(payload).encode(),
+        salt=salt,
+        private_key=sender_key,
+        dh=subscription["p256dh"],
+        auth_secret=subscription["auth"],
+        keylabel="P-256",
+        version="aesgcm",
+    )
+    request = urllib.request.Request(
+        subscription["endpoint"],
+        data=body,
+        method="POST",
+        headers={
+            "Content-Type": "application/octet-stream",
+            "Content-Encoding": "aesgcm",
+            "Encryption": "salt=" + _b64url(salt),
+            "Crypto-Key": "dh="
+            + _b64url(_public_bytes(sender_key))
+            + ";p256ecdsa="
+            + server_key(),
+            "TTL": "172800",
+        },
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.status
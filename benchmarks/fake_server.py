@@ -0,0 +1,695 @@
+#!/usr/bin/env python3
+"""A local fake of the Mastodon client API for benchmarking tootgroup.py.
+
+Only the endpoints tootgroup.py uses are served: account verification and
+instance information, the group's following list and relationships,
+notifications, reblogs, new statuses, media uploads, the download of
+media files and the Web Push subscription. Everything is kept in memory
+and generated from a few settings, see DEFAULT_SETTINGS.
+
+New mentions can be added while the server is running with add_mention()
+or by POSTing to /fake/mention. If tootgroup.py has subscribed to Web Push,
+they are pushed to it right away, see fake_push.py. Open connections to the
+streaming API at /api/v1/streaming/user get them as "notification" events.
+disconnect_streams() or a POST to /fake/disconnect drops these connections,
+optionally refusing new ones with "503 Service Unavailable" for "refuse"
+seconds, to see tootgroup.py reconnect and catch up with what it missed.
+
+The server counts requests and bytes in both directions. Like Mastodon, it
+rejects API requests with HTTP 429 once the rate limit is used up, until
+the rate limit period ends. It can be run on its own for manual testing:
+
+    python benchmarks/fake_server.py --members 100 --mentions 20
+
+With "tootgroup.py --stream" connected to it, streaming can be tried out
+from another shell:
+
+    curl -X POST http://127.0.0.1:8765/fake/mention
+    curl -X POST "http://127.0.0.1:8765/fake/disconnect?refuse=10"
+
+benchmarks/stream_reconnect.py does this automatically.
+"""
+
+import argparse
+import base64
+import json
+import queue
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+GROUP_ACCOUNT_ID = "1"
+GROUP_USERNAME = "bench"
+
+DEFAULT_SETTINGS = {
+    # seconds every API request takes on the server side
+    "latency": 0.0,
+    # seconds every media upload and download takes on top of "latency"
+    "media_latency": 0.0,
+    # maximum number of notifications and accounts returned per page
+    "page_size": 40,
+    # number of accounts the group account is following
+    "members": 10,
+    # number of mentions waiting to be processed
+    "mentions": 10,
+    # share of mentions that are direct messages, the others are boosts
+    "direct_share": 0.5,
+    # share of mentions sent by accounts that are not group members
+    "stranger_share": 0.0,
+    # media files attached to every direct message
+    "media_per_dm": 0,
+    # size of every media file in bytes
+    "media_size": 64 * 1024,
+    # if set, media files are JPEG photos with this many pixels instead,
+    # taken by a camera that left its EXIF data in (needs Pillow)
+    "media_photo_pixels": 0,
+    # account ID the first notification ID is counted from
+    "first_notification_id": 1000,
+    # API requests allowed per rate limit period, announced like Mastodon does
+    "rate_limit": 300,
+    # length of a rate limit period in seconds
+    "rate_limit_period": 300.0,
+    # reject requests beyond the rate limit, otherwise it is only announced
+    "enforce_rate_limit": True,
+    # number of new statuses rejected with "503 Service Unavailable" before
+    # they are accepted, e.g. to see failed posts retried from the outbox
+    "failing_posts": 0,
+    # seconds between heartbeats on open streaming connections
+    "stream_heartbeat": 15.0,
+    # close streaming connections after this many events, 0 keeps them open
+    "stream_disconnect_after": 0,
+}
+
+
+def account(account_id):
+    """Return a minimal account entity"""
+    return {
+        "id": str(account_id),
+        "username": "user" + str(account_id),
+        "acct": "user" + str(account_id) + "@example.com",
+        "display_name": "",
+        "url": "https://example.com/@user" + str(account_id),
+        "created_at": "2020-01-01T00:00:00.000Z",
+    }
+
+
+def make_notifications(settings, base_url):
+    """Generate the pending mentions, newest first like a real server"""
+    notifications = []
+    members = max(1, settings["members"])
+    mentions = settings["mentions"]
+    directs = int(mentions * settings["direct_share"])
+    strangers = int(mentions * settings["stranger_share"])
+    for i in range(mentions):
+        notification_id = settings["first_notification_id"] + i
+        if i * directs // max(1, mentions) != (i + 1) * directs // max(1, mentions):
+            visibility = "direct"
+            content = (
+                '<p><span class="h-card"><a href="'
+                + base_url
+                + "/@"
+                + GROUP_USERNAME
+                + '" class="u-url mention">@<span>'
+                + GROUP_USERNAME
+                + "</span></a></span> Direct message number "
+                + str(i)
+                + ' with a <a href="https://example.com/'
+                + str(i)
+                + '">link</a> &amp; an entity.<br />Second line</p>'
+                "<p>Second paragraph</p>"
+            )
+            media = [
+                {
+                    "id": "m" + str(notification_id) + "_" + str(j),
+                    "type": "image",
+                    "url": base_url
+                    + "/media/"
+                    + str(notification_id)
+                    + "_"
+                    + str(j)
+                    + ".png",
+                    "description": "Image " + str(j),
+                }
+                for j in range(settings["media_per_dm"])
+            ]
+        else:
+            visibility = "public"
+            content = boost_request(base_url, i)
+            media = []
+        if i * strangers // max(1, mentions) != (i + 1) * strangers // max(1, mentions):
+            sender = account(members + 2 + i)
+        else:
+            sender = account(2 + i % members)
+        notifications.append(
+            mention(notification_id, sender, visibility, content, media)
+        )
+    notifications.reverse()
+    return notifications
+
+
+def boost_request(base_url, number):
+    """Return the content of a public mention asking the group for a boost"""
+    return (
+        '<p>Please boost !<span class="h-card"><a href="'
+        + base_url
+        + "/@"
+        + GROUP_USERNAME
+        + '" class="u-url mention">@<span>'
+        + GROUP_USERNAME
+        + "</span></a></span> number "
+        + str(number)
+        + "</p>"
+    )
+
+
+def mention(notification_id, sender, visibility, content, media):
+    """Return a mention notification entity"""
+    return {
+        "id": str(notification_id),
+        "type": "mention",
+        "created_at": "2020-01-01T00:00:00.000Z",
+        "account": sender,
+        "status": {
+            "id": str(100000 + notification_id),
+            "created_at": "2020-01-01T00:00:00.000Z",
+            "visibility": visibility,
+            "content": content,
+            "spoiler_text": "",
+            "sensitive": False,
+            "media_attachments": media,
+            "account": sender,
+        },
+    }
+
+
+def add_mention(state):
+    """Add a public mention by a group member asking for a boost.
+
+    If tootgroup.py has subscribed to Web Push, the new notification is
+    pushed to it in a background thread.
+
+    Returns the ID of the new notification."""
+    with state["lock"]:
+        notifications = state["notifications"]
+        if len(notifications) > 0:
+            notification_id = int(notifications[0]["id"]) + 1
+        else:
+            notification_id = state["settings"]["first_notification_id"]
+        number = notification_id - state["settings"]["first_notification_id"]
+        notifications.insert(
+            0,
+            mention(
+                notification_id,
+                account(state["member_ids"][number % len(state["member_ids"])]),
+                "public",
+                boost_request(state["base_url"], number),
+                [],
+            ),
+        )
+        subscription = state["push_subscription"]
+        if len(state["streams"]) > 0:
+            event = (
+                "event: notification\ndata: " + json.dumps(notifications[0]) + "\n\n"
+            ).encode()
+            for events in state["streams"]:
+                events.put(event)
+    if subscription is not None:
+        threading.Thread(
+            target=push_notification,
+            args=(state, subscription, notification_id),
+            daemon=True,
+        ).start()
+    return str(notification_id)
+
+
+def disconnect_streams(state, refuse=0.0):
+    """Close all open streaming connections.
+
+    "refuse" seconds new streaming connections are rejected with "503
+    Service Unavailable"
+
+    Returns the number of connections closed."""
+    with state["lock"]:
+        state["stream_refused_until"] = time.time() + refuse
+        for events in state["streams"]:
+            events.put(None)
+        return len(state["streams"])
+
+
+def push_notification(state, subscription, notification_id):
+    """Push a new mention like Mastodon's Web Push worker"""
+    import fake_push
+
+    try:
+        fake_push.send_push(
+            subscription,
+            {
+                "access_token": "access_token",
+                "preferred_locale": "en",
+                "notification_id": notification_id,
+                "notification_type": "mention",
+                "icon": "",
+                "title": "You were mentioned",
+                "body": "",
+            },
+        )
+    except Exception as ex:
+        print("Cannot push notification " + str(notification_id) + ": " + str(ex))
+        return
+    with state["lock"]:
+        state["pushes"] += 1
+
+
+def make_photo(pixels):
+    """Return a noisy JPEG photo of about the given number of pixels"""
+    import io
+
+    from PIL import Image
+
+    width = int((pixels * 4 / 3.0) ** 0.5)
+    photo = Image.effect_noise((width, pixels // width), 24).convert("RGB")
+    exif = Image.Exif()
+    exif[0x010F] = "Fake Camera"
+    exif[0x0112] = 1  # orientation
+    buffer = io.BytesIO()
+    photo.save(buffer, "JPEG", quality=95, exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+def new_state(settings, base_url):
+    """Create the server's state from its settings"""
+    return {
+        "settings": dict(settings),
+        "base_url": base_url,
+        "lock": threading.Lock(),
+        "notifications": make_notifications(settings, base_url),
+        "member_ids": [str(2 + i) for i in range(settings["members"])],
+        "requests": 0,
+        "bytes_received": 0,
+        "bytes_sent": 0,
+        "reblogs": [],
+        "statuses": [],
+        "failed_posts": 0,
+        "media_downloads": 0,
+        "media_uploads": 0,
+        "rate_limit_used": 0,
+        "rate_limited": 0,
+        "rate_limit_reset": time.time() + settings["rate_limit_period"],
+        "push_subscription": None,
+        "pushes": 0,
+        "streams": [],
+        "stream_connections": 0,
+        "streamed": 0,
+        "stream_refused_until": 0.0,
+        "photo": (
+            make_photo(settings["media_photo_pixels"])
+            if settings["media_photo_pixels"]
+            else None
+        ),
+    }
+
+
+def make_handler(state):
+    """Return a request handler class serving the given state"""
+
+    class FakeMastodonHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass  # keep the benchmark's output clean
+
+        def count(self, received, sent):
+            with state["lock"]:
+                state["requests"] += 1
+                state["bytes_received"] += received
+                state["bytes_sent"] += sent
+
+        def respond(
+            self, data, status=200, headers=None, body=None, content_type="image/png"
+        ):
+            if body is None:
+                body = json.dumps(data).encode()
+                content_type = "application/json; charset=utf-8"
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            if self.path.startswith("/api/"):
+                for name, value in self.rate_limit().items():
+                    self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+            received = len(str(self.requestline)) + len(str(self.headers))
+            received += int(self.headers.get("Content-Length") or 0)
+            self.count(received, len(body) + 200)
+
+        def new_rate_limit_period(self):
+            # Must be called with the state's lock held
+            if time.time() >= state["rate_limit_reset"]:
+                state["rate_limit_used"] = 0
+                state["rate_limit_reset"] = (
+                    time.time() + state["settings"]["rate_limit_period"]
+                )
+
+        def throttled(self):
+            """Reject the request with 429 if the rate limit is used up"""
+            settings = state["settings"]
+            if not (settings["enforce_rate_limit"] and self.path.startswith("/api/")):
+                return False
+            with state["lock"]:
+                self.new_rate_limit_period()
+                if state["rate_limit_used"] < settings["rate_limit"]:
+                    return False
+                state["rate_limited"] += 1
+                retry_after = state["rate_limit_reset"] - time.time()
+            self.respond(
+                {"error": "Too many requests"},
+                status=429,
+                headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+            )
+            return True
+
+        def rate_limit(self):
+            settings = state["settings"]
+            with state["lock"]:
+                self.new_rate_limit_period()
+                state["rate_limit_used"] += 1
+                remaining = max(0, settings["rate_limit"] - state["rate_limit_used"])
+                reset = state["rate_limit_reset"]
+            return {
+                "X-RateLimit-Limit": str(settings["rate_limit"]),
+                "X-RateLimit-Remaining": str(remaining),
+                "X-RateLimit-Reset": time.strftime(
+                    "%Y-%m-%dT%H:%M:%S", time.gmtime(reset)
+                )
+                + ".%03dZ" % (reset % 1 * 1000),
+            }
+
+        def wait(self, media=False):
+            settings = state["settings"]
+            delay = settings["latency"]
+            if media:
+                delay += settings["media_latency"]
+            if delay > 0:
+                time.sleep(delay)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            path = url.path.rstrip("/")
+            if path == "/api/v1/streaming/user" or (
+                path == "/api/v1/streaming" and query.get("stream") == ["user"]
+            ):
+                return self.stream()
+            self.wait(media=path.startswith("/media/"))
+            if self.throttled():
+                return
+
+            if path == "/api/v1/accounts/verify_credentials":
+                group_account = account(GROUP_ACCOUNT_ID)
+                group_account["username"] = GROUP_USERNAME
+                group_account["acct"] = GROUP_USERNAME
+                return self.respond(group_account)
+            if path in ("/api/v1/instance", "/api/v2/instance"):
+                return self.respond(
+                    {
+                        "uri": "127.0.0.1",
+                        "domain": "127.0.0.1",
+                        "title": "tootgroup.py benchmark",
+                        "version": "4.3.0",
+                        "api_versions": {"mastodon": 2},
+                        "urls": {},
+                    }
+                )
+            if re.match(r"/api/v1/accounts/\d+/following$", path):
+                return self.following(path, query)
+            if path == "/api/v1/accounts/relationships":
+                member_ids = set(state["member_ids"])
+                return self.respond(
+                    [
+                        {"id": account_id, "following": account_id in member_ids}
+                        for account_id in query.get("id[]", [])
+                    ]
+                )
+            if path == "/api/v1/notifications":
+                return self.notifications(query)
+            single = re.match(r"/api/v1/notifications/(\d+)$", path)
+            if single:
+                for notification in state["notifications"]:
+                    if notification["id"] == single.group(1):
+                        return self.respond(notification)
+            if path.startswith("/media/"):
+                with state["lock"]:
+                    state["media_downloads"] += 1
+                if state["photo"] is not None:
+                    return self.respond(
+                        None, body=state["photo"], content_type="image/jpeg"
+                    )
+                return self.respond(
+                    None, body=b"\x89PNG" + b"\x00" * state["settings"]["media_size"]
+                )
+            self.respond({"error": "Record not found"}, status=404)
+
+        def stream(self):
+            """Send new notifications as server-sent events like Mastodon's
+            streaming server, until disconnect_streams() is called"""
+            settings = state["settings"]
+            with state["lock"]:
+                refused = time.time() < state["stream_refused_until"]
+                if not refused:
+                    events = queue.Queue()
+                    state["streams"].append(events)
+                    state["stream_connections"] += 1
+            if refused:
+                self.close_connection = True
+                return self.respond({"error": "Service Unavailable"}, status=503)
+
+            # The stream ends when the connection is closed
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-store")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            sent = 0
+            streamed = 0
+            try:
+                self.wfile.write(b":)\n")
+                self.wfile.flush()
+                while True:
+                    try:
+                        event = events.get(timeout=settings["stream_heartbeat"])
+                    except queue.Empty:
+                        event = b":thump\n"
+                    if event is None:
+                        break
+                    self.wfile.write(event)
+                    self.wfile.flush()
+                    sent += len(event)
+                    if event.startswith(b"event:"):
+                        streamed += 1
+                        with state["lock"]:
+                            state["streamed"] += 1
+                        if streamed == settings["stream_disconnect_after"]:
+                            break
+            except OSError:
+                pass  # the client has gone away
+            finally:
+                with state["lock"]:
+                    state["streams"].remove(events)
+            self.count(len(str(self.requestline)) + len(str(self.headers)), sent + 200)
+
+        def following(self, path, query):
+            limit = min(
+                int(query.get("limit", ["40"])[0]), state["settings"]["page_size"] * 2
+            )
+            member_ids = state["member_ids"]
+            start = 0
+            if "max_id" in query:
+                start = member_ids.index(query["max_id"][0]) + 1
+            page = member_ids[start : start + limit]
+            headers = {}
+            if start + limit < len(member_ids):
+                headers["Link"] = (
+                    "<"
+                    + state["base_url"]
+                    + path
+                    + "?limit="
+                    + str(limit)
+                    + "&max_id="
+                    + page[-1]
+                    + '>; rel="next"'
+                )
+            return self.respond([account(i) for i in page], headers=headers)
+
+        def notifications(self, query):
+            limit = min(
+                int(query.get("limit", ["40"])[0]), state["settings"]["page_size"]
+            )
+            notifications = state["notifications"]
+            types = query.get("types[]")
+            if types:
+                notifications = [n for n in notifications if n["type"] in types]
+            if "max_id" in query:
+                notifications = [
+                    n for n in notifications if int(n["id"]) < int(query["max_id"][0])
+                ]
+            if "since_id" in query:
+                notifications = [
+                    n for n in notifications if int(n["id"]) > int(query["since_id"][0])
+                ]
+            if "min_id" in query:
+                # Pages right after min_id, still sorted newest first
+                notifications = [
+                    n for n in notifications if int(n["id"]) > int(query["min_id"][0])
+                ]
+                notifications = notifications[-limit:]
+            else:
+                notifications = notifications[:limit]
+            return self.respond(notifications)
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length)
+            path = url.path
+            self.wait(media=path in ("/api/v1/media", "/api/v2/media"))
+            if self.throttled():
+                return
+
+            reblog = re.match(r"/api/v1/statuses/(\d+)/reblog$", path)
+            if reblog:
+                with state["lock"]:
+                    state["reblogs"].append(reblog.group(1))
+                return self.respond(self.status("r" + reblog.group(1)))
+            if path == "/api/v1/statuses":
+                with state["lock"]:
+                    failing = state["failed_posts"] < state["settings"]["failing_posts"]
+                    if failing:
+                        state["failed_posts"] += 1
+                if failing:
+                    return self.respond({"error": "Unavailable"}, status=503)
+                with state["lock"]:
+                    state["statuses"].append(length)
+                    status_id = str(len(state["statuses"]))
+                return self.respond(self.status(status_id))
+            if path in ("/api/v1/media", "/api/v2/media"):
+                with state["lock"]:
+                    state["media_uploads"] += 1
+                    media_id = "u" + str(state["media_uploads"])
+                return self.respond(
+                    {"id": media_id, "type": "image", "url": state["base_url"] + "/x"}
+                )
+            if path == "/api/v1/push/subscription":
+                return self.push_subscription(body)
+            if path == "/fake/mention":
+                return self.respond({"id": add_mention(state)})
+            if path == "/fake/disconnect":
+                refuse = float(parse_qs(url.query).get("refuse", ["0"])[0])
+                return self.respond({"closed": disconnect_streams(state, refuse)})
+            self.respond({"error": "Record not found"}, status=404)
+
+        def do_DELETE(self):
+            path = urlparse(self.path).path
+            if self.throttled():
+                return
+            if path == "/api/v1/push/subscription":
+                with state["lock"]:
+                    state["push_subscription"] = None
+                return self.respond({})
+            self.respond({"error": "Record not found"}, status=404)
+
+        def push_subscription(self, body):
+            import fake_push
+
+            form = parse_qs(body.decode())
+            subscription = {
+                "endpoint": form["subscription[endpoint]"][0],
+                "p256dh": base64.b64decode(form["subscription[keys][p256dh]"][0]),
+                "auth": base64.b64decode(form["subscription[keys][auth]"][0]),
+            }
+            with state["lock"]:
+                state["push_subscription"] = subscription
+            return self.respond(
+                {
+                    "id": "1",
+                    "endpoint": subscription["endpoint"],
+                    "alerts": {
+                        name[len("data[alerts][") : -1]: value[0] in ("1", "true")
+                        for name, value in form.items()
+                        if name.startswith("data[alerts][")
+                    },
+                    "policy": form.get("policy", ["all"])[0],
+                    "server_key": fake_push.server_key(),
+                }
+            )
+
+        def status(self, status_id):
+            return {
+                "id": status_id,
+                "created_at": "2020-01-01T00:00:00.000Z",
+                "content": "",
+                "visibility": "public",
+            }
+
+    return FakeMastodonHandler
+
+
+def start_server(settings, port=0):
+    """Start a fake server in a background thread.
+
+    "settings" dictionary overriding values of DEFAULT_SETTINGS
+
+    "port" TCP port on localhost, 0 picks a free one
+
+    Returns the server and its state. Stop it with server.shutdown()."""
+    merged = dict(DEFAULT_SETTINGS)
+    merged.update(settings)
+    server = ThreadingHTTPServer(("127.0.0.1", port), None)
+    server.daemon_threads = True
+    state = new_state(merged, "http://127.0.0.1:" + str(server.server_address[1]))
+    server.RequestHandlerClass = make_handler(state)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    for name, default in DEFAULT_SETTINGS.items():
+        value_type = type(default)
+        if value_type is bool:
+            value_type = lambda value: value.lower() in ("1", "yes", "true")
+        parser.add_argument(
+            "--" + name.replace("_", "-"), type=value_type, default=default
+        )
+    args = vars(parser.parse_args())
+    port = args.pop("port")
+    server, state = start_server(args, port)
+    print("Fake Mastodon API listening at " + state["base_url"])
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(
+            str(state["requests"])
+            + " requests, "
+            + str(len(state["reblogs"]))
+            + " boosts, "
+            + str(len(state["statuses"]))
+            + " statuses, "
+            + str(state["rate_limited"])
+            + " rejected by the rate limit, "
+            + str(state["pushes"])
+            + " pushed, "
+            + str(state["streamed"])
+            + " streamed"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Micro-benchmark for converting status content to plain text.
+
+Compares tootgroup_tools.status_content with the chain of regular
+expressions tootgroup.py used before. Run it from anywhere:
+
+    python benchmarks/html_to_text.py [--links N] [--number N]
+"""
+
+import argparse
+import html
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tootgroup_tools import status_content  # noqa: E402
+
+USERNAME = "group"
+
+
+def make_status(links):
+    """Return the HTML of a long direct message with many links"""
+    mention = (
+        '<span class="h-card"><a href="https://example.social/@' + USERNAME + '" '
+        'class="u-url mention">@<span>' + USERNAME + "</span></a></span> "
+    )
+    parts = []
+    for i in range(links):
+        parts.append(
+            "Have a look at "
+            '<a href="https://example.com/articles/' + str(i) + '" rel="nofollow '
+            'noopener noreferrer" target="_blank"><span class="invisible">'
+            'https://</span><span class="ellipsis">example.com/articles/'
+            + str(i)
+            + '</span><span class="invisible"></span></a> &amp; tell '
+            '<span class="h-card"><a href="https://example.social/@user'
+            + str(i)
+            + '" class="u-url mention">@<span>user'
+            + str(i)
+            + "</span></a></span>"
+            " what you think &quot;about it&quot;!<br />"
+        )
+        if i % 5 == 4:
+            parts.append("</p><p>")
+    return "<p>" + mention + "".join(parts) + "</p>"
+
+
+def regex_chain(content):
+    """What tootgroup.py 1.5 did for every direct message"""
+    account_username = "@" + USERNAME
+    new_status = re.sub("<br />", "\n", content)
+    new_status = re.sub("</p><p>", "\n\n", new_status)
+    new_status = re.sub("<.*?>", "", new_status)
+    if new_status.startswith(account_username):
+        new_status = re.sub(account_username, "", new_status)
+        return html.unescape(new_status)
+    return None
+
+
+def status_content_text(content):
+    return status_content.strip_leading_mention(content, USERNAME)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--links", type=int, default=50, help="links per status")
+    parser.add_argument("--number", type=int, default=2000, help="calls per run")
+    parser.add_argument("--repeat", type=int, default=5, help="runs, best counts")
+    args = parser.parse_args()
+
+    content = make_status(args.links)
+    print(
+        "status: "
+        + str(len(content))
+        + " characters, "
+        + str(args.links)
+        + " links, best of "
+        + str(args.repeat)
+        + " runs"
+    )
+    results = {}
+    for name, function in (
+        ("regex chain", regex_chain),
+        ("status_content", status_content_text),
+    ):
+        best = min(
+            timeit.repeat(
+                lambda: function(content), number=args.number, repeat=args.repeat
+            )
+        )
+        results[name] = best / args.number
+        print("%-14s %9.1f µs per status" % (name, results[name] * 1e6))
+    print(
+        "speed-up       %9.2fx" % (results["regex chain"] / results["status_content"])
+    )
+
+
+if __name__ == "__main__":
+    main()
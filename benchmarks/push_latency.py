@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark of tootgroup.py's Web Push receiver.
+
+The fake server is started and "tootgroup.py --push" subscribes to it.
+New mentions are then added one after the other. The fake server pushes
+each of them like Mastodon would (see fake_push.py), and the time until
+the boost arrives is measured. The requests sent while the group is idle
+are counted as well. Needs the "webpush" extra of Mastodon.py.
+
+    python benchmarks/push_latency.py
+    python benchmarks/push_latency.py --mentions 50 --idle 30"""
+
+import argparse
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_server
+import run_benchmark
+
+# Where tootgroup.py's receiver listens during the benchmark
+PUSH_ADDRESS = "127.0.0.1:8182"
+
+
+def wait_for(condition, timeout):
+    """Wait until condition() is true, return False on timeout"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--mentions",
+        type=int,
+        default=20,
+        help="mentions pushed one after the other (default %(default)s)",
+    )
+    parser.add_argument(
+        "--idle",
+        type=float,
+        default=10.0,
+        help="seconds requests are counted while idle (default %(default)s)",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.02,
+        help="seconds every request takes on the server (default %(default)s)",
+    )
+    args = parser.parse_args()
+
+    server, state = fake_server.start_server(
+        {"members": 10, "mentions": 0, "latency": args.latency}
+    )
+    directory = tempfile.mkdtemp(prefix="tootgroup-push-")
+    process = None
+    try:
+        run_benchmark.setup_group(
+            directory,
+            state["base_url"],
+            {
+                "push_url": "http://" + PUSH_ADDRESS + "/push",
+                "push_listen": PUSH_ADDRESS,
+                "push_poll_interval": "3600",
+            },
+        )
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.path.abspath(run_benchmark.REPOSITORY)
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(directory, "tootgroup.py"),
+                "-g",
+                run_benchmark.GROUP_NAME,
+                "--push",
+            ],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        if not wait_for(lambda: state["push_subscription"] is not None, 60):
+            print("tootgroup.py did not subscribe to Web Push")
+            return
+
+        # Let the first catch-up finish before counting idle requests
+        time.sleep(2)
+        requests = state["requests"]
+        time.sleep(args.idle)
+        idle_requests = state["requests"] - requests
+
+        latencies = []
+        requests = state["requests"]
+        for i in range(args.mentions):
+            started = time.perf_counter()
+            fake_server.add_mention(state)
+            if not wait_for(lambda: len(state["reblogs"]) > i, 30):
+                print("Pushed mention has not been boosted")
+                return
+            latencies.append(time.perf_counter() - started)
+        pushed_requests = state["requests"] - requests
+
+        print(
+            "%d pushed mentions: median %.1f ms, slowest %.1f ms, %.1f requests each"
+            % (
+                len(latencies),
+                statistics.median(latencies) * 1000,
+                max(latencies) * 1000,
+                pushed_requests / float(len(latencies)),
+            )
+        )
+        print("%d requests while idle for %.0f s" % (idle_requests, args.idle))
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.communicate(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
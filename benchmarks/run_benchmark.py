@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark of tootgroup.py runs against a local fake server.
+
+Every scenario starts benchmarks/fake_server.py with its own settings and
+runs tootgroup.py once for a freshly configured group, exactly like cron
+would. Reported are the run's wall time, the number of requests the server
+received, the bytes transferred and the peak memory (RSS) of the
+tootgroup.py process. Requests the server rejected because of its rate
+limit are reported as well.
+
+    python benchmarks/run_benchmark.py                 # all scenarios
+    python benchmarks/run_benchmark.py --list
+    python benchmarks/run_benchmark.py busy-group --latency 0.05 -- --async
+
+Arguments after "--" are passed on to tootgroup.py. By default, member and
+identity caches are started cold. Use --warm to do an unmeasured run first
+and measure the second one with all caches filled."""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_server
+
+REPOSITORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+GROUP_NAME = "bench"
+
+SCENARIOS = {
+    "quiet-group": {
+        "description": "100 members, nothing new",
+        "settings": {"members": 100, "mentions": 0},
+    },
+    "busy-group": {
+        "description": "200 members, 60 pending mentions",
+        "settings": {"members": 200, "mentions": 60},
+    },
+    "big-backlog": {
+        "description": "10k members, 500 pending mentions",
+        "settings": {"members": 10000, "mentions": 500, "stranger_share": 0.1},
+        "config": {"max_notifications": "500"},
+    },
+    "large-images": {
+        "description": "DM with 4 large images",
+        "settings": {
+            "members": 10,
+            "mentions": 1,
+            "direct_share": 1.0,
+            "media_per_dm": 4,
+            "media_size": 8 * 1024 * 1024,
+        },
+    },
+    "optimized-photos": {
+        "description": "DM with 4 24 MP photos, optimized",
+        "settings": {
+            "members": 10,
+            "mentions": 1,
+            "direct_share": 1.0,
+            "media_per_dm": 4,
+            "media_photo_pixels": 6000 * 4000,
+        },
+        "config": {"media_optimize": "yes"},
+    },
+    "rate-limited": {
+        "description": "60 mentions, 50 requests per 10 s",
+        "settings": {
+            "members": 50,
+            "mentions": 60,
+            "rate_limit": 50,
+            "rate_limit_period": 10.0,
+        },
+    },
+    "backlog-drain": {
+        "description": "2000 pending mentions, --drain",
+        "settings": {
+            "members": 100,
+            "mentions": 2000,
+            "direct_share": 0.0,
+            "rate_limit": 100000,
+        },
+        "arguments": ["--drain"],
+    },
+    "media-heavy": {
+        "description": "20 DMs with 2 images each",
+        "settings": {
+            "members": 50,
+            "mentions": 20,
+            "direct_share": 1.0,
+            "media_per_dm": 2,
+            "media_size": 512 * 1024,
+        },
+    },
+}
+
+
+def setup_group(directory, base_url, config):
+    """Write configuration and credentials for the benchmark group.
+
+    tootgroup.py looks for its configuration next to the script first, so
+    it is linked into the directory."""
+    os.symlink(
+        os.path.join(os.path.abspath(REPOSITORY), "tootgroup.py"),
+        os.path.join(directory, "tootgroup.py"),
+    )
+    with open(os.path.join(directory, GROUP_NAME + "_clientcred.secret"), "w") as f:
+        f.write("client_id\nclient_secret\n" + base_url + "\n")
+    with open(os.path.join(directory, GROUP_NAME + "_usercred.secret"), "w") as f:
+        f.write("access_token\n" + base_url + "\n")
+    options = {
+        "mastodon_instance": base_url,
+        "client_id": GROUP_NAME + "_clientcred.secret",
+        "access_token": GROUP_NAME + "_usercred.secret",
+        "accept_retoots": "yes",
+        "accept_dms": "yes",
+        "dm_visibility": "public",
+        "last_seen_id": "0",
+    }
+    options.update(config)
+    with open(os.path.join(directory, "tootgroup.conf"), "w") as f:
+        f.write("[" + GROUP_NAME + "]\n")
+        for key, value in options.items():
+            f.write(key + " = " + value + "\n")
+
+
+def run_tootgroup(directory, arguments):
+    """Run tootgroup.py once and return its wall time, peak RSS and output"""
+    # Make sure tootgroup_tools is imported from this repository
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.abspath(REPOSITORY)
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(directory, "tootgroup.py"), "-g", GROUP_NAME]
+        + arguments,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env=env,
+    )
+    output = process.stdout.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - started
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    # ru_maxrss is reported in KiB on Linux but in bytes on macOS
+    peak_rss = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return wall_time, peak_rss, output.decode(errors="replace"), process.returncode
+
+
+def run_scenario(name, scenario, latency, warm, arguments):
+    """Run a single scenario and return its results as a dictionary"""
+    settings = dict(scenario["settings"])
+    settings["latency"] = latency
+    arguments = scenario.get("arguments", []) + arguments
+    server, state = fake_server.start_server(settings)
+    directory = tempfile.mkdtemp(prefix="tootgroup-benchmark-")
+    try:
+        setup_group(directory, state["base_url"], scenario.get("config", {}))
+        if warm:
+            # Fill the caches. The group's progress is reset afterwards,
+            # so the measured run has the same work to do.
+            run_tootgroup(directory, arguments)
+            for file_name in os.listdir(directory):
+                if file_name.startswith(GROUP_NAME + "_state.sqlite"):
+                    os.unlink(os.path.join(directory, file_name))
+            with state["lock"]:
+                state["requests"] = state["bytes_received"] = state["bytes_sent"] = 0
+                state["reblogs"] = []
+                state["statuses"] = []
+                state["media_uploads"] = 0
+                state["rate_limited"] = 0
+        wall_time, peak_rss, output, returncode = run_tootgroup(directory, arguments)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if returncode != 0 or "Successful tootgroup.py run" not in output:
+        print(output)
+    return {
+        "scenario": name,
+        "description": scenario["description"],
+        "latency": latency,
+        "wall_time": round(wall_time, 3),
+        "requests": state["requests"],
+        "bytes_sent_to_server": state["bytes_received"],
+        "bytes_received_from_server": state["bytes_sent"],
+        "peak_rss": peak_rss,
+        "boosts": len(state["reblogs"]),
+        "statuses": len(state["statuses"]),
+        "media_uploads": state["media_uploads"],
+        "rate_limited": state["rate_limited"],
+        "succeeded": returncode == 0 and "Successful tootgroup.py run" in output,
+    }
+
+
+def print_result(result):
+    print(
+        (
+            "%-13s %-36s %8.2f s %6d req %4d 429 %9.1f KiB up %9.1f KiB down "
+            + "%7.1f MiB RSS%s"
+        )
+        % (
+            result["scenario"],
+            result["description"],
+            result["wall_time"],
+            result["requests"],
+            result["rate_limited"],
+            result["bytes_sent_to_server"] / 1024.0,
+            result["bytes_received_from_server"] / 1024.0,
+            result["peak_rss"] / 1024.0 / 1024.0,
+            "" if result["succeeded"] else "  FAILED",
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        epilog='Arguments after "--" are passed on to tootgroup.py.'
+    )
+    parser.add_argument("scenarios", nargs="*", help="scenarios to run, default all")
+    parser.add_argument("--list", action="store_true", help="list scenarios")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.02,
+        help="seconds every request takes on the server (default %(default)s)",
+    )
+    parser.add_argument(
+        "--warm", action="store_true", help="measure with filled caches"
+    )
+    parser.add_argument("--json", action="store_true", help="print JSON lines")
+    arguments = sys.argv[1:]
+    tootgroup_arguments = []
+    if "--" in arguments:
+        tootgroup_arguments = arguments[arguments.index("--") + 1 :]
+        arguments = arguments[: arguments.index("--")]
+    args = parser.parse_args(arguments)
+
+    if args.list:
+        for name, scenario in SCENARIOS.items():
+            print("%-13s %s" % (name, scenario["description"]))
+        return
+
+    failed = False
+    for name in args.scenarios or SCENARIOS:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario " + name)
+        result = run_scenario(
+            name, SCENARIOS[name], args.latency, args.warm, tootgroup_arguments
+        )
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print_result(result)
+        failed = failed or not result["succeeded"]
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
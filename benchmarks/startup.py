@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Startup benchmark of short tootgroup.py runs, like the ones cron starts.
+
+Measured are "--version", "--help" and a dry-run of an idle group with
+filled caches, once with Mastodon.py and once with the built-in REST client
+("api_client = builtin"). For comparison, the time Python needs to start
+and to import Mastodon.py alone is measured, too. Every command is run
+several times, the median and the fastest wall time are reported.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --repeat 20 --importtime
+
+With --importtime, the slowest imports of the idle runs are listed as
+reported by "python -X importtime"."""
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_server
+import run_benchmark
+
+
+def measure(command, directory, repeat):
+    """Run a command several times and return its wall times in seconds"""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.abspath(run_benchmark.REPOSITORY)
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run(
+            command,
+            cwd=directory,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def slowest_imports(command, directory, count=8):
+    """Return the slowest top-level imports of a command"""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.abspath(run_benchmark.REPOSITORY)
+    output = subprocess.run(
+        [command[0], "-X", "importtime"] + command[1:],
+        cwd=directory,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    ).stderr
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Only modules imported directly, not their dependencies
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=10,
+        help="runs per command (default %(default)s)",
+    )
+    parser.add_argument(
+        "--importtime", action="store_true", help="list the slowest imports"
+    )
+    args = parser.parse_args()
+
+    server, state = fake_server.start_server({"members": 100, "mentions": 0})
+    directories = {}
+    try:
+        for client in ("mastodon.py", "builtin"):
+            directory = tempfile.mkdtemp(prefix="tootgroup-startup-")
+            directories[client] = directory
+            run_benchmark.setup_group(
+                directory, state["base_url"], {"api_client": client}
+            )
+            # Fill identity and member caches
+            measure(
+                [sys.executable, "tootgroup.py", "-g", run_benchmark.GROUP_NAME],
+                directory,
+                1,
+            )
+
+        tootgroup = [sys.executable, "tootgroup.py"]
+        idle_run = tootgroup + ["-g", run_benchmark.GROUP_NAME, "--dry-run"]
+        commands = [
+            ("python startup", [sys.executable, "-c", "pass"], "builtin"),
+            ("import mastodon", [sys.executable, "-c", "import mastodon"], "builtin"),
+            ("--version", tootgroup + ["--version"], "builtin"),
+            ("--help", tootgroup + ["--help"], "builtin"),
+            ("idle, Mastodon.py", idle_run, "mastodon.py"),
+            ("idle, built-in client", idle_run, "builtin"),
+        ]
+        for name, command, client in commands:
+            times = measure(command, directories[client], args.repeat)
+            print(
+                "%-24s median %7.1f ms   fastest %7.1f ms"
+                % (name, statistics.median(times) * 1000, min(times) * 1000)
+            )
+
+        if args.importtime:
+            for client in ("mastodon.py", "builtin"):
+                print("")
+                print("Slowest imports of an idle run with " + client + ":")
+                for microseconds, module in slowest_imports(
+                    idle_run, directories[client]
+                ):
+                    print("  %-30s %7.1f ms" % (module, microseconds / 1000.0))
+    finally:
+        server.shutdown()
+        server.server_close()
+        for directory in directories.values():
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
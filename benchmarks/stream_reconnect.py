@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""End-to-end check of tootgroup.py's streaming mode across reconnects.
+
+The fake server is started and "tootgroup.py --stream" connects to its
+streaming API. New mentions are added one after the other and the time
+until each boost arrives is measured. Then the streaming connection is
+dropped and refused for a while. Mentions added meanwhile can only be
+found by the catch-up poll after reconnecting. In the end, every mention
+has to be boosted exactly once.
+
+    python benchmarks/stream_reconnect.py
+    python benchmarks/stream_reconnect.py --mentions 50 --refuse 10"""
+
+import argparse
+import os
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_server
+import run_benchmark
+from push_latency import wait_for
+
+
+def add_mentions(state, count):
+    """Add mentions one after the other and wait for each boost.
+
+    Returns the seconds every boost took, or None if one did not arrive."""
+    latencies = []
+    for _ in range(count):
+        boosted = len(state["reblogs"])
+        started = time.perf_counter()
+        fake_server.add_mention(state)
+        if not wait_for(lambda: len(state["reblogs"]) > boosted, 30):
+            return None
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--mentions",
+        type=int,
+        default=20,
+        help="mentions streamed before and after the outage (default %(default)s)",
+    )
+    parser.add_argument(
+        "--missed",
+        type=int,
+        default=5,
+        help="mentions added while disconnected (default %(default)s)",
+    )
+    parser.add_argument(
+        "--refuse",
+        type=float,
+        default=5.0,
+        help="seconds new connections are refused (default %(default)s)",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.02,
+        help="seconds every request takes on the server (default %(default)s)",
+    )
+    args = parser.parse_args()
+
+    server, state = fake_server.start_server(
+        {"members": 10, "mentions": 0, "latency": args.latency}
+    )
+    directory = tempfile.mkdtemp(prefix="tootgroup-stream-")
+    process = None
+    try:
+        run_benchmark.setup_group(directory, state["base_url"], {})
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.path.abspath(run_benchmark.REPOSITORY)
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(directory, "tootgroup.py"),
+                "-g",
+                run_benchmark.GROUP_NAME,
+                "--stream",
+            ],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        if not wait_for(lambda: len(state["streams"]) > 0, 60):
+            print("tootgroup.py did not connect to the streaming API")
+            return
+        # Let the first catch-up finish
+        time.sleep(2)
+
+        streamed = add_mentions(state, args.mentions)
+        if streamed is None:
+            print("Streamed mention has not been boosted")
+            return
+
+        boosted = len(state["reblogs"])
+        fake_server.disconnect_streams(state, args.refuse)
+        for _ in range(args.missed):
+            fake_server.add_mention(state)
+        started = time.perf_counter()
+        if not wait_for(
+            lambda: len(state["reblogs"]) >= boosted + args.missed,
+            args.refuse + 600,
+        ):
+            print("Missed mentions have not been caught up with")
+            return
+        caught_up = time.perf_counter() - started
+
+        reconnected = add_mentions(state, args.mentions)
+        if reconnected is None:
+            print("Mention streamed after reconnecting has not been boosted")
+            return
+
+        print(
+            "%d streamed mentions: median %.1f ms, slowest %.1f ms"
+            % (
+                len(streamed),
+                statistics.median(streamed) * 1000,
+                max(streamed) * 1000,
+            )
+        )
+        print(
+            "%d mentions missed during a %.0f s outage caught up after %.1f s"
+            % (args.missed, args.refuse, caught_up)
+        )
+        print(
+            "%d streamed mentions after reconnecting: median %.1f ms"
+            % (len(reconnected), statistics.median(reconnected) * 1000)
+        )
+        total = 2 * args.mentions + args.missed
+        duplicates = len(state["reblogs"]) - len(set(state["reblogs"]))
+        print(
+            "%d of %d mentions boosted, %d twice, %d streaming connections"
+            % (
+                len(set(state["reblogs"])),
+                total,
+                duplicates,
+                state["stream_connections"],
+            )
+        )
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.communicate(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,288 +12,2327 @@ any later version.
 
 See attached LICENSE file.
 """
-import html
+import atexit
+import concurrent.futures
+import configparser
+import mimetypes
 import os
-import re
+import shutil
 import sys
 import tempfile
+import threading
+import time
 
-import mastodon
-import requests
+# Heavy modules like asyncio and mastodon are only imported where they are
+# needed. This keeps runs that have nothing to do fast, see rest_client.
+import tootgroup_tools
+
+TOOTGROUP_VERSION = "1.5"
+
+# Notification types tootgroup.py acts upon. Only these are fetched from the
+# server. Servers that do not support filtering by "types" get the others
+# excluded instead.
+NOTIFICATION_TYPES = ["mention", "follow"]
+EXCLUDED_NOTIFICATION_TYPES = [
+    "favourite",
+    "reblog",
+    "poll",
+    "follow_request",
+    "status",
+    "update",
+]
+
+# Defaults for fetching notifications. They can be overridden per group with
+# "notification_page_size" and "max_notifications" in the config file.
+NOTIFICATION_PAGE_SIZE = 40
+MAX_NOTIFICATIONS = 100
+
+# Number of notifications handled and checkpointed together with --drain.
+# It can be overridden per group with "drain_batch_size" in the config file.
+DRAIN_BATCH_SIZE = 100
+
+# Defaults for re-uploading media files. They can be overridden per group with
+# the according "media_..." option in the config file. See get_media_settings().
+MEDIA_SETTINGS = {
+    # maximum number of media files transferred at the same time
+    "concurrency": 4,
+    # seconds to wait for a server before giving up a transfer
+    "timeout": 60.0,
+    # media files are kept in memory up to this size in bytes, bigger ones
+    # are buffered on disk
+    "spool_size": 4 * 1024 * 1024,
+    # media files bigger than this are not reposted at all
+    "max_size": 100 * 1024 * 1024,
+    # size budget of the media cache in bytes, 0 disables caching
+    "cache_size": 256 * 1024 * 1024,
+    # seconds an unattached upload is reused instead of uploading again
+    "upload_window": 3600.0,
+    # scale down, re-encode and strip images before uploading them again
+    "optimize": False,
+    # images with more pixels are scaled down to fit
+    "max_pixels": 3840 * 2160,
+    # quality images are re-encoded with, from 1 to 95
+    "quality": 85,
+}
+
+# Size of the chunks media files are downloaded in
+MEDIA_CHUNK_SIZE = 64 * 1024
+
+# Number of worker threads the asyncio engine sends requests from. It can be
+# overridden per group with "async_workers" in the config file.
+ASYNC_WORKERS = 8
+
+# Number of worker threads planned actions are executed on by a regular run.
+# It can be overridden per group with "action_workers" in the config file.
+ACTION_WORKERS = 4
+
+# Number of runs a failing boost or reply is tried in before it is given up.
+# It can be overridden per group with "action_max_attempts" in the config file.
+ACTION_MAX_ATTEMPTS = 10
+
+# Number of groups served at the same time with --all-groups. It can be
+# overridden with --jobs on the command line.
+GROUP_WORKERS = 8
+
+# Held while printing from worker threads, so lines do not get mixed up
+OUTPUT_LOCK = threading.Lock()
+
+
+def main():
+    """Execution starts here"""
+
+    # Read commandline arguments and flags from input
+    commandline_arguments = tootgroup_tools.commandline_arguments.parse_arguments()
+
+    # Measure the time spent in every phase of the run if asked for.
+    if commandline_arguments["profile"]:
+        tootgroup_tools.phase_profiler.start(commandline_arguments["profile_file"])
+        atexit.register(tootgroup_tools.phase_profiler.finish)
+
+    # if the "--version" argument has been given, show version and exit.
+    if commandline_arguments["show_version"]:
+        print(TOOTGROUP_VERSION)
+        sys.exit(0)
+
+    # A replay needs neither a configuration nor a server.
+    if commandline_arguments["replay_file"]:
+        if run_replay(commandline_arguments):
+            sys.exit(0)
+        sys.exit(1)
+
+    # Get the configuration storage location
+    config_store = tootgroup_tools.configuration_management.setup_configuration_store()
+
+    # In daemon mode, all configured groups are served from this process until
+    # it gets interrupted.
+    if commandline_arguments["daemon"]:
+        run_daemon(config_store, commandline_arguments)
+        sys.exit(0)
+
+    # Do one run for every configured group and exit with a combined status.
+    if commandline_arguments["all_groups"]:
+        if run_all_groups(config_store, commandline_arguments):
+            sys.exit(0)
+        sys.exit(1)
+
+    # Get the handle for the account the script has been invoked with.
+    config_store["group_name"] = commandline_arguments["group_name"]
+    group_name = config_store["group_name"]
+
+    # Get and validate configuration from the config file.
+    my_config = tootgroup_tools.configuration_management.parse_configuration(
+        config_store
+    )
+
+    # Only one process at a time may serve a group. The lock is held until
+    # tootgroup.py exits.
+    group_lock = lock_group(config_store, group_name)
+    if group_lock is None:
+        sys.exit(0)
+
+    # Keep everything the run receives to replay it later on, starting with
+    # the group's identity.
+    capture = None
+    if commandline_arguments["record_file"]:
+        capture = tootgroup_tools.traffic_capture.start_recording(
+            commandline_arguments["record_file"],
+            tootgroup_tools.http_session.get_session(group_name),
+        )
+
+    # Connect to the Fediverse server and get the group account information.
+    group = connect_group(
+        config_store,
+        my_config,
+        group_name,
+        commandline_arguments["stream"] or commandline_arguments["push"],
+    )
+    if group is None:
+        sys.exit(0)
+
+    # If the "catch-up" commandline argument has been given, reset the last seen
+    # ID so that tootgroup.py only updates its stored progress without
+    # retooting anything.
+    if commandline_arguments["catch_up"]:
+        group["last_seen_id"] = "catch-up"
+    if commandline_arguments["refresh_members"]:
+        group["member_cache"]["updated"] = 0.0
+
+    # In streaming mode, notifications are processed as soon as the server
+    # sends them until tootgroup.py gets interrupted.
+    if commandline_arguments["stream"]:
+        run_stream(group, commandline_arguments)
+        sys.exit(0)
+
+    # In push mode, the server sends new notifications to tootgroup.py via
+    # Web Push until it gets interrupted.
+    if commandline_arguments["push"]:
+        run_push(group, commandline_arguments)
+        sys.exit(0)
+
+    if capture is not None:
+        group["capture"] = capture
+        write_capture_header(group)
+
+    try:
+        process_notifications(group, commandline_arguments)
+    except Exception as ex:
+        if not is_unauthorized(ex):
+            raise
+        # The cached identity might not be valid any more.
+        tootgroup_tools.account_identity.discard_identity(config_store, group_name)
+        report_connection_error(ex)
+        write_metrics(commandline_arguments)
+        sys.exit(0)
+    finally:
+        if group["capture"] is not None:
+            stop_recording(group)
+
+    write_metrics(commandline_arguments)
+
+    # Failed actions have been reported already and are retried next time.
+    if any(is_failed(result) for result in group["action_results"]):
+        sys.exit(1)
+
+    print(
+        "Successful tootgroup.py run for "
+        + "@"
+        + group["account"]["username"]
+        + " at "
+        + my_config[group_name]["mastodon_instance"]
+    )
+
+
+def connect_group(config_store, my_config, group_name, full_client=False):
+    """Create the Mastodon API instance for a group and get its account.
+
+    "config_store" dictionary containting config file name and path
+
+    "my_config" the configuration as returned by parse_configuration()
+
+    "group_name" handle of the group that should be connected
+
+    "full_client" True if the streaming API or Web Push will be used. Only
+    Mastodon.py supports them. Otherwise, the built-in REST client is used
+    if the group's "api_client" is set to "builtin".
+
+    Returns a dictionary holding everything needed to process the group's
+    notifications later on, or None if the server could not be reached. The
+    returned client is kept alive and can be reused for any number of runs.
+    The group's progress is loaded from the state store as "last_seen_id",
+    posts waiting to be published are kept in its "outbox"."""
+    mastodon_instance = my_config[group_name]["mastodon_instance"]
+
+    # The group account's identity is cached between runs. Only if it is
+    # missing or outdated, it has to be verified with the server.
+    with tootgroup_tools.phase_profiler.phase("identity"):
+        my_account = tootgroup_tools.account_identity.load_identity(
+            config_store,
+            group_name,
+            mastodon_instance,
+            my_config[group_name].getfloat(
+                "identity_cache_ttl",
+                fallback=tootgroup_tools.account_identity.DEFAULT_TTL,
+            ),
+        )
+
+    # Create Mastodon API instance.
+    with tootgroup_tools.phase_profiler.phase("client construction"):
+        if my_config[group_name].get("api_client") == "builtin" and not full_client:
+            masto = tootgroup_tools.rest_client.RestClient(
+                mastodon_instance,
+                config_store["directory"] + my_config[group_name]["access_token"],
+                tootgroup_tools.http_session.get_session(group_name),
+            )
+        else:
+            import mastodon
+
+            masto = mastodon.Mastodon(
+                client_id=config_store["directory"]
+                + my_config[group_name]["client_id"],
+                access_token=config_store["directory"]
+                + my_config[group_name]["access_token"],
+                api_base_url=mastodon_instance,
+                version_check_mode="none",
+                session=tootgroup_tools.http_session.get_session(group_name),
+            )
+
+    if my_account is None:
+        with tootgroup_tools.phase_profiler.phase("identity"):
+            try:
+                # Get the group account information.
+                # This connects to the Fediverse server for the first time.
+                my_account = tootgroup_tools.account_identity.fetch_identity(
+                    masto, mastodon_instance
+                )
+            except Exception as ex:
+                report_connection_error(ex)
+                return None
+            tootgroup_tools.account_identity.save_identity(
+                config_store, group_name, my_account
+            )
+
+    state_store = tootgroup_tools.state_store.get_state_store(config_store, group_name)
+    return {
+        "name": group_name,
+        "config": my_config[group_name],
+        "config_store": config_store,
+        "masto": masto,
+        "account": my_account,
+        "member_cache": tootgroup_tools.member_cache.load_member_cache(
+            config_store, group_name
+        ),
+        "state_store": state_store,
+        "last_seen_id": tootgroup_tools.state_store.load_last_seen_id(
+            state_store, group_name, my_config[group_name]
+        ),
+        "outbox": tootgroup_tools.outbox.get_outbox(
+            config_store, group_name, state_store
+        ),
+        # Set while the group's traffic is recorded or replayed
+        "capture": None,
+    }
+
+
+def lock_group(config_store, group_name):
+    """Make sure no other tootgroup.py process serves a group at the same time.
+
+    "config_store" dictionary containting config file name and path
+
+    "group_name" handle of the group
+
+    Overlapping runs for the same group would repost the same notifications.
+    The lock file "GROUP.lock" next to the configuration is locked instead
+    of waiting for the other process.
+
+    Returns the lock, see file_locks.acquire(), or None if the group is
+    served by another process right now. Then a message is shown."""
+    lock = tootgroup_tools.file_locks.acquire(
+        config_store["directory"] + group_name + ".lock", blocking=False
+    )
+    if lock is None:
+        print(
+            'Group "'
+            + group_name
+            + '" is served by another tootgroup.py process right now.'
+        )
+    return lock
+
+
+def write_capture_header(group):
+    """Start the capture of a group's run with what the run knows beforehand.
+
+    "group" dictionary as returned by connect_group(), with the "capture"
+    returned by traffic_capture.start_recording()
+
+    The group's options are kept without the names of its credential
+    files."""
+    member_cache = group["member_cache"]
+    tootgroup_tools.traffic_capture.write_header(
+        group["capture"],
+        {
+            "group_name": group["name"],
+            "tootgroup_version": TOOTGROUP_VERSION,
+            "config": {
+                key: value
+                for key, value in group["config"].items()
+                if key not in ("client_id", "access_token")
+            },
+            "account": group["account"],
+            "member_ids": sorted(member_cache["member_ids"]),
+            "member_cache_age": (
+                time.time() - member_cache["updated"]
+                if member_cache["updated"]
+                else None
+            ),
+            "last_seen_id": group["last_seen_id"],
+        },
+    )
+
+
+def stop_recording(group):
+    """Close the capture of a group's run, see write_capture_header()"""
+    responses = tootgroup_tools.traffic_capture.stop_recording(group["capture"])
+    print(
+        "Recorded " + str(responses) + " responses to " + group["capture"]["file_name"]
+    )
+    group["capture"] = None
+
+
+def run_replay(commandline_arguments):
+    """Run a capture recorded with --record through the notification handling.
+
+    "commandline_arguments" dictionary as returned by parse_arguments()
+
+    The group is set up from the capture in a temporary directory, with the
+    identity, member cache and progress it had when it was recorded. All
+    requests are answered by the capture, nothing is sent to any server.
+
+    Returns True if all actions have succeeded."""
+    try:
+        capture = tootgroup_tools.traffic_capture.load_capture(
+            commandline_arguments["replay_file"]
+        )
+    except Exception as ex:
+        print("Cannot replay " + commandline_arguments["replay_file"] + ": " + str(ex))
+        return False
+    header = capture["header"]
+    group_name = header["group_name"]
+    mastodon_instance = header["config"]["mastodon_instance"]
+
+    directory = tempfile.mkdtemp(prefix="tootgroup-replay-") + os.sep
+    try:
+        config_store = {
+            "filename": "tootgroup.conf",
+            "directory": directory,
+            "group_name": group_name,
+            "first_run": False,
+            "write_NEW": False,
+        }
+        my_config = configparser.ConfigParser()
+        my_config[group_name] = header["config"]
+        my_config[group_name]["client_id"] = group_name + "_clientcred.secret"
+        my_config[group_name]["access_token"] = group_name + "_usercred.secret"
+        my_config[group_name]["last_seen_id"] = header["last_seen_id"]
+        with open(directory + group_name + "_clientcred.secret", "w") as f:
+            f.write("replay\nreplay\n" + mastodon_instance + "\n")
+        with open(directory + group_name + "_usercred.secret", "w") as f:
+            f.write("replay\n" + mastodon_instance + "\n")
+
+        identity = dict(header["account"])
+        identity["updated"] = time.time()
+        tootgroup_tools.account_identity.save_identity(
+            config_store, group_name, identity
+        )
+        member_cache_age = header["member_cache_age"]
+        tootgroup_tools.member_cache.save_member_cache(
+            config_store,
+            group_name,
+            {
+                "updated": (
+                    time.time() - member_cache_age
+                    if member_cache_age is not None
+                    else 0.0
+                ),
+                "member_ids": set(header["member_ids"]),
+            },
+        )
+
+        tootgroup_tools.traffic_capture.start_replay(
+            capture, tootgroup_tools.http_session.get_session(group_name)
+        )
+        group = connect_group(config_store, my_config, group_name)
+        if group is None:
+            return False
+        group["capture"] = capture
+
+        print(
+            "Replaying @"
+            + header["account"]["username"]
+            + " at "
+            + mastodon_instance
+            + ", recorded "
+            + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(header["recorded"]))
+        )
+        started = time.perf_counter()
+        count = process_notifications(group, commandline_arguments)
+        seconds = time.perf_counter() - started
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    write_metrics(commandline_arguments)
+    print(
+        "Replayed %d notifications in %.3f s (%.0f per second), %d responses "
+        "from the capture, %d requests pretended"
+        % (
+            count,
+            seconds,
+            count / seconds if seconds > 0 else 0.0,
+            capture["served"],
+            capture["stubbed"],
+        )
+    )
+    return not any(is_failed(result) for result in group["action_results"])
+
+
+def write_metrics(commandline_arguments):
+    """Export statistics about the requests sent to the Fediverse servers.
+
+    "commandline_arguments" dictionary as returned by parse_arguments()
+
+    Nothing is written unless a metrics file has been given on the
+    command line."""
+    if commandline_arguments["metrics_file"]:
+        tootgroup_tools.api_metrics.write_prometheus_textfile(
+            commandline_arguments["metrics_file"]
+        )
+    if commandline_arguments["metrics_json_file"]:
+        tootgroup_tools.api_metrics.append_json_lines(
+            commandline_arguments["metrics_json_file"]
+        )
+
+
+def is_unauthorized(ex):
+    """Check if an exception means that the server rejected the group's
+    credentials. Works for both Mastodon.py and the built-in REST client."""
+    if isinstance(ex, tootgroup_tools.rest_client.UnauthorizedError):
+        return True
+    # If Mastodon.py has not been imported, it cannot have raised anything
+    mastodon = sys.modules.get("mastodon")
+    return mastodon is not None and isinstance(ex, mastodon.MastodonUnauthorizedError)
+
+
+def is_permanent_error(ex):
+    """Check if an exception means that the server will never accept the
+    request, e.g. because the status to boost has been deleted.
+
+    Client errors count, except for "429 Too Many Requests", "408 Request
+    Timeout" and rejected credentials, see is_unauthorized(). Network errors
+    and server errors may go away and do not count."""
+    status_code = None
+    if isinstance(ex, tootgroup_tools.rest_client.ApiError):
+        status_code = ex.status_code
+    else:
+        mastodon = sys.modules.get("mastodon")
+        if mastodon is not None and isinstance(ex, mastodon.MastodonAPIError):
+            # Mastodon.py passes the status code as the second argument
+            if len(ex.args) > 1 and isinstance(ex.args[1], int):
+                status_code = ex.args[1]
+    if status_code is None or status_code in (408, 429):
+        return False
+    return 400 <= status_code < 500 and not is_unauthorized(ex)
+
+
+def report_connection_error(ex):
+    """Tell the user that the Fediverse server cannot be used.
+
+    "ex" the exception that has been raised while talking to the server"""
+    print("")
+    print("\n########################################################")
+    print("tootgroup.py could not connect to the Fediverse server")
+    print("instance. If you know that it is running, there might be a")
+    print("problem with your local configuration. Check the error")
+    print("message for more details:")
+    print(ex)
+    print("\nYou can always try to delete tootgroup.py's config file")
+    print("and re-run the script for a new setup.")
+    print("########################################################\n")
+
+
+def process_notifications(group, commandline_arguments):
+    """Fetch new notifications for a connected group and repost them.
+
+    "group" dictionary as returned by connect_group()
+
+    "commandline_arguments" dictionary as returned by parse_arguments()
+
+    This does one complete pass over everything that happened since the
+    last run. Every handled notification is recorded in the state store.
+    Whatever has been done is written there even if the pass fails halfway,
+    so the next pass continues right after it. With --drain, the whole
+    backlog is worked through in batches instead, see drain_backlog().
+
+    The result of every action is kept in the group's "action_results", see
+    run_action(). Failed actions are reported but do not stop the pass,
+    except if the server rejects the group's credentials. Posts waiting in
+    the group's outbox are published first, see publish_outbox().
+
+    Returns the number of new notifications that have been found."""
+    group["action_results"] = []
+    outbox_results = []
+    try:
+        outbox_results = publish_outbox(group, commandline_arguments)
+        if commandline_arguments["drain"]:
+            count = drain_backlog(group, commandline_arguments)
+        elif commandline_arguments["run_async"]:
+            count = process_notifications_async(group, commandline_arguments)
+        else:
+            my_notifications = fetch_new_notifications(group)
+
+            # Only group members may post to the group. Make sure all of them
+            # are known.
+            update_group_members(group, my_notifications)
+
+            finish_actions(
+                group,
+                [notification.id for notification in my_notifications],
+                dispatch_actions(
+                    group,
+                    plan_actions(group, my_notifications),
+                    commandline_arguments,
+                ),
+                commandline_arguments,
+            )
+            count = len(my_notifications)
+    finally:
+        save_progress(group, commandline_arguments)
+        tootgroup_tools.repost_latency.finish_pass(group["name"])
+
+    group["action_results"] = outbox_results + group["action_results"]
+    report_action_failures(group["action_results"])
+    for result in group["action_results"]:
+        if is_unauthorized(result["error"]):
+            raise result["error"]
+    return count
+
+
+def drain_backlog(group, commandline_arguments):
+    """Work through all pending notifications of a group in bounded memory.
+
+    "group" dictionary as returned by connect_group()
+
+    "commandline_arguments" dictionary as returned by parse_arguments()
+
+    Unlike a regular pass, this is not limited by "max_notifications".
+    Notifications are fetched page by page, oldest first, and turned into
+    compact records right away, see notification_records. They are handled
+    in batches of "drain_batch_size" notifications. After every batch, the
+    progress is written to the state store, so an interrupted drain goes on
+    from there next time.
+
+    Actions that could not be completed are retried by the next run, see
+    give_up_action(). Draining goes on after them, but "last_seen_id" stays
+    before the first one, so it is not skipped.
+
+    Returns the number of notifications that have been handled."""
+    # Catching up does not need to page through anything.
+    if group["last_seen_id"] == "catch-up":
+        return len(fetch_new_notifications(group))
+
+    batch_size = max(
+        1, group["config"].getint("drain_batch_size", fallback=DRAIN_BATCH_SIZE)
+    )
+    records = tootgroup_tools.notification_records.compact_notifications(
+        iter_notification_pages(group)
+    )
+    results = []
+    count = 0
+    advance = True
+    for batch in tootgroup_tools.notification_records.batched(records, batch_size):
+        update_group_members(group, batch)
+        advance = (
+            finish_actions(
+                group,
+                [record.id for record in batch],
+                dispatch_actions(
+                    group, plan_actions(group, batch), commandline_arguments
+                ),
+                commandline_arguments,
+                advance,
+            )
+            and advance
+        )
+        results.extend(group["action_results"])
+        group["action_results"] = results
+        count += len(batch)
+        save_progress(group, commandline_arguments)
+        print("Drained " + str(count) + " notifications so far")
+        if any(is_unauthorized(result["error"]) for result in results):
+            break
+    return count
+
+
+def plan_actions(group, notifications):
+    """Decide what has to be done with newly fetched notifications.
+
+    "group" dictionary as returned by connect_group()
+
+    "notifications" newly fetched notifications, oldest first
+
+    Notifications that have been processed already are left out.
+
+    Returns the planned actions as returned by classify_notification(), in
+    the order of their notifications."""
+    processed = find_processed(group, notifications)
+    actions = []
+    for notification in notifications:
+        if str(notification.id) in processed:
+            continue
+        action = classify_notification(group, notification)
+        if action is not None:
+            actions.append(action)
+    return actions
+
+
+def dispatch_actions(group, actions, commandline_arguments):
+    """Execute planned actions on a pool of worker threads.
+
+    "group" dictionary as returned by connect_group()
+
+    "actions" planned actions as returned by classify_notification(), in the
+    order of their notifications
+
+    "commandline_arguments" dictionary as returned by parse_arguments()
+
+    Retoots and replies do not depend on each other and are sent at the same
+    time. New posts are published one after the other in the order of their
+    notifications, so the group's timeline still reads chronologically. The
+    media files of later posts are transferred meanwhile. The size of the
+    pool can be set with "action_workers" in the group's configuration.
+
+    Returns the result of every action, in the order of "actions"."""
+    if len(actions) == 0:
+        return []
+    posts = [action for action in actions if action["type"] == "post"]
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(
+            1, group["config"].getint("action_workers", fallback=ACTION_WORKERS)
+        )
+    ) as executor:
+        # Uploads are queued before the posts waiting for them, so they
+        # always get a worker first.
+        media_uploads = []
+        if not commandline_arguments["dry_run"]:
+            media_uploads = [
+                executor.submit(upload_action_media, group, post) for post in posts
+            ]
+        publishing = executor.submit(
+            publish_posts, group, posts, commandline_arguments, media_uploads
+        )
+        others = {
+            id(action): executor.submit(
+                run_action, group, action, commandline_arguments
+            )
+            for action in actions
+            if action["type"] != "post"
+        }
+        post_results = iter(publishing.result())
+        return [
+            (
+                next(post_results)
+                if action["type"] == "post"
+                else others[id(action)].result()
+            )
+            for action in actions
+        ]
+
+
+def publish_posts(group, posts, commandline_arguments, media_uploads):
+    """Publish new posts one after the other.
+
+    "group", "commandline_arguments" see execute_action()
+
+    "posts" planned "post" actions in the order of their notifications
+
+    "media_uploads" futures of the posts' media uploads, empty in a dry-run
+
+    If a post fails, it is queued in the group's outbox and the posts after
+    it are queued behind it, see run_action(). Posts that cannot be queued
+    either make the posts after them skipped. They are published in order
+    by the next run then.
+
+    Returns the result of every post."""
+    results = []
+    for i, post in enumerate(posts):
+        new_media = None
+        if len(media_uploads) > 0:
+            try:
+                new_media = media_uploads[i].result()
+            except Exception as ex:
+                results.append(run_action(group, post, commandline_arguments, error=ex))
+                continue
+        if len(results) > 0 and results[-1]["status"] in ("failed", "skipped"):
+            results.append(skip_post(group, post, new_media))
+            continue
+        results.append(run_action(group, post, commandline_arguments, new_media))
+    return results
+
+
+def run_action(group, action, commandline_arguments, new_media=None, error=None):
+    """Execute a planned action and report how it went.
+
+    "group", "action", "commandline_arguments", "new_media" see
+    execute_action()
+
+    "error" the exception uploading the media files of a "post" has raised
+
+    New posts that cannot be published are queued in the group's outbox,
+    see queue_post(). So are all new posts while older ones are waiting
+    there, to keep them in order. Boosts and replies that fail are retried
+    by the next passes until they are given up, see give_up_action(). Posts
+    the server will never accept are given up right away.
+
+    The notification is recorded as processed as soon as its action is done,
+    queued or given up, so a run that gets killed halfway does not repeat it. Moving
+    "last_seen_id" forward is left to finish_actions().
+
+    Returns the action's result, see action_result()."""
+    started = time.perf_counter()
+    outbox = action["type"] == "post" and not commandline_arguments["dry_run"]
+    try:
+        if error is not None:
+            raise error
+        if outbox and tootgroup_tools.outbox.count_posts(group["outbox"]) > 0:
+            result = queue_post(group, action, new_media)
+        else:
+            execute_action(group, action, commandline_arguments, new_media)
+            result = action_result(
+                action, "done", seconds=time.perf_counter() - started
+            )
+    except Exception as ex:
+        result = action_result(action, "failed", ex, time.perf_counter() - started)
+        if outbox and not is_permanent_error(ex):
+            try:
+                result = queue_post(group, action, None, ex)
+            except Exception as queue_ex:
+                print("Cannot queue post in the outbox: " + str(queue_ex))
+        elif not commandline_arguments["dry_run"]:
+            result = give_up_action(group, result)
+    if outbox and result["status"] != "queued":
+        tootgroup_tools.outbox.discard_media_files(
+            group["outbox"], action["notification_id"], len(action["media_attachments"])
+        )
+    if result["status"] == "done" and not commandline_arguments["dry_run"]:
+        tootgroup_tools.repost_latency.record_action(
+            group["name"], action["notification_id"], action["type"]
+        )
+    if is_closed(result):
+        record_processed(
+            group, action["notification_id"], commandline_arguments, advance=False
+        )
+    return result
+
+
+def give_up_action(group, result):
+    """Decide if a failed action is tried again by the next pass.
+
+    "group" dictionary as returned by connect_group()
+
+    "result" the failed action's result, see action_result()
+
+    An action is given up right away if the server will never accept it,
+    e.g. because the status has been deleted meanwhile, see
+    is_permanent_error(). Otherwise, it is given up after failing in
+    "action_max_attempts" passes. Until then, "last_seen_id" stays before
+    its notification, so it is fetched again.
+
+    Returns the result, with the status "given up" if it is not retried."""
+    error = result["error"]
+    if is_unauthorized(error):
+        return result
+    attempts = tootgroup_tools.state_store.count_failure(
+        group["state_store"], group["name"], result["notification_id"]
+    )
+    if not is_permanent_error(error) and attempts < group["config"].getint(
+        "action_max_attempts", fallback=ACTION_MAX_ATTEMPTS
+    ):
+        return result
+    with OUTPUT_LOCK:
+        print("")
+        print("\n##################################################################")
+        print(
+            "Giving up "
+            + result["type"]
+            + " from notification ID: "
+            + str(result["notification_id"])
+            + " after "
+            + str(attempts)
+            + " attempts:"
+        )
+        print(error)
+        print("##################################################################\n")
+    result["status"] = "given up"
+    return result
+
+
+def action_result(action, status, error=None, seconds=0.0):
+    """Return the result of a planned action as a dictionary.
+
+    "action" dictionary as returned by classify_notification()
+
+    "status" either "done", "failed", "queued" in the outbox, "skipped" if
+    it has not been tried because an earlier post failed or "given up" if
+    it has failed too often or can never succeed
+
+    "error" the exception a failed action raised
+
+    "seconds" time it took to execute the action"""
+    return {
+        "notification_id": action["notification_id"],
+        "type": action["type"],
+        "status": status,
+        "error": error,
+        "seconds": seconds,
+    }
+
+
+def is_failed(result):
+    """Tell if an action could not be completed, see action_result().
+
+    Queued posts only count if they have failed. Those that merely wait
+    behind older posts in the outbox do not."""
+    if result["status"] == "queued":
+        return result["error"] is not None
+    return result["status"] != "done"
+
+
+def finish_actions(
+    group, notification_ids, results, commandline_arguments, advance=True
+):
+    """Record the outcome of a pass in the state store.
+
+    "group" dictionary as returned by connect_group()
+
+    "notification_ids" IDs of all notifications of the pass, in order
+
+    "results" results of the actions taken, see action_result()
+
+    "commandline_arguments" dictionary as returned by parse_arguments()
+
+    "advance" if False, "last_seen_id" is left alone, e.g. because an
+    earlier pass left an open action behind
+
+    Notifications whose actions are done, queued in the outbox or given up
+    have been recorded as processed by run_action() already. The group's
+    "last_seen_id" is advanced up to the first notification whose action is
+    still open, so it gets fetched again by the next pass. The results are
+    kept in the group's "action_results".
+
+    Returns True if all actions are closed."""
+    group["action_results"] = results
+    open_results = {}
+    for result in results:
+        if not is_closed(result):
+            open_results[str(result["notification_id"])] = result
+    if not advance:
+        return len(open_results) == 0
+    for notification_id in notification_ids:
+        if str(notification_id) in open_results:
+            break
+        group["last_seen_id"] = str(notification_id)
+    return len(open_results) == 0
+
+
+def is_closed(result):
+    """Tell if an action is done with, see action_result(). Open actions
+    are tried again by the next pass."""
+    return result["status"] in ("done", "queued", "given up")
+
+
+def report_action_failures(results):
+    """Tell the user about actions that could not be completed.
+
+    "results" results of the actions taken, see action_result()"""
+    failed = [result for result in results if is_failed(result)]
+    if len(failed) == 0:
+        return
+    print("")
+    print("\n##################################################################")
+    print(
+        str(len(failed))
+        + " of "
+        + str(len(results))
+        + " actions could not be completed. Unless given up, they will be "
+        + "retried next time:"
+    )
+    for result in failed:
+        if result["status"] == "skipped":
+            reason = "skipped because an earlier post failed"
+        elif result["status"] == "queued":
+            reason = "queued in the outbox, " + str(result["error"])
+        elif result["status"] == "given up":
+            reason = "given up, not retried any more: " + str(result["error"])
+        else:
+            reason = str(result["error"])
+        print(
+            "  "
+            + result["type"]
+            + " from notification ID "
+            + str(result["notification_id"])
+            + ": "
+            + reason
+        )
+    print("##################################################################\n")
+
+
+def skip_post(group, action, new_media):
+    """Leave out a new post because an earlier one has failed. The next run
+    tries it again.
+
+    "group" dictionary as returned by connect_group()
+
+    "action" the planned "post" action
+
+    "new_media" media attachments as returned by upload_action_media()
+
+    Returns the post's result, see action_result()."""
+    release_action_media(group, new_media)
+    tootgroup_tools.outbox.discard_media_files(
+        group["outbox"], action["notification_id"], len(action["media_attachments"])
+    )
+    return action_result(action, "skipped")
+
+
+def release_action_media(group, new_media):
+    """Make uploads of a post that has not been published usable again.
+
+    "group" dictionary as returned by connect_group()
+
+    "new_media" media attachments as returned by upload_action_media()"""
+    if not new_media:
+        return
+    media_cache = get_media_cache(group, get_media_settings(group["config"]))
+    if media_cache is not None:
+        tootgroup_tools.media_cache.release_uploads(
+            media_cache, group["name"], [media["id"] for media in new_media]
+        )
+        tootgroup_tools.media_cache.save_media_cache(media_cache)
+
+
+def forget_action_media(group, new_media):
+    """Forget uploads that have been attached to a published post or are
+    kept by a post in the outbox.
+
+    "group" dictionary as returned by connect_group()
+
+    "new_media" media attachments as returned by upload_action_media()
+
+    The media cache only marks uploads as in use while this process runs.
+    Uploads kept in the outbox are therefore left out of it, so no other
+    post gets them after a restart."""
+    if not new_media:
+        return
+    media_settings = get_media_settings(group["config"])
+    media_cache = get_media_cache(group, media_settings)
+    if media_cache is not None:
+        # Attached uploads cannot be used for another status
+        tootgroup_tools.media_cache.forget_uploads(
+            media_cache,
+            group["name"],
+            [media["id"] for media in new_media],
+            media_settings["upload_window"],
+        )
+        tootgroup_tools.media_cache.save_media_cache(media_cache)
+
+
+def queue_post(group, action, new_media=None, error=None):
+    """Put a new post into the group's outbox instead of publishing it now.
+
+    "group" dictionary as returned by connect_group()
+
+    "action" planned "post" action as returned by classify_notification()
+
+    "new_media" media attachments as returned by upload_action_media(), if
+    they have been uploaded already
+
+    "error" why the post could not be published. None if it only has to
+    wait behind older posts in the outbox.
+
+    The media files put into the outbox by upload_action_media() are kept
+    there, so they do not have to be downloaded again. Files that have not
+    been transferred yet are taken from the media cache if possible. Uploads
+    are kept in the outbox as well and removed from the media cache. See
+    tootgroup_tools.outbox.
+
+    Returns the action's result, see action_result()."""
+    media_cache = get_media_cache(group, get_media_settings(group["config"]))
+    kept_media = []
+    for i, attachment in enumerate(action["media_attachments"]):
+        cached_media = None
+        if media_cache is not None:
+            cached_media = tootgroup_tools.media_cache.lookup(
+                media_cache, attachment.url
+            )
+        kept_file = tootgroup_tools.outbox.media_file_name(
+            group["outbox"], action["notification_id"], i
+        )
+        mime_type = None if cached_media is None else cached_media[2]
+        if os.path.exists(kept_file):
+            kept_media.append(
+                (attachment.url, attachment.description, kept_file, mime_type)
+            )
+        elif cached_media is not None:
+            kept_media.append(
+                (attachment.url, attachment.description, cached_media[1], mime_type)
+            )
+        else:
+            kept_media.append((attachment.url, attachment.description, None, None))
+    tootgroup_tools.outbox.queue_post(
+        group["outbox"],
+        action["notification_id"],
+        {
+            "status": action["status"],
+            "visibility": action["visibility"],
+            "spoiler_text": action["spoiler_text"],
+            "sensitive": action["sensitive"],
+        },
+        kept_media,
+        None if new_media is None else [media["id"] for media in new_media],
+        error,
+        group["config"].getfloat(
+            "outbox_retry_delay", fallback=tootgroup_tools.outbox.DEFAULT_RETRY_DELAY
+        ),
+    )
+    forget_action_media(group, new_media)
+    with OUTPUT_LOCK:
+        if error is None:
+            print(
+                "Queued post from DM with notification ID: "
+                + str(action["notification_id"])
+                + " behind older posts in the outbox"
+            )
+        else:
+            print(
+                "Cannot post from DM with notification ID: "
+                + str(action["notification_id"])
+                + ", queued in the outbox: "
+                + str(error)
+            )
+    return action_result(action, "queued", error)
+
+
+def publish_outbox(group, commandline_arguments):
+    """Publish the posts waiting in a group's outbox.
+
+    "group" dictionary as returned by connect_group()
+
+    "commandline_arguments" dictionary as returned by parse_arguments()
+
+    Posts are published oldest first. Publishing stops at the first post
+    that is not due yet or fails again, unless it is given up. A failed post
+    is tried again after "outbox_retry_delay" seconds, doubling with every
+    failure up to "outbox_max_delay". After "outbox_max_attempts" failures,
+    it is given up. So is a post the server will never accept, e.g. because
+    of invalid media, see is_permanent_error(). Nothing is published in a
+    dry-run.
+
+    Returns the results of the posts that have been tried, see
+    action_result(). Posts that failed again are "queued" with the error."""
+    if commandline_arguments["dry_run"]:
+        return []
+    group_config = group["config"]
+    outbox = group["outbox"]
+    results = []
+    for post in tootgroup_tools.outbox.queued_posts(outbox):
+        if post["next_attempt"] > time.time():
+            break
+        action = {"notification_id": post["notification_id"], "type": "post"}
+        started = time.perf_counter()
+        try:
+            publish_queued_post(group, post)
+        except Exception as ex:
+            seconds = time.perf_counter() - started
+            if is_permanent_error(ex) or post["attempts"] + 1 >= group_config.getint(
+                "outbox_max_attempts",
+                fallback=tootgroup_tools.outbox.DEFAULT_MAX_ATTEMPTS,
+            ):
+                tootgroup_tools.outbox.remove_post(outbox, post)
+                print("")
+                print(
+                    "\n##################################################################"
+                )
+                print(
+                    "Giving up post from DM with notification ID: "
+                    + post["notification_id"]
+                    + " after "
+                    + str(post["attempts"] + 1)
+                    + " attempts:"
+                )
+                print(ex)
+                print(
+                    "##################################################################\n"
+                )
+                results.append(action_result(action, "given up", ex, seconds))
+            else:
+                delay = tootgroup_tools.outbox.postpone(
+                    outbox,
+                    post,
+                    ex,
+                    group_config.getfloat(
+                        "outbox_retry_delay",
+                        fallback=tootgroup_tools.outbox.DEFAULT_RETRY_DELAY,
+                    ),
+                    group_config.getfloat(
+                        "outbox_max_delay",
+                        fallback=tootgroup_tools.outbox.DEFAULT_MAX_DELAY,
+                    ),
+                )
+                print(
+                    "Cannot post from DM with notification ID: "
+                    + post["notification_id"]
+                    + " from the outbox, retrying in "
+                    + str(int(delay))
+                    + " s: "
+                    + str(ex)
+                )
+                results.append(action_result(action, "queued", ex, seconds))
+            if is_unauthorized(ex):
+                raise
+            if results[-1]["status"] == "given up":
+                # Nothing to wait for, go on with the next post
+                continue
+            break
+        tootgroup_tools.outbox.remove_post(outbox, post)
+        results.append(
+            action_result(action, "done", seconds=time.perf_counter() - started)
+        )
+        print(
+            "Newly posted from the outbox with notification ID: "
+            + post["notification_id"]
+        )
+    return results
+
+
+@tootgroup_tools.phase_profiler.timed("actions")
+def publish_queued_post(group, post):
+    """Publish a post from the group's outbox.
+
+    "group" dictionary as returned by connect_group()
+
+    "post" dictionary as returned by tootgroup_tools.outbox.queued_posts()
+
+    Uploads made for the post earlier are used again while the server still
+    accepts them. Otherwise its media files are uploaded again, from the
+    outbox if they are kept there. New uploads are remembered in the outbox
+    instead of the media cache before the post is published."""
+    media_settings = get_media_settings(group["config"])
+    if (
+        post["uploads"] is not None
+        and time.time() - post["uploaded"] <= media_settings["upload_window"]
+    ):
+        new_media = [{"id": media_id} for media_id in post["uploads"]]
+    else:
+        with tootgroup_tools.phase_profiler.phase("media transfer"):
+            new_media = media_toot_again(
+                post["media"],
+                group["masto"],
+                media_settings,
+                get_media_cache(group, media_settings),
+                group["name"],
+            )
+        tootgroup_tools.outbox.keep_uploads(
+            group["outbox"], post, [media["id"] for media in new_media]
+        )
+        forget_action_media(group, new_media)
+    group["masto"].status_post(
+        post["status"],
+        media_ids=new_media,
+        sensitive=post["sensitive"],
+        visibility=post["visibility"],
+        spoiler_text=post["spoiler_text"],
+    )
+    forget_action_media(group, new_media)
+
+
+def record_processed(group, notification_id, commandline_arguments, advance=True):
+    """Remember that a notification has been taken care of.
+
+    "group" dictionary as returned by connect_group()
+
+    "notification_id" ID of the notification
+
+    "commandline_arguments" dictionary as returned by parse_arguments()
+
+    "advance" if True, the notification also becomes the group's
+    "last_seen_id". Only use this if all earlier notifications are done.
+
+    The notification is written to the state store with the next batch of
+    "state_commit_batch" notifications. Nothing is written in a dry-run."""
+    if advance:
+        group["last_seen_id"] = str(notification_id)
+    if commandline_arguments["dry_run"]:
+        return
+    if advance:
+        tootgroup_tools.state_store.set_last_seen_id(
+            group["state_store"], group["name"], notification_id
+        )
+    tootgroup_tools.state_store.mark_processed(
+        group["state_store"],
+        group["name"],
+        notification_id,
+        group["config"].getint(
+            "state_commit_batch",
+            fallback=tootgroup_tools.state_store.DEFAULT_COMMIT_BATCH,
+        ),
+    )
+
+
+def save_progress(group, commandline_arguments):
+    """Write a group's "last_seen_id" and everything recorded by
+    record_processed() to the state store.
+
+    "group" dictionary as returned by connect_group()
+
+    "commandline_arguments" dictionary as returned by parse_arguments()
+
+    Nothing is written in a dry-run."""
+    if commandline_arguments["dry_run"] or group["last_seen_id"] == "catch-up":
+        return
+    tootgroup_tools.state_store.set_last_seen_id(
+        group["state_store"], group["name"], group["last_seen_id"]
+    )
+    tootgroup_tools.state_store.commit(group["state_store"])
+
+
+def find_processed(group, notifications):
+    """Return the IDs of notifications that have been processed already.
+
+    "group" dictionary as returned by connect_group()
+
+    "notifications" newly fetched notifications
+
+    A run that has been interrupted may have handled notifications after
+    its last "last_seen_id". They are fetched again but must not be
+    reposted twice. The IDs are returned as strings."""
+    return tootgroup_tools.state_store.processed_ids(
+        group["state_store"],
+        group["name"],
+        [notification.id for notification in notifications],
+    )
+
+
+def process_notifications_async(group, commandline_arguments):
+    """Fetch new notifications for a connected group and repost them concurrently.
+
+    "group" dictionary as returned by connect_group()
+
+    "commandline_arguments" dictionary as returned by parse_arguments()
+
+    This does the same as process_notifications() but lets an asyncio event
+    loop hand all requests to the Fediverse server to a pool of worker
+    threads as soon as they do not depend on each other any more:
+
+    - an outdated member list is fetched together with the first page of
+      notifications
+    - the next page is fetched while the current one is being classified
+    - media files of new posts are transferred while earlier ones are still
+      being published, and retoots and replies are sent right away
+
+    Like with dispatch_actions(), new posts are still published one after
+    the other in the order of their notifications. The size of the worker
+    pool can be set with "async_workers" in the group's configuration.
+
+    Returns the number of new notifications that have been found."""
+    import asyncio
+
+    return asyncio.run(run_notification_engine(group, commandline_arguments))
+
+
+async def run_notification_engine(group, commandline_arguments):
+    """The coroutine doing the work of process_notifications_async()"""
+    import asyncio
+
+    masto = group["masto"]
+    group_config = group["config"]
+    config_store = group["config_store"]
+    member_cache = group["member_cache"]
+    page_size = group_config.getint(
+        "notification_page_size", fallback=NOTIFICATION_PAGE_SIZE
+    )
+    max_notifications = group_config.getint(
+        "max_notifications", fallback=MAX_NOTIFICATIONS
+    )
+    members_expired = tootgroup_tools.member_cache.is_expired(
+        member_cache,
+        group_config.getfloat(
+            "member_cache_ttl", fallback=tootgroup_tools.member_cache.DEFAULT_TTL
+        ),
+    )
+
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, group_config.getint("async_workers", fallback=ASYNC_WORKERS))
+    )
+    try:
+        # Catching up is a single request, nothing to be gained here.
+        if group["last_seen_id"] == "catch-up":
+            return len(
+                await loop.run_in_executor(executor, fetch_new_notifications, group)
+            )
+
+        # The member list and the first page do not depend on each other.
+        if members_expired:
+            member_refresh = loop.run_in_executor(
+                executor,
+                tootgroup_tools.member_cache.refresh_members,
+                masto,
+                group["account"]["id"],
+                member_cache,
+            )
+        page_request = loop.run_in_executor(
+            executor,
+            fetch_notification_page,
+            masto,
+            group["last_seen_id"],
+            min(page_size, max_notifications),
+            group["name"],
+        )
+        if members_expired:
+            await member_refresh
+        members_changed = members_expired
+
+        my_notifications = []
+        new_count = 0
+        published = None
+        tasks = []
+        try:
+            while page_request is not None:
+                new_notifications, more_pages = await page_request
+                new_notifications, count = take_new_notifications(
+                    group, new_notifications, max_notifications - new_count
+                )
+                my_notifications.extend(new_notifications)
+                new_count += count
+
+                # Prefetch the next page before working on the current one
+                page_request = None
+                if more_pages and new_count < max_notifications:
+                    page_request = loop.run_in_executor(
+                        executor,
+                        fetch_notification_page,
+                        masto,
+                        new_notifications[-1].id,
+                        min(page_size, max_notifications - new_count),
+                        group["name"],
+                    )
+
+                # Only group members may post to the group. Unknown senders on
+                # this page have to be looked up before classifying it.
+                if not members_expired:
+                    sender_ids = [
+                        notification.account.id
+                        for notification in new_notifications
+                        if notification.type in ("mention", "follow")
+                    ]
+                    if await loop.run_in_executor(
+                        executor,
+                        tootgroup_tools.member_cache.add_new_members,
+                        masto,
+                        member_cache,
+                        sender_ids,
+                    ):
+                        members_changed = True
+
+                processed = find_processed(group, new_notifications)
+                for notification in new_notifications:
+                    if str(notification.id) in processed:
+                        continue
+                    action = classify_notification(group, notification)
+                    if action is None:
+                        continue
+                    if action["type"] != "post":
+                        # Retoots and replies do not depend on each other.
+                        task = loop.run_in_executor(
+                            executor,
+                            run_action,
+                            group,
+                            action,
+                            commandline_arguments,
+                        )
+                    else:
+                        media_upload = None
+                        if not commandline_arguments["dry_run"]:
+                            media_upload = loop.run_in_executor(
+                                executor, upload_action_media, group, action
+                            )
+                        task = asyncio.ensure_future(
+                            publish_action(
+                                executor,
+                                group,
+                                action,
+                                commandline_arguments,
+                                published,
+                                media_upload,
+                            )
+                        )
+                        published = task
+                    tasks.append(task)
+        finally:
+            # Let actions that are already underway finish. Only notifications
+            # up to the first failed one are marked as seen.
+            finish_actions(
+                group,
+                [notification.id for notification in my_notifications],
+                await asyncio.gather(*tasks),
+                commandline_arguments,
+            )
+            if members_changed:
+                tootgroup_tools.member_cache.save_member_cache(
+                    config_store, group["name"], member_cache
+                )
+
+        return len(my_notifications)
+    finally:
+        executor.shutdown(wait=True)
+
+
+async def publish_action(
+    executor, group, action, commandline_arguments, previous, media_upload
+):
+    """Publish a new post right after the previous one.
+
+    "executor" worker pool the API requests are sent from
+
+    "group", "action", "commandline_arguments" see execute_action()
+
+    "previous" task publishing the preceeding post, or None
+
+    "media_upload" future of the post's media upload, or None
+
+    If the previous post has been queued in the outbox, this one is queued
+    behind it. If the previous post could not be queued either, this one
+    is skipped, so nothing is published out of order.
+
+    Returns the post's result, see action_result()."""
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    previous_result = None
+    if previous is not None:
+        previous_result = await previous
+    new_media = None
+    error = None
+    if media_upload is not None:
+        try:
+            new_media = await media_upload
+        except Exception as ex:
+            error = ex
+    if previous_result is not None and previous_result["status"] in (
+        "failed",
+        "skipped",
+    ):
+        return skip_post(group, action, new_media)
+    return await loop.run_in_executor(
+        executor, run_action, group, action, commandline_arguments, new_media, error
+    )
+
+
+def fetch_new_notifications(group):
+    """Get all notifications that arrived since the last run.
+
+    "group" dictionary as returned by connect_group()
+
+    The server is asked only for notification types tootgroup.py acts upon.
+    Starting at "last_seen_id", notifications are paged through from oldest to
+    newest. "notification_page_size" and "max_notifications" from the group's
+    configuration limit the size of a single page and the number of
+    notifications processed in one run. Notifications that have been
+    processed already do not count, see take_new_notifications(). Anything
+    beyond that is left for the next run. "last_seen_id" is only changed
+    when catching up, otherwise it is up to the caller to advance it while
+    processing the notifications.
+
+    Returns the new notifications, oldest first."""
+    masto = group["masto"]
+    max_notifications = group["config"].getint(
+        "max_notifications", fallback=MAX_NOTIFICATIONS
+    )
+
+    # Initialize "last_seen_id" on first run. Notifications are ignored up
+    # to this point, but newer ones will be considered subsequently.
+    if group["last_seen_id"] == "catch-up":
+        with tootgroup_tools.phase_profiler.phase("notification fetch"):
+            latest_notifications = masto.notifications(
+                types=NOTIFICATION_TYPES,
+                exclude_types=EXCLUDED_NOTIFICATION_TYPES,
+                limit=1,
+            )
+        if len(latest_notifications) > 0:
+            group["last_seen_id"] = str(latest_notifications[0].id)
+            print("Caught up to current timeline. Run again to start group-tooting.")
+        else:  # If there have not been any notifications yet, set value to "0"
+            group["last_seen_id"] = "0"
+            print("Nothing to do yet! Start interacting with your group account first.")
+        return []
+
+    my_notifications = []
+    for new_notifications in iter_notification_pages(group, max_notifications):
+        my_notifications.extend(new_notifications)
+    return my_notifications
+
+
+def iter_notification_pages(group, max_notifications=None):
+    """Get the pages of notifications that arrived since "last_seen_id".
+
+    "group" dictionary as returned by connect_group()
+
+    "max_notifications" stop after this many notifications that have not
+    been processed yet, see take_new_notifications(). Without it, paging
+    goes on until there are no new notifications left.
+
+    Pages are fetched one by one while they are being iterated. Page size
+    is limited to 40 by default in Mastodon but this can be configured at
+    any specific server instance and with "notification_page_size".
+
+    Yields the pages as lists of notifications, oldest first."""
+    page_size = group["config"].getint(
+        "notification_page_size", fallback=NOTIFICATION_PAGE_SIZE
+    )
+    min_notification_id = group["last_seen_id"]
+    fetched = 0
+    while max_notifications is None or fetched < max_notifications:
+        limit = page_size
+        if max_notifications is not None:
+            limit = min(page_size, max_notifications - fetched)
+        new_notifications, more_pages = fetch_notification_page(
+            group["masto"], min_notification_id, limit, group["name"]
+        )
+        count = len(new_notifications)
+        if max_notifications is not None:
+            new_notifications, count = take_new_notifications(
+                group, new_notifications, max_notifications - fetched
+            )
+        if len(new_notifications) > 0:
+            fetched += count
+            yield new_notifications
+        if not more_pages:
+            break
+        min_notification_id = new_notifications[-1].id
+
+
+def take_new_notifications(group, notifications, limit):
+    """Limit a page of notifications to the ones a pass can handle.
+
+    "group" dictionary as returned by connect_group()
+
+    "notifications" a page of notifications, oldest first
+
+    "limit" number of notifications that have not been processed yet
+
+    While an action is retried, "last_seen_id" stays before its
+    notification and everything after it is fetched again. Notifications
+    that are done already do not count towards the limit. Otherwise, they
+    would fill up "max_notifications" and no new ones would be fetched.
+
+    Returns the notifications to handle and how many of them are new."""
+    processed = find_processed(group, notifications)
+    taken = []
+    count = 0
+    for notification in notifications:
+        if count >= limit:
+            break
+        taken.append(notification)
+        if str(notification.id) not in processed:
+            count += 1
+    return taken, count
 
-import tootgroup_tools
 
-TOOTGROUP_VERSION = "1.5"
+@tootgroup_tools.phase_profiler.timed("notification fetch")
+def fetch_notification_page(masto, min_notification_id, limit, group_name=None):
+    """Get one page of notifications newer than the given ID.
 
+    "masto" connected Mastodon API instance of the group
 
-def main():
-    """Execution starts here"""
+    "min_notification_id" only notifications after this one are returned
 
-    # Read commandline arguments and flags from input
-    commandline_arguments = tootgroup_tools.commandline_arguments.parse_arguments()
+    "limit" maximum number of notifications on the page
 
-    # if the "--version" argument has been given, show version and exit.
-    if commandline_arguments["show_version"]:
-        print(TOOTGROUP_VERSION)
-        sys.exit(0)
+    "group_name" if given, the time the notifications have been fetched is
+    noted for the group's repost latencies, see repost_latency
 
-    # Get the configuration storage location
-    config_store = tootgroup_tools.configuration_management.setup_configuration_store()
+    Returns the new notifications, oldest first, and whether there might be
+    more pages to fetch after this one."""
+    get_notifications = masto.notifications(
+        min_id=min_notification_id,
+        limit=limit,
+        types=NOTIFICATION_TYPES,
+        exclude_types=EXCLUDED_NOTIFICATION_TYPES,
+    )
 
-    # Get the handle for the account the script has been invoked with.
-    config_store["group_name"] = commandline_arguments["group_name"]
-    group_name = config_store["group_name"]
+    # Pages are returned newest first. Sort them the other way round and
+    # make sure nothing old slips through on servers ignoring "min_id".
+    new_notifications = [
+        notification
+        for notification in reversed(get_notifications)
+        if tootgroup_tools.compare_ids(notification.id, min_notification_id)
+    ]
 
-    # Get and validate configuration from the config file.
-    my_config = tootgroup_tools.configuration_management.parse_configuration(
-        config_store
+    if group_name is not None:
+        tootgroup_tools.repost_latency.record_fetch(group_name, new_notifications)
+
+    # A page that is not full is the last one
+    more_pages = len(new_notifications) > 0 and len(get_notifications) >= limit
+    return new_notifications, more_pages
+
+
+def update_group_members(group, notifications):
+    """Keep the cached list of group members up to date.
+
+    "group" dictionary as returned by connect_group()
+
+    "notifications" newly received notifications
+
+    Group members are all accounts the group account is following. The whole
+    list is only fetched from the server once the member cache has expired.
+    Otherwise just the unknown senders of new mentions and follows are looked
+    up. Changes are written to the member cache file right away."""
+    member_cache = group["member_cache"]
+    ttl = group["config"].getfloat(
+        "member_cache_ttl", fallback=tootgroup_tools.member_cache.DEFAULT_TTL
     )
 
-    # If the "catch-up" commandline argument has been given, reset the last seen
-    # ID so that tootgroup.py only updates its according config value without
-    # retooting anything.
-    if commandline_arguments["catch_up"]:
-        my_config[group_name]["last_seen_id"] = "catch-up"
+    if tootgroup_tools.member_cache.is_expired(member_cache, ttl):
+        tootgroup_tools.member_cache.refresh_members(
+            group["masto"], group["account"]["id"], member_cache
+        )
+    elif not tootgroup_tools.member_cache.add_new_members(
+        group["masto"],
+        member_cache,
+        [
+            notification.account.id
+            for notification in notifications
+            if notification.type in ("mention", "follow")
+        ],
+    ):
+        return
 
-    # Create Mastodon API instance.
-    masto = mastodon.Mastodon(
-        client_id=config_store["directory"] + my_config[group_name]["client_id"],
-        access_token=config_store["directory"] + my_config[group_name]["access_token"],
-        api_base_url=my_config[group_name]["mastodon_instance"],
-        version_check_mode="none",
+    tootgroup_tools.member_cache.save_member_cache(
+        group["config_store"], group["name"], member_cache
     )
 
-    try:
-        # Get the group account information.
-        # This connects to the Fediverse server for the first time at
-        # every tootgroup.py's invocation.
-        my_account = {
-            "username": masto.account_verify_credentials().username,
-            "id": masto.account_verify_credentials().id,
-            "group_member_ids": [],
+
+def handle_notification(group, notification, commandline_arguments):
+    """Retoot or repost a single notification if it qualifies.
+
+    "group" dictionary as returned by connect_group()
+
+    "notification" the notification as returned by the Fediverse server
+
+    "commandline_arguments" dictionary as returned by parse_arguments()
+
+    The notification is recorded as processed unless its action fails and
+    cannot be queued in the outbox. That action's error is raised then, see
+    run_action(). The group's "last_seen_id" is not moved forward."""
+    action = classify_notification(group, notification)
+    if action is None:
+        record_processed(group, notification.id, commandline_arguments, advance=False)
+        return
+    result = run_action(group, action, commandline_arguments)
+    if result["status"] == "failed":
+        raise result["error"]
+
+
+@tootgroup_tools.phase_profiler.timed("classification")
+def classify_notification(group, notification):
+    """Decide what has to be done with a notification.
+
+    "group" dictionary as returned by connect_group()
+
+    "notification" the notification as returned by the Fediverse server
+
+    Only notifications of group members are considered. Whether public
+    mentions are retooted and/or direct messages reposted depends on the
+    group's configuration.
+
+    Returns the planned action as a dictionary or None if there is nothing
+    to do. Its "type" is either "reblog", "post" or "reply". Nothing is sent
+    to the server here, see execute_action() for that."""
+    my_account = group["account"]
+    group_config = group["config"]
+
+    # Do we accept direct messages, public retoots, both or none? This
+    # can be set in the configuration.
+    accept_direct_messages = group_config.getboolean("accept_DMs")
+    accept_retoots = group_config.getboolean("accept_retoots")
+    dm_visibility = group_config["dm_visibility"]
+
+    # Only from group members
+    if str(notification.account.id) not in group["member_cache"]["member_ids"]:
+        return None
+    if notification.type != "mention":
+        return None
+
+    # Is retooting of public mentions configured?
+    if accept_retoots and notification.status.visibility == "public":
+        # Only if the mention was preceeded by either a "!" or a "*".
+        # To check for this, html tags have to be removed first.
+        repost_triggers = []
+        repost_triggers.append("!@" + my_account["username"])
+        repost_triggers.append("*@" + my_account["username"])
+        status = tootgroup_tools.status_content.to_plain_text(
+            notification.status.content
+        )
+        if any(trigger in status for trigger in repost_triggers):
+            return {
+                "type": "reblog",
+                "notification_id": notification.id,
+                "status_id": notification.status.id,
+            }
+
+    # Is reposting of direct messages configured? - if yes then:
+    # Look for direct messages
+    if accept_direct_messages and notification.status.visibility == "direct":
+        # Remove HTML tags from the status content but keep linebreaks. The
+        # group account's @username is removed from the beginning of the text.
+        new_status = tootgroup_tools.status_content.strip_leading_mention(
+            notification.status.content, my_account["username"]
+        )
+
+        # Only continue if the DM starts with the group account's @username
+        if new_status is not None:
+            spoiler_text = notification.status.spoiler_text
+            # DMs from friendica always have a title that is used as spoiler_text.
+            # Remove it if it does not make sense.
+            if spoiler_text == "[no subject]":
+                spoiler_text = ""
+            return {
+                "type": "post",
+                "notification_id": notification.id,
+                "status": new_status,
+                "media_attachments": notification.status.media_attachments,
+                "sensitive": notification.status.sensitive,
+                "visibility": dm_visibility,
+                "spoiler_text": spoiler_text,
+            }
+
+        # If the DM does not start with the group account's @username it will not
+        # trigger a new toot. Notify the originating user why this happened instead!
+        new_status = (
+            "@" + notification.account.acct + "\n"
+            "Ohai! - This is a notification from your friendly tootgroup.py bot.\n\n"
+            "Your message has not been converted to a new group toot because it did "
+            "not start with @" + my_account["username"] + "\n\n"
+            "Remember to put @" + my_account["username"] + " at the very beginning if "
+            "you want to create a new group toot."
+        )
+        return {
+            "type": "reply",
+            "notification_id": notification.id,
+            "status": new_status,
+            "in_reply_to_id": notification.status.id,
         }
+
+    return None
+
+
+@tootgroup_tools.phase_profiler.timed("actions")
+def execute_action(group, action, commandline_arguments, new_media=None):
+    """Send a planned action to the server.
+
+    "group" dictionary as returned by connect_group()
+
+    "action" dictionary as returned by classify_notification()
+
+    "commandline_arguments" dictionary as returned by parse_arguments()
+
+    "new_media" media attachments of a "post" as returned by
+    upload_action_media(). They are uploaded right here if not given.
+
+    In a dry-run, only the action that would have been taken is shown."""
+    masto = group["masto"]
+    my_account = group["account"]
+    notification_id = str(action["notification_id"])
+
+    if action["type"] == "reblog":
+        if not commandline_arguments["dry_run"]:
+            masto.status_reblog(action["status_id"])
+            message = "Retooted from notification ID: " + notification_id
+        else:
+            message = "DRY RUN - would have retooted from notification ID: "
+            message += notification_id
+
+    elif action["type"] == "post":
+        if not commandline_arguments["dry_run"]:
+            # Repost as a new status
+            if new_media is None:
+                new_media = upload_action_media(group, action)
+            try:
+                masto.status_post(
+                    action["status"],
+                    media_ids=new_media,
+                    sensitive=action["sensitive"],
+                    visibility=action["visibility"],
+                    spoiler_text=action["spoiler_text"],
+                )
+            except Exception:
+                # The uploads can be used again when retrying
+                release_action_media(group, new_media)
+                raise
+            forget_action_media(group, new_media)
+            message = "Newly posted from DM with notification ID: " + notification_id
+        else:
+            message = "DRY RUN - would have newly posted from DM with notification ID: "
+            message += notification_id
+
+    elif action["type"] == "reply":
+        if not commandline_arguments["dry_run"]:
+            masto.status_post(
+                action["status"],
+                in_reply_to_id=action["in_reply_to_id"],
+                visibility="direct",
+            )
+            message = (
+                "Not posted from DM with notification ID: "
+                + notification_id
+                + ". It did not start with @"
+                + my_account["username"]
+                + "!"
+            )
+        else:
+            message = (
+                "DRY RUN - received DM with notification ID: "
+                + notification_id
+                + ", but it did not begin with @"
+                + my_account["username"]
+                + "!"
+            )
+
+    # Actions are executed by several threads. Keep their output lines apart.
+    with OUTPUT_LOCK:
+        print(message)
+
+
+@tootgroup_tools.phase_profiler.timed("media transfer")
+def upload_action_media(group, action):
+    """Upload the media attachments of a planned "post" action again.
+
+    "group" dictionary as returned by connect_group()
+
+    "action" dictionary as returned by classify_notification()
+
+    The media files are kept in the group's outbox directory meanwhile, in
+    case the post has to be queued there, see queue_post().
+
+    Returns the list of uploaded media that can be attached to the post."""
+    media_settings = get_media_settings(group["config"])
+    return media_toot_again(
+        action["media_attachments"],
+        group["masto"],
+        media_settings,
+        get_media_cache(group, media_settings),
+        group["name"],
+        [
+            tootgroup_tools.outbox.media_file_name(
+                group["outbox"], action["notification_id"], i
+            )
+            for i in range(len(action["media_attachments"]))
+        ],
+    )
+
+
+def run_stream(group, commandline_arguments):
+    """Process a group's notifications as they are streamed by the server.
+
+    "group" dictionary as returned by connect_group()
+
+    "commandline_arguments" dictionary as returned by parse_arguments()
+
+    Every streamed notification is handled right away, exactly like it would
+    have been by a regular run. Whenever the streaming connection is (re)opened,
+    one regular polling run catches up with anything that has been missed."""
+
+    def catch_up():
+        process_notifications(group, commandline_arguments)
+        write_metrics(commandline_arguments)
+
+    def on_notification(notification):
+        process_single_notification(group, notification, commandline_arguments)
+
+    try:
+        tootgroup_tools.streaming.listen(group["masto"], on_notification, catch_up)
+    except KeyboardInterrupt:
+        print("\ntootgroup.py streaming stopped.")
+
+
+def run_push(group, commandline_arguments):
+    """Process a group's notifications as they are pushed by the server.
+
+    "group" dictionary as returned by connect_group()
+
+    "commandline_arguments" dictionary as returned by parse_arguments()
+
+    A Web Push subscription is registered for the group account and every
+    pushed notification is handled right away. A regular polling run
+    catches up with anything that has not been pushed, when starting and
+    every "push_poll_interval" seconds. See tootgroup_tools.web_push."""
+    group_config = group["config"]
+    if not group_config.get("push_url"):
+        print("")
+        print("\n##################################################################")
+        print("Web Push needs the URL under which the Fediverse server can reach")
+        print('tootgroup.py. Set it as "push_url" in the group\'s configuration.')
+        print("##################################################################\n")
+        return
+
+    def catch_up():
+        process_notifications(group, commandline_arguments)
+        write_metrics(commandline_arguments)
+
+    def on_notification(notification):
+        process_single_notification(group, notification, commandline_arguments)
+
+    try:
+        tootgroup_tools.web_push.listen(
+            group["masto"],
+            group_config["push_url"],
+            on_notification,
+            catch_up,
+            group_config.get(
+                "push_listen", fallback=tootgroup_tools.web_push.DEFAULT_LISTEN_ADDRESS
+            ),
+            group_config.getfloat(
+                "push_poll_interval",
+                fallback=tootgroup_tools.web_push.DEFAULT_POLL_INTERVAL,
+            ),
+        )
+    except KeyboardInterrupt:
+        print("\ntootgroup.py Web Push receiver stopped.")
+    except (ImportError, NotImplementedError) as ex:
+        # Mastodon.py raises NotImplementedError without its crypto extras.
+        print("")
+        print("\n##################################################################")
+        print("tootgroup.py cannot receive Web Push messages:")
+        print(ex)
+        print("")
+        print('Decrypting them needs "pip install Mastodon.py[webpush]".')
+        print("##################################################################\n")
+        sys.exit(1)
+    except tootgroup_tools.web_push.SubscriptionError as ex:
+        print("")
+        print("\n##################################################################")
+        print("The Fediverse server does not accept the Web Push subscription:")
+        print(ex)
+        print("")
+        print('The group\'s access token needs the "push" scope, delete its')
+        print("credential files and run tootgroup.py again to get a new one.")
+        print("##################################################################\n")
+        sys.exit(1)
     except Exception as ex:
         print("")
-        print("\n########################################################")
-        print("tootgroup.py could not connect to the Fediverse server")
-        print("instance. If you know that it is running, there might be a")
-        print("problem with your local configuration. Check the error")
-        print("message for more details:")
+        print("\n##################################################################")
+        print("tootgroup.py cannot receive Web Push messages:")
         print(ex)
-        print("\nYou can always try to delete tootgroup.py's config file")
-        print("and re-run the script for a new setup.")
-        print("########################################################\n")
-        sys.exit(0)
+        print("##################################################################\n")
+        sys.exit(1)
 
-    # Get group member IDs. They can not be fetched directly when
-    # connecting to the Fediverse server.
-    #
-    # limit=sys.maxsize is set here because Pleroma only returns 20 Member if
-    # the standard limit=None value is used!
-    for member in masto.account_following(my_account["id"], limit=sys.maxsize):
-        my_account["group_member_ids"].append(member.id)
 
-    # Do we accept direct messages, public retoots, both or none? This
-    # can be set in the configuration.
-    accept_direct_messages = my_config[group_name].getboolean("accept_DMs")
-    accept_retoots = my_config[group_name].getboolean("accept_retoots")
-    dm_visibility = my_config[group_name]["dm_visibility"]
-
-    # Get all new notifications up to a maximum number set here.
-    # Defaults to 100 and has to be changed in the code if really desired.
-    # Use the ID of the last seen notification for deciding what is new.
-    notification_count = 0
-    max_notifications = 100
-    max_notification_id = None
-    latest_notification_id = 0
-    my_notifications = []
-    get_more_notifications = True
-
-    # Get notifications. Stop if either the last known notification ID or
-    # the maximum number is reached. Chunk size is limited to 40 by default
-    # in Mastodon but this can be configured at any specific server instance.
-    while get_more_notifications:
-        get_notifications = masto.notifications(max_id=max_notification_id)
-
-        # Remember the ID of the latest notification on first iteration
-        if notification_count == 0:
-            if len(get_notifications) > 0:
-                latest_notification_id = get_notifications[0].id
-            else:  # If there have not been any notifications yet, set value to "0"
-                latest_notification_id = 0
-                print(
-                    "Nothing to do yet! Start interacting with your group account first."
-                )
-                get_more_notifications = False
-        else:  # leave the while loop if there are no more notifications fetched
-            if len(get_notifications) == 0:
-                get_more_notifications = False
-
-        # Initialize "last_seen_id" on first run. Notifications are ignored up
-        # to this point, but newer ones will be considered subsequently.
-        if my_config[group_name]["last_seen_id"] == "catch-up":
-            my_config[group_name]["last_seen_id"] = str(latest_notification_id)
-            config_store["write_NEW"] = True
-            print("Caught up to current timeline. Run again to start group-tooting.")
+def process_single_notification(group, notification, commandline_arguments):
+    """Handle a notification the server has sent on its own.
 
-        for notification in get_notifications:
-            max_notification_id = notification.id
+    "group" dictionary as returned by connect_group()
 
-            if (
-                tootgroup_tools.compare_ids(
-                    notification.id, my_config[group_name]["last_seen_id"]
-                )
-                and notification_count < max_notifications
-            ):
-                my_notifications.append(notification)
-            else:
-                get_more_notifications = False
-                break
+    "notification" the notification as streamed or pushed by the server
 
-            notification_count += 1
+    "commandline_arguments" dictionary as returned by parse_arguments()
 
-    # If there have been new notifications since the last run, update "last_seen_id"
-    # and write config file to persist the new value.
-    if tootgroup_tools.compare_ids(
-        latest_notification_id, my_config[group_name]["last_seen_id"]
-    ):
-        my_config[group_name]["last_seen_id"] = str(latest_notification_id)
-        config_store["write_NEW"] = True
-
-    # Reverse list of notifications so that the oldest are processed first
-    my_notifications = my_notifications[::-1]
-
-    # run through the notifications and look for retoot candidates
-    for notification in my_notifications:
-
-        # Only from group members
-        if notification.account.id in my_account["group_member_ids"]:
-
-            # Is retooting of public mentions configured?
-            if accept_retoots:
-                if (
-                    notification.type == "mention"
-                    and notification.status.visibility == "public"
-                ):
-                    # Only if the mention was preceeded by either a "!" or a "*".
-                    # To check for this, html tags have to be removed first.
-                    repost_triggers = []
-                    repost_triggers.append("!@" + my_account["username"])
-                    repost_triggers.append("*@" + my_account["username"])
-                    status = re.sub("<.*?>", "", notification.status.content)
-                    if any(trigger in status for trigger in repost_triggers):
-                        if not commandline_arguments["dry_run"]:
-                            masto.status_reblog(notification.status.id)
-                            print(
-                                "Retooted from notification ID: " + str(notification.id)
-                            )
-                        else:
-                            print(
-                                "DRY RUN - would have retooted from notification ID: "
-                                + str(notification.id)
-                            )
+    Notifications that have been handled already are skipped. The progress
+    is saved right away.
 
-            # Is reposting of direct messages configured? - if yes then:
-            # Look for direct messages
-            if accept_direct_messages:
-                if (
-                    notification.type == "mention"
-                    and notification.status.visibility == "direct"
-                ):
-                    # Remove HTML tags from the status content but keep linebreaks
-                    new_status = re.sub("<br />", "\n", notification.status.content)
-                    new_status = re.sub("</p><p>", "\n\n", new_status)
-                    new_status = re.sub("<.*?>", "", new_status)
-                    # Get the group account's @username
-                    account_username = "@" + my_account["username"]
-
-                    # Only continue if the DM starts with the group account's @username
-                    if new_status.startswith(account_username):
-                        # Remove the group account's @username from the text
-                        new_status = re.sub(account_username, "", new_status)
-                        # "un-escape" HTML special characters
-                        new_status = html.unescape(new_status)
-                        if not commandline_arguments["dry_run"]:
-                            # Repost as a new status
-                            spoiler_text = notification.status.spoiler_text
-                            # DMs from friendica always have a title that is used as spoiler_text.
-                            # Remove it if it does not make sense.
-                            if spoiler_text == "[no subject]":
-                                spoiler_text = ""
-                            masto.status_post(
-                                new_status,
-                                media_ids=media_toot_again(
-                                    notification.status.media_attachments, masto
-                                ),
-                                sensitive=notification.status.sensitive,
-                                visibility=dm_visibility,
-                                spoiler_text=spoiler_text,
-                            )
-                            print(
-                                "Newly posted from DM with notification ID: "
-                                + str(notification.id)
-                            )
-                        else:
-                            print(
-                                "DRY RUN - would have newly posted from DM with notification ID: "
-                                + str(notification.id)
-                            )
+    Notifications may arrive in any order, and handling one of them may
+    fail. Each one is therefore only recorded in the processed set. Moving
+    the group's "last_seen_id" forward is left to the catching up runs,
+    which fetch everything after it and retry what has failed."""
+    # Everything up to "last_seen_id" has been taken care of. Only catching
+    # up moves it forward, and never past an open notification.
+    if not tootgroup_tools.compare_ids(notification.id, group["last_seen_id"]):
+        return
+    tootgroup_tools.repost_latency.record_fetch(group["name"], [notification])
+    try:
+        publish_outbox(group, commandline_arguments)
+        update_group_members(group, [notification])
+        if str(notification.id) not in find_processed(group, [notification]):
+            handle_notification(group, notification, commandline_arguments)
+        save_progress(group, commandline_arguments)
+    finally:
+        tootgroup_tools.repost_latency.finish_pass(group["name"])
+    write_metrics(commandline_arguments)
 
-                    # If the DM does not start with the group account's @username it will not
-                    # trigger a new toot. Notify the originating user why this happened instead!
-                    else:
-                        if not commandline_arguments["dry_run"]:
-                            new_status = (
-                                "@" + notification.account.acct + "\n"
-                                "Ohai! - This is a notification from your friendly tootgroup.py bot.\n\n"
-                                "Your message has not been converted to a new group toot because it did "
-                                "not start with @" + my_account["username"] + "\n\n"
-                                "Remember to put @"
-                                + my_account["username"]
-                                + " at the very beginning if "
-                                "you want to create a new group toot."
-                            )
-                            masto.status_post(
-                                new_status,
-                                in_reply_to_id=notification.status.id,
-                                visibility="direct",
-                            )
-                            print(
-                                "Not posted from DM with notification ID: "
-                                + str(notification.id),
-                                end="",
-                            )
-                            print(
-                                ". It did not start with @"
-                                + my_account["username"]
-                                + "!"
-                            )
-                        else:
-                            print(
-                                "DRY RUN - received DM with notification ID: "
-                                + str(notification.id)
-                                + ", but it did not begin with @"
-                                + my_account["username"]
-                                + "!"
-                            )
 
-    # There have been changes requiring to persist the new configuration
-    # but not in a dry-run condition
-    if config_store["write_NEW"] and not commandline_arguments["dry_run"]:
-        tootgroup_tools.configuration_management.write_configuration(
+def run_daemon(config_store, commandline_arguments):
+    """Serve all configured groups from one long-running process.
+
+    "config_store" dictionary containting config file name and path
+
+    "commandline_arguments" dictionary as returned by parse_arguments()
+
+    The configuration is read once and every group gets its own, permanently
+    connected API instance. Each group is then polled on its own schedule.
+    Polling intervals get shorter while there is activity and back off again
+    for idle groups. See tootgroup_tools.scheduler for details."""
+    group_names = tootgroup_tools.configuration_management.get_group_names(config_store)
+    if len(group_names) == 0:
+        print("No groups configured yet! Run tootgroup.py with the --group flag")
+        print("once for every group to set it up before using the daemon mode.")
+        return
+
+    my_config = None
+    groups = {}
+    schedule = []
+    for group_name in group_names:
+        config_store["group_name"] = group_name
+        my_config = tootgroup_tools.configuration_management.parse_configuration(
+            config_store, my_config
+        )
+
+        group_lock = lock_group(config_store, group_name)
+        if group_lock is None:
+            print('Group "' + group_name + '" will not be served by the daemon.')
+            continue
+        group = connect_group(config_store, my_config, group_name)
+        if group is None:
+            tootgroup_tools.file_locks.release(group_lock)
+            print('Group "' + group_name + '" will not be served by the daemon.')
+            continue
+        # Held as long as the daemon is running
+        group["lock"] = group_lock
+        if commandline_arguments["catch_up"]:
+            group["last_seen_id"] = "catch-up"
+        if commandline_arguments["refresh_members"]:
+            group["member_cache"]["updated"] = 0.0
+        groups[group_name] = group
+        schedule.append(
+            tootgroup_tools.scheduler.new_schedule_entry(
+                group_name,
+                my_config[group_name].getfloat(
+                    "poll_interval_min",
+                    fallback=tootgroup_tools.scheduler.DEFAULT_MIN_INTERVAL,
+                ),
+                my_config[group_name].getfloat(
+                    "poll_interval_max",
+                    fallback=tootgroup_tools.scheduler.DEFAULT_MAX_INTERVAL,
+                ),
+            )
+        )
+
+    if len(schedule) == 0:
+        return
+    print("tootgroup.py daemon serving " + str(len(schedule)) + " group(s)...")
+
+    try:
+        while True:
+            entry = tootgroup_tools.scheduler.next_due(schedule)
+            delay = entry["next_run"] - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            group = groups[entry["group_name"]]
+            try:
+                activity = process_notifications(group, commandline_arguments)
+            except Exception as ex:
+                # A failing server must not stop all other groups. Treat the
+                # group as idle so it backs off until the server recovers.
+                if is_unauthorized(ex):
+                    tootgroup_tools.account_identity.discard_identity(
+                        config_store, entry["group_name"]
+                    )
+                print('Polling group "' + entry["group_name"] + '" failed: ' + str(ex))
+                activity = 0
+            tootgroup_tools.scheduler.reschedule(entry, activity)
+            write_metrics(commandline_arguments)
+    except KeyboardInterrupt:
+        print("\ntootgroup.py daemon stopped.")
+
+
+def run_all_groups(config_store, commandline_arguments):
+    """Do one run for every group in the configuration file.
+
+    "config_store" dictionary containting config file name and path
+
+    "commandline_arguments" dictionary as returned by parse_arguments()
+
+    The configuration is read once. Groups are then connected and processed
+    by a pool of worker threads, "--jobs" of them at the same time (default
+    GROUP_WORKERS). All groups share the same rate limits, media cache and
+    HTTP connection pools per server. A group that fails does not affect
+    the others. A summary of all groups is shown at the end.
+
+    Returns True if none of the groups failed."""
+    group_names = tootgroup_tools.configuration_management.get_group_names(config_store)
+    if len(group_names) == 0:
+        print("No groups configured yet! Run tootgroup.py with the --group flag")
+        print("once for every group to set it up before using --all-groups.")
+        return True
+
+    my_config = None
+    for group_name in group_names:
+        config_store["group_name"] = group_name
+        my_config = tootgroup_tools.configuration_management.parse_configuration(
             config_store, my_config
         )
 
+    workers = commandline_arguments["jobs"] or GROUP_WORKERS
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(workers, len(group_names)))
+    ) as executor:
+        summaries = list(
+            executor.map(
+                lambda group_name: run_group(
+                    config_store, my_config, group_name, commandline_arguments
+                ),
+                group_names,
+            )
+        )
+
+    write_metrics(commandline_arguments)
+    report_group_summaries(summaries)
+    return all(summary["status"] != "failed" for summary in summaries)
+
+
+def run_group(config_store, my_config, group_name, commandline_arguments):
+    """Connect a group and process its new notifications once.
+
+    "config_store" dictionary containting config file name and path
+
+    "my_config" the configuration as returned by parse_configuration()
+
+    "group_name" handle of the group
+
+    "commandline_arguments" dictionary as returned by parse_arguments()
+
+    Errors are reported but not raised, so other groups running at the
+    same time are not affected.
+
+    Groups served by another tootgroup.py process right now are skipped.
+
+    Returns a summary of the run as a dictionary. Its "status" is "ok",
+    "skipped" or "failed". "notifications" is the number of new notifications,
+    "actions" and "failed_actions" count the actions taken and the ones
+    that could not be completed. "error" holds what stopped the run."""
+    started = time.perf_counter()
+    summary = {
+        "group_name": group_name,
+        "status": "failed",
+        "notifications": 0,
+        "actions": 0,
+        "failed_actions": 0,
+        "seconds": 0.0,
+        "error": None,
+    }
+    group_lock = lock_group(config_store, group_name)
+    if group_lock is None:
+        summary["status"] = "skipped"
+        summary["error"] = "served by another process"
+        return summary
+    try:
+        group = connect_group(config_store, my_config, group_name)
+        if group is None:
+            summary["error"] = "cannot connect to the Fediverse server"
+        else:
+            if commandline_arguments["catch_up"]:
+                group["last_seen_id"] = "catch-up"
+            if commandline_arguments["refresh_members"]:
+                group["member_cache"]["updated"] = 0.0
+            summary["notifications"] = process_notifications(
+                group, commandline_arguments
+            )
+            summary["actions"] = len(group["action_results"])
+            summary["failed_actions"] = len(
+                [result for result in group["action_results"] if is_failed(result)]
+            )
+            if summary["failed_actions"] == 0:
+                summary["status"] = "ok"
+            else:
+                summary["error"] = "some actions will be retried next time"
+    except Exception as ex:
+        if is_unauthorized(ex):
+            tootgroup_tools.account_identity.discard_identity(config_store, group_name)
+            report_connection_error(ex)
+        summary["error"] = ex
+    finally:
+        tootgroup_tools.file_locks.release(group_lock)
+    summary["seconds"] = time.perf_counter() - started
+    return summary
+
+
+def report_group_summaries(summaries):
+    """Show how the runs of all groups went.
+
+    "summaries" dictionaries as returned by run_group()"""
+    failed = [summary for summary in summaries if summary["status"] == "failed"]
+    print("")
+    print("tootgroup.py run for " + str(len(summaries)) + " group(s):")
+    for summary in summaries:
+        line = "  %-24s %-7s %5d notifications %5d actions %8.2f s" % (
+            summary["group_name"],
+            summary["status"],
+            summary["notifications"],
+            summary["actions"],
+            summary["seconds"],
+        )
+        if summary["error"] is not None:
+            line += "  " + str(summary["error"])
+        print(line)
     print(
-        "Successful tootgroup.py run for "
-        + "@"
-        + my_account["username"]
-        + " at "
-        + my_config[group_name]["mastodon_instance"]
+        str(len(summaries) - len(failed))
+        + " group(s) succeeded or skipped, "
+        + str(len(failed))
+        + " failed"
+    )
+
+
+def get_media_settings(group_config):
+    """Return the settings for re-uploading a group's media files.
+
+    "group_config" the group's section of the configuration
+
+    Every value in MEDIA_SETTINGS can be overridden by an option of the
+    same name prefixed with "media_", e.g. "media_concurrency"."""
+    return {
+        "concurrency": group_config.getint(
+            "media_concurrency", fallback=MEDIA_SETTINGS["concurrency"]
+        ),
+        "timeout": group_config.getfloat(
+            "media_timeout", fallback=MEDIA_SETTINGS["timeout"]
+        ),
+        "spool_size": group_config.getint(
+            "media_spool_size", fallback=MEDIA_SETTINGS["spool_size"]
+        ),
+        "max_size": group_config.getint(
+            "media_max_size", fallback=MEDIA_SETTINGS["max_size"]
+        ),
+        "cache_size": group_config.getint(
+            "media_cache_size", fallback=MEDIA_SETTINGS["cache_size"]
+        ),
+        "upload_window": group_config.getfloat(
+            "media_upload_window", fallback=MEDIA_SETTINGS["upload_window"]
+        ),
+        "optimize": group_config.getboolean(
+            "media_optimize", fallback=MEDIA_SETTINGS["optimize"]
+        ),
+        "max_pixels": group_config.getint(
+            "media_max_pixels", fallback=MEDIA_SETTINGS["max_pixels"]
+        ),
+        "quality": group_config.getint(
+            "media_quality", fallback=MEDIA_SETTINGS["quality"]
+        ),
+    }
+
+
+def get_media_cache(group, media_settings):
+    """Return the media cache used by a group.
+
+    "group" dictionary as returned by connect_group()
+
+    "media_settings" dictionary as returned by get_media_settings()
+
+    The cache is stored in the "media_cache" directory next to the config
+    file and shared by all groups. Returns None if caching is disabled or
+    the group's traffic is recorded or replayed. Every media file has to
+    pass through the capture then."""
+    if media_settings["cache_size"] <= 0 or group["capture"] is not None:
+        return None
+    return tootgroup_tools.media_cache.get_media_cache(
+        group["config_store"]["directory"] + "media_cache/"
     )
 
 
-def media_toot_again(orig_media_dict, mastodon_instance):
+def media_toot_again(
+    orig_media_dict,
+    mastodon_instance,
+    media_settings=None,
+    media_cache=None,
+    group_name="",
+    keep_files=None,
+):
     """Re-upload media files to the server for use in another toot.
 
     "orig_media_dict" - extracted media files from the original toot
@@ -301,48 +2340,304 @@ def media_toot_again(orig_media_dict, mastodon_instance):
     "mastodon_instance" - needed to re-upload the media files and create
     a new media_dict.
 
+    "media_settings" - dictionary as returned by get_media_settings(). The
+    defaults from MEDIA_SETTINGS are used if it is not given.
+
+    "media_cache" - optional media cache as returned by get_media_cache()
+
+    "group_name" - handle of the group the media files are uploaded for. It is
+    needed to reuse the group's earlier uploads from the media cache.
+
+    "keep_files" - optional file names to keep a copy of every media file
+    at, in the order of "orig_media_dict"
+
     Mastodon does not allow the re-use of already uploaded media files (images,
     videos) in a new toot. This function downloads all media files from a toot
     and re-uploads them. It then returns a dict formatted in a proper way to
     be used by the Mastodon.status_post() function.
     It also works with Pleroma and others this way, altough it has not been tested
-    if there would be another, more "direct" solution with alternative services."""
+    if there would be another, more "direct" solution with alternative services.
+
+    All media files are transferred concurrently. The returned list keeps the
+    order of the original attachments. Files that cannot be downloaded are
+    left out. If uploading a file fails, its error is raised, so the post
+    can be retried later on. The other uploads are released in the media
+    cache then to be used again."""
+    if media_settings is None:
+        media_settings = MEDIA_SETTINGS
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, media_settings["concurrency"])
+    ) as executor:
+        transfers = [
+            executor.submit(
+                media_upload_again,
+                media,
+                mastodon_instance,
+                media_settings,
+                media_cache,
+                group_name,
+                None if keep_files is None else keep_files[i],
+            )
+            for i, media in enumerate(orig_media_dict)
+        ]
+
     new_media_dict = []
-    for media in orig_media_dict:
-        media_data = requests.get(media.url).content
-        filename = os.path.basename(media.url)
-        # basename still includes a "?" followed by a number after the file's name.
-        # Remove them both.
-        filename = filename.split("?")[0]
-        # separate filename and extension
-        filename, file_ext = os.path.splitext(filename)
-        f_temp = tempfile.NamedTemporaryFile(suffix=file_ext, delete=False, mode="w+b")
+    upload_error = None
+    for transfer in transfers:
         try:
-            f_temp.write(media_data)
-            f_temp.close()  # close to flush data
-            # This re-uploads the current media file to the server!
-            new_media_dict.append(
-                mastodon_instance.media_post(f_temp.name, description=media.description)
-            )
+            new_media = transfer.result()
         except Exception as ex:
+            upload_error = upload_error or ex
+            continue
+        if new_media is not None:
+            new_media_dict.append(new_media)
+
+    if media_cache is not None:
+        if upload_error is not None:
+            tootgroup_tools.media_cache.release_uploads(
+                media_cache, group_name, [media["id"] for media in new_media_dict]
+            )
+        tootgroup_tools.media_cache.save_media_cache(media_cache)
+    if upload_error is not None:
+        raise upload_error
+    return new_media_dict
+
+
+def media_upload_again(
+    media,
+    mastodon_instance,
+    media_settings,
+    media_cache=None,
+    group_name="",
+    keep_file=None,
+):
+    """Download a single media file and upload it again.
+
+    "media" - one media attachment of the original toot
+
+    "mastodon_instance" - needed to re-upload the media file
+
+    "media_settings" - dictionary as returned by get_media_settings()
+
+    "media_cache" - optional media cache as returned by get_media_cache()
+
+    "group_name" - handle of the group the media file is uploaded for
+
+    "keep_file" - optional file name to keep a copy of the media file at,
+    no matter if it is cached, see tootgroup_tools.outbox.keep_media_file()
+
+    The download is streamed in chunks into a temporary buffer that is only
+    written to disk if the file gets bigger than the configured "spool_size".
+    The buffer is then uploaded directly. Files bigger than "max_size" are
+    given up as soon as this is known.
+
+    With a media cache, files are only downloaded if they are not cached yet
+    and uploads of the same file that have not been used yet are reused.
+    Attachments of posts from the outbox are read from the file they are
+    kept in, if there is one.
+
+    If "optimize" is set, images are scaled down, re-encoded and stripped of
+    their metadata before they are uploaded. The savings are reported for
+    every file. The cache always keeps the original.
+
+    Returns the newly uploaded media or None if it could not be downloaded.
+    Errors while uploading it are raised."""
+    filename = os.path.basename(media.url)
+    # basename still includes a "?" followed by a number after the file's name.
+    # Remove them both.
+    filename = filename.split("?")[0]
+
+    media_buffer = None
+    uploading = False
+    try:
+        cached_media = None
+        if media_cache is not None:
+            cached_media = tootgroup_tools.media_cache.lookup(media_cache, media.url)
+
+        kept_file = getattr(media, "file", None)
+        if cached_media is not None:
+            content_hash, cached_file_name, mime_type = cached_media
+            try:
+                media_buffer = open(cached_file_name, "rb")
+            except OSError:
+                # Evicted by another thread or process meanwhile
+                tootgroup_tools.media_cache.forget(media_cache, content_hash)
+                cached_media = None
+        if cached_media is None:
+            if kept_file is not None and os.path.exists(kept_file):
+                media_buffer, mime_type = open(kept_file, "rb"), media.mime_type
+            else:
+                media_buffer, mime_type = media_download(
+                    media.url, media_settings, group_name
+                )
+            if media_cache is not None:
+                content_hash = tootgroup_tools.media_cache.store(
+                    media_cache,
+                    media.url,
+                    media_buffer,
+                    mime_type,
+                    media_settings["cache_size"],
+                )
+                media_buffer.seek(0)
+
+        if keep_file is not None:
+            tootgroup_tools.outbox.keep_media_file(keep_file, media_buffer)
+            media_buffer.seek(0)
+
+        if media_cache is not None:
+            media_id = tootgroup_tools.media_cache.get_upload(
+                media_cache,
+                group_name,
+                content_hash,
+                media.description,
+                media_settings["upload_window"],
+            )
+            if media_id is not None:
+                return {"id": media_id}
+
+        # Servers do not always know what they are serving. Guess from the
+        # file name in that case.
+        if mime_type in (None, "", "application/octet-stream"):
+            mime_type = mimetypes.guess_type(filename)[0]
+
+        if media_settings["optimize"]:
+            with tootgroup_tools.phase_profiler.phase("media optimization"):
+                optimized = tootgroup_tools.media_optimizer.optimize_image(
+                    media_buffer,
+                    mime_type,
+                    media_settings["max_pixels"],
+                    media_settings["quality"],
+                    media_settings["spool_size"],
+                )
+            if optimized is not None:
+                media_buffer.close()
+                media_buffer, original_size, optimized_size = optimized
+                with OUTPUT_LOCK:
+                    print(
+                        "Optimized media file %s: %.1f KiB -> %.1f KiB, %d %% saved"
+                        % (
+                            filename,
+                            original_size / 1024.0,
+                            optimized_size / 1024.0,
+                            (original_size - optimized_size) * 100 // original_size,
+                        )
+                    )
+
+        # This re-uploads the current media file to the server! If it fails,
+        # the whole post is retried later on, see queue_post().
+        uploading = True
+        new_media = media_upload(
+            mastodon_instance,
+            media_buffer,
+            mime_type,
+            filename,
+            media.description,
+            media_settings["timeout"],
+        )
+        if media_cache is not None:
+            tootgroup_tools.media_cache.remember_upload(
+                media_cache,
+                group_name,
+                content_hash,
+                media.description,
+                new_media["id"],
+            )
+        return new_media
+    except Exception as ex:
+        if uploading:
+            raise
+        with OUTPUT_LOCK:
             print("")
             print(
                 "\n##################################################################"
             )
-            print("Cannot write media to temporary file:")
+            print("Cannot transfer media file " + media.url + ":")
             print(ex)
             print("")
             print("tootgroup.py will continue but media files might not get reposted!")
             print(
                 "##################################################################\n"
             )
-        finally:
-            f_temp.close()  # close again for good measure
-            try:
-                os.unlink(f_temp.name)  # delete temporary file
-            except Exception:
-                pass  # cannot delete, probably non-existant anyway!
-    return new_media_dict
+        return None
+    finally:
+        if media_buffer is not None:
+            media_buffer.close()  # this also deletes data buffered on disk
+
+
+def media_upload(
+    mastodon_instance, media_file, mime_type, file_name, description, timeout
+):
+    """Upload a media file to the group's server.
+
+    "mastodon_instance" - connected Mastodon API instance of the group
+
+    "media_file" - file object holding the media data
+
+    "mime_type", "file_name", "description" - sent along with the file
+
+    "timeout" - seconds to wait for the server before giving up
+
+    The file is read while it is sent, see rest_client.MultipartBody.
+    Mastodon.py would read it into memory first, so its uploads are sent by
+    the built-in client instead, with the same server, access token and
+    session.
+
+    Returns the new media attachment."""
+    if not isinstance(mastodon_instance, tootgroup_tools.rest_client.RestClient):
+        mastodon_instance = tootgroup_tools.rest_client.RestClient(
+            mastodon_instance.api_base_url,
+            mastodon_instance.access_token,
+            mastodon_instance.session,
+        )
+    return mastodon_instance.media_post(
+        media_file,
+        mime_type=mime_type,
+        description=description,
+        file_name=file_name,
+        timeout=timeout,
+    )
+
+
+def media_download(url, media_settings, group_name=""):
+    """Download a media file into a temporary buffer.
+
+    "url" - where to download the media file from
+
+    "media_settings" - dictionary as returned by get_media_settings()
+
+    "group_name" - handle of the group the file is downloaded for
+
+    The download is streamed in chunks into a buffer that is only written to
+    disk if the file gets bigger than the configured "spool_size". Files bigger
+    than "max_size" are given up as soon as this is known.
+
+    Returns the buffer, positioned at its start, and the media's mime type."""
+    media_buffer = tempfile.SpooledTemporaryFile(
+        max_size=media_settings["spool_size"], mode="w+b"
+    )
+    try:
+        with tootgroup_tools.http_session.get_session(group_name).get(
+            url, timeout=media_settings["timeout"], stream=True
+        ) as response:
+            response.raise_for_status()
+            if (
+                int(response.headers.get("Content-Length", 0))
+                > media_settings["max_size"]
+            ):
+                raise ValueError("Media file exceeds the maximum size!")
+            for chunk in response.iter_content(chunk_size=MEDIA_CHUNK_SIZE):
+                media_buffer.write(chunk)
+                if media_buffer.tell() > media_settings["max_size"]:
+                    raise ValueError("Media file exceeds the maximum size!")
+            mime_type = response.headers.get("Content-Type", "")
+            mime_type = mime_type.split(";")[0].strip()
+    except Exception:
+        media_buffer.close()
+        raise
+
+    media_buffer.seek(0)
+    return media_buffer, mime_type
 
 
 # Start executing main() function if the script is called from a command line
@@ -1,8 +1,41 @@
-from tootgroup_tools import commandline_arguments, configuration_management
-
+import importlib
 import random
 import string
 
+# Submodules are imported on first use only. Some of them pull in heavy
+# dependencies like Mastodon.py or requests that are not needed by every
+# run, e.g. "tootgroup.py --version".
+_SUBMODULES = (
+    "account_identity",
+    "api_metrics",
+    "commandline_arguments",
+    "configuration_management",
+    "file_locks",
+    "http_session",
+    "media_cache",
+    "media_optimizer",
+    "member_cache",
+    "notification_records",
+    "outbox",
+    "phase_profiler",
+    "rate_limiter",
+    "repost_latency",
+    "rest_client",
+    "scheduler",
+    "state_files",
+    "state_store",
+    "status_content",
+    "streaming",
+    "traffic_capture",
+    "web_push",
+)
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module("tootgroup_tools." + name)
+    raise AttributeError("module 'tootgroup_tools' has no attribute " + repr(name))
+
 
 def compare_ids(current_notification_id, stored_notification_id):
     """Fediverse services use different kinds of notification IDs. Some
@@ -0,0 +1,86 @@
+"""Caches the group account's identity between runs.
+
+Verifying the account's credentials costs a round trip to the server on
+every run, although ID and username practically never change. They are
+therefore kept in a state file together with the server's version and
+only fetched again after some time or when the server rejects the
+group's credentials."""
+
+import os
+import time
+
+from tootgroup_tools import state_files
+
+# Default time in seconds after which the identity is verified again.
+# It can be overridden per group with "identity_cache_ttl" in the config file.
+DEFAULT_TTL = 86400
+
+
+def load_identity(config_store, group_name, mastodon_instance, ttl):
+    """Return a group's cached identity if it is still usable.
+
+    "config_store" dictionary containting config file name and path
+
+    "group_name" handle of the group
+
+    "mastodon_instance" the server URL configured for the group. Identities
+    cached for another server are ignored.
+
+    "ttl" maximum age of the cached identity in seconds
+
+    Returns None if the identity has to be fetched from the server again."""
+    identity = state_files.read_json(
+        state_files.state_file_name(config_store, group_name, "identity")
+    )
+    if not isinstance(identity, dict):
+        return None
+    if not all(key in identity for key in ("id", "username", "instance", "updated")):
+        return None
+    if identity["instance"] != mastodon_instance:
+        return None
+    if time.time() - identity["updated"] > ttl:
+        return None
+    return identity
+
+
+def fetch_identity(masto, mastodon_instance):
+    """Get the group account's identity from the server.
+
+    "masto" connected Mastodon API instance of the group
+
+    "mastodon_instance" the server URL configured for the group
+
+    Returns a dictionary holding the account's "id", "username" and "acct"
+    as well as the server's "version" if it can be determined."""
+    account = masto.account_verify_credentials()
+    try:
+        version = masto.instance().version
+    except Exception:
+        version = None
+    return {
+        "id": account.id,
+        "username": account.username,
+        "acct": account.acct,
+        "version": version,
+        "instance": mastodon_instance,
+        "updated": time.time(),
+    }
+
+
+def save_identity(config_store, group_name, identity):
+    """Write a group's identity to its state file. Failing is not fatal."""
+    try:
+        state_files.write_json(
+            state_files.state_file_name(config_store, group_name, "identity"),
+            identity,
+        )
+    except Exception as ex:
+        print("Cannot write account identity cache: " + str(ex))
+
+
+def discard_identity(config_store, group_name):
+    """Remove a group's cached identity so that it gets verified next time"""
+    try:
+        os.unlink(state_files.state_file_name(config_store, group_name, "identity"))
+    except Exception:
+        pass  # cannot delete, probably non-existant anyway!
@@ -0,0 +1,371 @@
+"""Records every request sent to a Fediverse server and exports the numbers.
+
+Each group's HTTP session reports its responses here (see http_session).
+Requests are counted per group, endpoint, method and HTTP status together
+with their latency and the bytes sent and received. The rate limit the
+server announced last is kept per group and host, as well as the time
+requests had to wait for it (see rate_limiter).
+
+At the end of a run, the numbers can be written as a Prometheus
+textfile-collector file and/or appended to a JSON lines file. The
+Prometheus file holds everything since the process started, every JSON
+line only what happened since the previous one. The repost latencies traced
+by repost_latency are exported along with them."""
+
+import datetime
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+
+from tootgroup_tools import repost_latency, state_files
+
+# Upper bounds of the latency histogram's buckets in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Path segments holding IDs are replaced by this, so that e.g. all reblogs
+# are counted for the same endpoint
+ID_PLACEHOLDER = ":id"
+
+_ID_PATTERN = re.compile(r"^(?!v\d+$).*\d")
+
+_metrics_lock = threading.Lock()
+# Everything since the process started
+_totals = {}
+# Everything since the last JSON line has been written
+_unreported = {}
+_rate_limits = {}
+# Time spent waiting for the rate limiter by group, since the process
+# started and since the last JSON line
+_pacing_totals = {}
+_pacing_unreported = {}
+
+
+def endpoint_name(url):
+    """Return the endpoint a URL belongs to.
+
+    IDs in API paths are replaced, e.g. "/api/v1/statuses/:id/reblog". URLs
+    outside of the API, like media files, are all counted as "download"."""
+    path = urllib.parse.urlsplit(url).path
+    if not (path.startswith("/api/") or path.startswith("/oauth/")):
+        return "download"
+    segments = [
+        ID_PLACEHOLDER if _ID_PATTERN.match(segment) else segment
+        for segment in path.rstrip("/").split("/")
+    ]
+    return "/".join(segments)
+
+
+def response_hook(group_name):
+    """Return a requests response hook recording responses for a group"""
+
+    def record(response, *args, **kwargs):
+        try:
+            record_response(group_name, response, kwargs.get("stream", False))
+        except Exception:
+            pass  # metrics must never break a run
+
+    return record
+
+
+def record_response(group_name, response, stream=False):
+    """Record a single response.
+
+    "group_name" handle of the group the request has been made for
+
+    "response" the requests.Response received from the server
+
+    "stream" True if the response's body is not read yet. Its size is then
+    taken from the Content-Length header."""
+    request = response.request
+    bytes_up = 0
+    if isinstance(request.body, (bytes, str)):
+        bytes_up = len(request.body)
+    elif request.body is not None:
+        # Streamed bodies like media uploads
+        bytes_up = int(request.headers.get("Content-Length", 0))
+    if stream:
+        bytes_down = int(response.headers.get("Content-Length", 0))
+    else:
+        bytes_down = len(response.content)
+    latency = response.elapsed.total_seconds()
+    key = (
+        group_name,
+        endpoint_name(request.url),
+        request.method,
+        str(response.status_code),
+    )
+
+    with _metrics_lock:
+        for metrics in (_totals, _unreported):
+            entry = metrics.setdefault(
+                key,
+                {
+                    "count": 0,
+                    "latency_sum": 0.0,
+                    "latency_buckets": [0] * len(LATENCY_BUCKETS),
+                    "bytes_up": 0,
+                    "bytes_down": 0,
+                },
+            )
+            entry["count"] += 1
+            entry["latency_sum"] += latency
+            for i, bucket in enumerate(LATENCY_BUCKETS):
+                if latency <= bucket:
+                    entry["latency_buckets"][i] += 1
+            entry["bytes_up"] += bytes_up
+            entry["bytes_down"] += bytes_down
+
+        rate_limit = rate_limit_headers(response.headers)
+        if rate_limit is not None:
+            host = urllib.parse.urlsplit(request.url).netloc
+            _rate_limits[(group_name, host)] = rate_limit
+
+
+def record_pacing(group_name, seconds):
+    """Record that a request of a group had to wait for the rate limiter"""
+    with _metrics_lock:
+        for pacing in (_pacing_totals, _pacing_unreported):
+            entry = pacing.setdefault(group_name, {"count": 0, "seconds": 0.0})
+            entry["count"] += 1
+            entry["seconds"] += seconds
+
+
+def rate_limit_headers(headers):
+    """Return the rate limit a response announces or None"""
+    if "X-RateLimit-Remaining" not in headers:
+        return None
+    rate_limit = {
+        "limit": int(headers.get("X-RateLimit-Limit", 0)),
+        "remaining": int(headers["X-RateLimit-Remaining"]),
+        "reset": None,
+    }
+    try:
+        reset = headers["X-RateLimit-Reset"].replace("Z", "+00:00")
+        rate_limit["reset"] = datetime.datetime.fromisoformat(reset).timestamp()
+    except Exception:
+        pass  # not given or in an unknown format
+    return rate_limit
+
+
+def _labels(**labels):
+    """Format Prometheus labels"""
+    return (
+        "{"
+        + ",".join(
+            name
+            + '="'
+            + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            + '"'
+            for name, value in labels.items()
+        )
+        + "}"
+    )
+
+
+def prometheus_text():
+    """Return all metrics in the Prometheus text exposition format"""
+    with _metrics_lock:
+        totals = {
+            key: dict(entry, latency_buckets=list(entry["latency_buckets"]))
+            for key, entry in _totals.items()
+        }
+        rate_limits = dict(_rate_limits)
+        pacing = {group: dict(entry) for group, entry in _pacing_totals.items()}
+
+    lines = [
+        "# HELP tootgroup_api_requests_total Requests sent to Fediverse servers.",
+        "# TYPE tootgroup_api_requests_total counter",
+    ]
+    for (group, endpoint, method, status), entry in sorted(totals.items()):
+        lines.append(
+            "tootgroup_api_requests_total"
+            + _labels(group=group, endpoint=endpoint, method=method, status=status)
+            + " "
+            + str(entry["count"])
+        )
+
+    # Latency, bytes and rate limits are not split by HTTP status
+    by_endpoint = {}
+    for (group, endpoint, method, status), entry in totals.items():
+        summed = by_endpoint.setdefault(
+            (group, endpoint, method),
+            {
+                "count": 0,
+                "latency_sum": 0.0,
+                "latency_buckets": [0] * len(LATENCY_BUCKETS),
+                "bytes_up": 0,
+                "bytes_down": 0,
+            },
+        )
+        summed["count"] += entry["count"]
+        summed["latency_sum"] += entry["latency_sum"]
+        summed["bytes_up"] += entry["bytes_up"]
+        summed["bytes_down"] += entry["bytes_down"]
+        for i, count in enumerate(entry["latency_buckets"]):
+            summed["latency_buckets"][i] += count
+
+    lines.append(
+        "# HELP tootgroup_api_request_duration_seconds Time until the server's "
+        + "response headers arrived."
+    )
+    lines.append("# TYPE tootgroup_api_request_duration_seconds histogram")
+    for (group, endpoint, method), entry in sorted(by_endpoint.items()):
+        for bucket, count in zip(LATENCY_BUCKETS, entry["latency_buckets"]):
+            lines.append(
+                "tootgroup_api_request_duration_seconds_bucket"
+                + _labels(group=group, endpoint=endpoint, method=method, le=bucket)
+                + " "
+                + str(count)
+            )
+        labels = _labels(group=group, endpoint=endpoint, method=method)
+        lines.append(
+            "tootgroup_api_request_duration_seconds_bucket"
+            + _labels(group=group, endpoint=endpoint, method=method, le="+Inf")
+            + " "
+            + str(entry["count"])
+        )
+        lines.append(
+            "tootgroup_api_request_duration_seconds_sum"
+            + labels
+            + " "
+            + repr(entry["latency_sum"])
+        )
+        lines.append(
+            "tootgroup_api_request_duration_seconds_count"
+            + labels
+            + " "
+            + str(entry["count"])
+        )
+
+    for direction, help_text in (
+        ("up", "Bytes of request bodies sent to Fediverse servers."),
+        ("down", "Bytes of response bodies received from Fediverse servers."),
+    ):
+        name = "tootgroup_api_" + ("sent" if direction == "up" else "received")
+        name += "_bytes_total"
+        lines.append("# HELP " + name + " " + help_text)
+        lines.append("# TYPE " + name + " counter")
+        for (group, endpoint, method), entry in sorted(by_endpoint.items()):
+            lines.append(
+                name
+                + _labels(group=group, endpoint=endpoint, method=method)
+                + " "
+                + str(entry["bytes_" + direction])
+            )
+
+    for field, help_text in (
+        ("limit", "Requests allowed per rate limit period."),
+        ("remaining", "Requests left in the current rate limit period."),
+        ("reset", "Time the current rate limit period ends."),
+    ):
+        name = "tootgroup_api_ratelimit_" + field
+        if field == "reset":
+            name += "_timestamp_seconds"
+        lines.append("# HELP " + name + " " + help_text)
+        lines.append("# TYPE " + name + " gauge")
+        for (group, host), rate_limit in sorted(rate_limits.items()):
+            if rate_limit[field] is not None:
+                lines.append(
+                    name
+                    + _labels(group=group, host=host)
+                    + " "
+                    + str(rate_limit[field])
+                )
+
+    for field, help_text in (
+        ("count", "Requests that had to wait for the rate limiter."),
+        ("seconds", "Time requests have waited for the rate limiter."),
+    ):
+        name = "tootgroup_api_paced_requests_total"
+        if field == "seconds":
+            name = "tootgroup_api_pacing_seconds_total"
+        lines.append("# HELP " + name + " " + help_text)
+        lines.append("# TYPE " + name + " counter")
+        for group, entry in sorted(pacing.items()):
+            lines.append(name + _labels(group=group) + " " + str(entry[field]))
+
+    lines.extend(repost_latency.prometheus_lines(_labels))
+
+    lines.append(
+        "# HELP tootgroup_last_run_timestamp_seconds Time metrics were written."
+    )
+    lines.append("# TYPE tootgroup_last_run_timestamp_seconds gauge")
+    lines.append("tootgroup_last_run_timestamp_seconds " + repr(time.time()))
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_textfile(file_name):
+    """Replace the Prometheus textfile-collector file with all metrics.
+
+    The file is replaced atomically, so the collector never reads a half
+    written file. Failing is not fatal."""
+    try:
+        state_files.write_text(file_name, prometheus_text())
+        # The collector usually runs as another user
+        os.chmod(file_name, 0o644)
+    except Exception as ex:
+        print("Cannot write metrics file: " + str(ex))
+
+
+def append_json_lines(file_name):
+    """Append the requests since the last call to a JSON lines file.
+
+    One line is written for each group, endpoint, method and HTTP status
+    that has been requested. The latest rate limit of each group and host
+    follows, and the time each group has waited for the rate limiter if it
+    had to. Repost latencies come last. Failing is not fatal."""
+    with _metrics_lock:
+        unreported = dict(_unreported)
+        _unreported.clear()
+        rate_limits = dict(_rate_limits)
+        pacing = dict(_pacing_unreported)
+        _pacing_unreported.clear()
+
+    now = time.time()
+    lines = []
+    for (group, endpoint, method, status), entry in sorted(unreported.items()):
+        lines.append(
+            {
+                "type": "api_requests",
+                "time": now,
+                "group": group,
+                "endpoint": endpoint,
+                "method": method,
+                "status": int(status),
+                "count": entry["count"],
+                "latency_sum": entry["latency_sum"],
+                "latency_buckets": dict(
+                    zip(
+                        (str(bucket) for bucket in LATENCY_BUCKETS),
+                        entry["latency_buckets"],
+                    )
+                ),
+                "bytes_up": entry["bytes_up"],
+                "bytes_down": entry["bytes_down"],
+            }
+        )
+    for (group, host), rate_limit in sorted(rate_limits.items()):
+        line = {"type": "rate_limit", "time": now, "group": group, "host": host}
+        line.update(rate_limit)
+        lines.append(line)
+    for group, entry in sorted(pacing.items()):
+        lines.append(
+            {
+                "type": "pacing",
+                "time": now,
+                "group": group,
+                "count": entry["count"],
+                "seconds": entry["seconds"],
+            }
+        )
+    lines.extend(repost_latency.json_lines(now))
+
+    try:
+        with open(file_name, "a", encoding="utf-8") as json_file:
+            for line in lines:
+                json_file.write(json.dumps(line) + "\n")
+    except Exception as ex:
+        print("Cannot write metrics file: " + str(ex))
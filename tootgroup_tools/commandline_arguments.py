@@ -14,6 +14,12 @@ def parse_arguments():
     Availble arguments:
     -h, --help: Automatically generated, prints options for help
 
+    --all-groups: Do one run for every group in the configuration file.
+    The groups are processed at the same time by a pool of worker threads.
+
+    -a, --async: Process notifications with the asyncio engine. Independent
+    requests to the Fediverse server are sent concurrently.
+
     -c, --catch-up: Catch up to the current state of the timeline without
     tooting anything. This is useful if the script has not been running for
     a while and would otherwise (re)post lots of old group-toots.
@@ -21,13 +27,63 @@ def parse_arguments():
     -d, --dry-run: Parse new messages but do not upload or toot anything.
     Shows the ID of notifications it would have processed instead.
 
+    --drain: Work through all pending notifications, however many there
+    are, in batches that are checkpointed one by one.
+
+    --daemon: Keep running and serve all configured groups from a single
+    process. Every group is polled on its own, adaptive schedule.
+
     -g, --group: group handle the script is currently running for. Needed
     by configparser to find its configuration and can be chosen freely.
 
+    -j, --jobs N: Number of groups processed at the same time with
+    --all-groups.
+
     -k, --ketchup: Same as -c or --catch-up, for the sake of lol.
 
+    --metrics FILE: Write statistics about all requests sent to the
+    Fediverse server to FILE in the Prometheus textfile-collector format.
+
+    --metrics-json FILE: Append the same statistics as JSON lines to FILE.
+
+    --profile [FILE]: Show how much time has been spent in each phase of
+    the run. If FILE is given, cProfile statistics are written to it too.
+
+    --push: Keep running and let the Fediverse server push new notifications
+    via Web Push instead of polling for them.
+
+    --record FILE: Save all responses of the run to a compressed capture
+    file that can be replayed later on.
+
+    --replay FILE: Run a capture recorded with --record through the regular
+    notification handling again, offline and without sending anything.
+
+    --refresh-members: Fetch the complete list of group members from the
+    server instead of relying on the member cache.
+
+    -s, --stream: Keep running and process the group's notifications as soon
+    as they are streamed by the Fediverse server instead of polling for them.
+
     --version: Show tootgroup.py version and exit"""
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--all-groups",
+        action="store_true",
+        help="Do one run for every group in the configuration file instead of "
+        + "a single one. Groups are processed at the same time and share their "
+        + "connections to the Fediverse servers. A summary of all groups is "
+        + "shown at the end. The exit status is 1 if any of them failed.",
+    )
+    parser.add_argument(
+        "-a",
+        "--async",
+        action="store_true",
+        dest="run_async",
+        help="Process notifications with the asyncio engine. The member list "
+        + "and the next page of notifications are fetched while the current "
+        + "one is being handled and media files are transferred concurrently. "
+        + "Group posts are still published in their original order.",
+    )
     parser.add_argument(
         "-c",
         "--catch-up",
@@ -43,6 +99,21 @@ def parse_arguments():
         help="Parse new messages but do not upload or toot anything. "
         + "Shows the ID of notifications it would have processed instead.",
     )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and serve all groups from the configuration file. "
+        + "Each group is polled on its own schedule which gets shorter while "
+        + "a group is busy and backs off while it is idle.",
+    )
+    parser.add_argument(
+        "--drain",
+        action="store_true",
+        help="Work through the complete backlog of notifications, oldest first, "
+        + 'instead of stopping after "max_notifications". Only the fields '
+        + "tootgroup.py needs are kept and notifications are handled in batches "
+        + "whose progress is saved one by one. Useful after a long downtime.",
+    )
     parser.add_argument(
         "-g",
         "--group",
@@ -55,25 +126,142 @@ def parse_arguments():
         + " it will be used with. If no handle is given, "
         + '"%(default)s" is always used instead.',
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        metavar="N",
+        help="Number of groups processed at the same time with --all-groups. "
+        + "Defaults to 8.",
+    )
     parser.add_argument(
         "-k",
         "--ketchup",
         action="store_true",
         help="Same as -c or --catch-up for the sake of lol!",
     )
+    parser.add_argument(
+        "--metrics",
+        metavar="FILE",
+        help="Count calls, latency, HTTP status, rate limits and transferred "
+        + "bytes of all requests to the Fediverse server per group and endpoint. "
+        + "Write them to FILE for the Prometheus textfile collector at the end "
+        + "of every run. FILE is replaced atomically.",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        metavar="FILE",
+        help="Append the same statistics as --metrics to FILE, one JSON object "
+        + "per group, endpoint and HTTP status for every run.",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="",
+        metavar="FILE",
+        help="Show how much time has been spent in each phase of the run, from "
+        + "reading the configuration to writing it back. If FILE is given, the "
+        + "main thread is profiled with cProfile as well and its statistics "
+        + "are written to FILE for further analysis with pstats.",
+    )
+    parser.add_argument(
+        "--push",
+        action="store_true",
+        help="Keep running and receive new notifications via Web Push. The "
+        + 'server sends them to the URL set as "push_url" in the group\'s '
+        + "configuration and they are processed right away. A regular poll "
+        + 'every "push_poll_interval" seconds catches up with anything missed. '
+        + 'Needs "pip install Mastodon.py[webpush]".',
+    )
+    parser.add_argument(
+        "--record",
+        metavar="FILE",
+        help="Save the responses to all requests of the run to FILE, e.g. "
+        + "notifications, member lists and media files, together with the "
+        + "group's settings and progress. FILE is gzip compressed and can be "
+        + "run through tootgroup.py again with --replay.",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="FILE",
+        help="Handle the notifications of a capture recorded with --record "
+        + "again, offline and at full speed. No configuration is needed and "
+        + "nothing is sent to any server: boosts, posts and uploads are only "
+        + "pretended. The time taken is shown at the end.",
+    )
+    parser.add_argument(
+        "--refresh-members",
+        action="store_true",
+        help="Fetch the complete list of group members from the Fediverse "
+        + "server instead of relying on the member cache. Useful after "
+        + "unfollowing accounts to remove them from the group right away.",
+    )
+    parser.add_argument(
+        "-s",
+        "--stream",
+        action="store_true",
+        help="Keep running and listen to the Fediverse server's streaming API. "
+        + "Notifications are processed as soon as they arrive. Missed ones are "
+        + "caught up with every time the connection is (re)established.",
+    )
     parser.add_argument(
         "--version", action="store_true", help="Show tootgroup.py version and exit."
     )
     args = parser.parse_args()
+    if args.daemon and (args.all_groups or args.stream or args.push):
+        parser.error(
+            "--daemon cannot be combined with --all-groups, --stream or --push"
+        )
+    if args.all_groups and (args.stream or args.push):
+        parser.error("--all-groups cannot be combined with --stream or --push")
+    if args.stream and args.push:
+        parser.error("--stream cannot be combined with --push")
+    if (args.record or args.replay) and (
+        args.all_groups or args.daemon or args.stream or args.push
+    ):
+        parser.error(
+            "--record and --replay cannot be combined with --all-groups, "
+            + "--daemon, --stream or --push"
+        )
+    if args.record and args.replay:
+        parser.error("--record cannot be combined with --replay")
     arguments = {}
     arguments["group_name"] = args.group
+    arguments["all_groups"] = False
+    arguments["jobs"] = args.jobs
+    arguments["run_async"] = False
     arguments["catch_up"] = False
     arguments["dry_run"] = False
+    arguments["daemon"] = False
+    arguments["drain"] = False
+    arguments["stream"] = False
+    arguments["push"] = False
+    arguments["refresh_members"] = False
+    arguments["metrics_file"] = args.metrics
+    arguments["profile"] = args.profile is not None
+    arguments["profile_file"] = args.profile or None
+    arguments["metrics_json_file"] = args.metrics_json
+    arguments["record_file"] = args.record
+    arguments["replay_file"] = args.replay
     arguments["show_version"] = False
+    if args.all_groups:
+        arguments["all_groups"] = True
+    if args.run_async:
+        arguments["run_async"] = True
     if args.catch_up or args.ketchup:
         arguments["catch_up"] = True
     if args.dry_run:
         arguments["dry_run"] = True
+    if args.daemon:
+        arguments["daemon"] = True
+    if args.drain:
+        arguments["drain"] = True
+    if args.refresh_members:
+        arguments["refresh_members"] = True
+    if args.stream:
+        arguments["stream"] = True
+    if args.push:
+        arguments["push"] = True
     if args.version:
         arguments["show_version"] = True
 
@@ -2,12 +2,14 @@
 and writing."""
 
 import configparser
+import io
 import os
 import sys
 import tootgroup_tools
 
 import platformdirs
-import mastodon
+
+from tootgroup_tools import phase_profiler
 
 
 def new_credentials_from_server(config_store, config):
@@ -23,21 +25,27 @@ def new_credentials_from_server(config_store, config):
     configuration files have been deleted or if some elements of the
     configuration are missing.
     """
+    # Mastodon.py takes long to import and is only needed here for setting
+    # up a group.
+    import mastodon
+
     group_name = config_store["group_name"]
 
     # Register tootgroup.py app at the Fediverse server
     try:
         mastodon.Mastodon.create_app(
             "tootgroup.py",
-            scopes=["read", "write"],
+            scopes=get_scopes(config, group_name),
             api_base_url=config[group_name]["mastodon_instance"],
             redirect_uris="urn:ietf:wg:oauth:2.0:oob",
             to_file=config_store["directory"] + config[group_name]["client_id"],
+            session=tootgroup_tools.http_session.get_session(group_name),
         )
         # Create Mastodon API instance
         masto = mastodon.Mastodon(
             client_id=config_store["directory"] + config[group_name]["client_id"],
             api_base_url=config[group_name]["mastodon_instance"],
+            session=tootgroup_tools.http_session.get_session(group_name),
         )
     except Exception as ex:
         print("")
@@ -58,7 +66,7 @@ def new_credentials_from_server(config_store, config):
         masto.log_in(
             input("Username (e-Mail) to log into the Fediverse Instance: "),
             input("Password: "),
-            scopes=["read", "write"],
+            scopes=get_scopes(config, group_name),
             redirect_uri="urn:ietf:wg:oauth:2.0:oob",
             to_file=config_store["directory"] + config[group_name]["access_token"],
         )
@@ -70,7 +78,7 @@ def new_credentials_from_server(config_store, config):
             client_id=config_store["directory"] + config[group_name]["client_id"],
             redirect_uris="urn:ietf:wg:oauth:2.0:oob",
             state=tootgroup_tools.get_random_alphanumeric_string(11),
-            scopes=["read", "write"],
+            scopes=get_scopes(config, group_name),
         )
 
         print("\nPlease open the following URL in your webbrowser, then authorize")
@@ -83,7 +91,7 @@ def new_credentials_from_server(config_store, config):
         try:
             masto.log_in(
                 code=input("Access Token from Web: "),
-                scopes=["read", "write"],
+                scopes=get_scopes(config, group_name),
                 redirect_uri="urn:ietf:wg:oauth:2.0:oob",
                 to_file=config_store["directory"] + config[group_name]["access_token"],
             )
@@ -96,12 +104,37 @@ def new_credentials_from_server(config_store, config):
             sys.exit(0)
 
 
-def parse_configuration(config_store):
+def get_scopes(config, group_name):
+    """Return the OAuth scopes tootgroup.py needs for a group.
+
+    Receiving Web Push messages needs the "push" scope. It is only asked
+    for if a "push_url" has been configured for the group."""
+    scopes = ["read", "write"]
+    if config[group_name].get("push_url"):
+        scopes.append("push")
+    return scopes
+
+
+def get_group_names(config_store):
+    """Return the handles of all groups found in the config file.
+
+    "config_store" dictionary containting config file name and path"""
+    config = configparser.ConfigParser()
+    config.read(config_store["directory"] + config_store["filename"])
+    return config.sections()
+
+
+@phase_profiler.timed("config parse")
+def parse_configuration(config_store, config=None):
     """Read configuration from file, handle first-run situations and errors.
 
     "config_store" dictionary containting config file name and path as
     well as the current group's name
 
+    "config" optional, already parsed configuration. If it is given, the
+    config file is not read again. This allows to validate many groups
+    against one configuration that is read only once.
+
     parse_configuration() uses Python's configparser to read and interpret the
     config file. It will detect a missing config file or missing elements and
     then try to solve problems by asking the user for more information. This
@@ -109,8 +142,9 @@ def parse_configuration(config_store):
     in that way act as an installer!
 
     parse_configuration should always return a complete and usable configuration"""
-    config = configparser.ConfigParser()
-    config.read(config_store["directory"] + config_store["filename"])
+    if config is None:
+        config = configparser.ConfigParser()
+        config.read(config_store["directory"] + config_store["filename"])
 
     group_name = config_store["group_name"]
     get_new_credentials = False
@@ -210,14 +244,8 @@ def parse_configuration(config_store):
         config_store["write_NEW"] = True
 
     # The ID of the last group-toot is needed to check for newly arrived
-    # notifications and will be persisted here. It is initially set up with
-    # "catch-up" to indicate this situation.
-    # Tootgroup.py will then get sane values and continue.
-    if (not config.has_option(group_name, "last_seen_id")) or (
-        config[group_name]["last_seen_id"] == ""
-    ):
-        config[group_name]["last_seen_id"] = "catch-up"
-        config_store["write_NEW"] = True
+    # notifications. It is kept in the state store and not in the config
+    # file any more, see tootgroup_tools.state_store.
 
     # Some registration info or credentials were missing - we have to register
     # tootgroup.py with our Fediverse server instance. (again?)
@@ -226,9 +254,11 @@ def parse_configuration(config_store):
         new_credentials_from_server(config_store, config)
 
     # Have there been any changes to the configuration?
-    # If yes we have to write them to the config file
+    # If yes we have to write them to the config file. Otherwise, the
+    # config file is only read.
     if config_store["write_NEW"]:
         write_configuration(config_store, config)
+        config_store["write_NEW"] = False
 
     # Configuration should be complete and working now - return it.
     return config
@@ -316,20 +346,29 @@ def setup_configuration_store():
     return config_store
 
 
+@phase_profiler.timed("config write")
 def write_configuration(config_store, config):
-    """Write out the configuration into the config file.
+    """Write out the current group's configuration into the config file.
 
-    "config_store: dictionary containting config file name and path
+    "config_store: dictionary containting config file name and path as
+    well as the current group's name
 
     "config" configparser object containing the current configuration.
 
-    This can be called whenever the configuration needs to be persisted by
-    writing it to the disk."""
+    Other tootgroup.py processes might be setting up groups at the same
+    time. The config file is therefore locked and read again, only the
+    current group's section is replaced and the file is then replaced
+    atomically. Changes made by others in the meantime are kept."""
+    file_name = config_store["directory"] + config_store["filename"]
+    group_name = config_store["group_name"]
     try:
-        with open(
-            config_store["directory"] + config_store["filename"], "w", encoding="utf-8"
-        ) as configfile:
-            config.write(configfile)
+        with tootgroup_tools.file_locks.locked(file_name + ".lock"):
+            current_config = configparser.ConfigParser()
+            current_config.read(file_name)
+            current_config[group_name] = config[group_name]
+            config_text = io.StringIO()
+            current_config.write(config_text)
+            tootgroup_tools.state_files.write_text(file_name, config_text.getvalue())
 
     except Exception as ex:
         print("")
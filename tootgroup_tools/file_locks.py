@@ -0,0 +1,53 @@
+"""Advisory file locks that keep concurrent tootgroup.py processes apart.
+
+Cron jobs for different groups may overlap, and a slow run can still be
+busy when the next one for the same group is started. Locks are taken on
+small, separate lock files next to the files they protect. They are
+released when the lock file is closed, which the operating system also
+does if tootgroup.py crashes, so a stale lock never blocks later runs.
+
+Locking relies on fcntl.flock(). Where it is not available, e.g. on
+Windows, every lock is granted right away."""
+
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def acquire(file_name, blocking=True):
+    """Lock a lock file, creating it if needed.
+
+    "file_name" name of the lock file
+
+    "blocking" if True, wait until the lock is free. Otherwise give up
+    right away if another process holds it.
+
+    Returns the lock, which has to be given to release() later on, or None
+    if the lock is held by someone else and "blocking" is False."""
+    lock = open(file_name, "a")
+    if fcntl is None:
+        return lock
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+
+def release(lock):
+    """Release a lock returned by acquire()"""
+    lock.close()
+
+
+@contextlib.contextmanager
+def locked(file_name):
+    """Hold the lock of a lock file for the duration of a with block"""
+    lock = acquire(file_name)
+    try:
+        yield
+    finally:
+        release(lock)
@@ -0,0 +1,79 @@
+"""Provides the HTTP sessions used by all connections of a tootgroup.py run.
+
+Every group gets its own requests.Session, so each request can be
+accounted to the group it has been made for. All sessions share the same
+connection pools, which keeps connections alive between requests no
+matter which group or media download they belong to. The pools are big
+enough to allow concurrent media transfers.
+
+API requests of all sessions are paced by tootgroup_tools.rate_limiter."""
+
+import threading
+
+import requests
+
+from tootgroup_tools import api_metrics, rate_limiter
+
+# Number of connections kept open per host. This also limits how many
+# requests can be sent to the same host at the same time.
+POOL_SIZE = 10
+
+# Number of hosts whose connections are kept open. With --all-groups or
+# --daemon, groups of many different servers are served by one process.
+POOL_HOSTS = 100
+
+_adapter = None
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class PacedSession(requests.Session):
+    """A session that waits for the rate limiter before sending requests"""
+
+    def __init__(self, group_name):
+        super().__init__()
+        self.group_name = group_name
+        # Replayed requests do not reach any server, see traffic_capture
+        self.paced = True
+
+    def send(self, request, **kwargs):
+        if not self.paced:
+            return super().send(request, **kwargs)
+        # A request rejected by the rate limit is sent again once the rate
+        # limiter allows it.
+        for attempt in range(rate_limiter.MAX_RETRIES + 1):
+            waited = rate_limiter.acquire(
+                request.method,
+                request.url,
+                rate_limiter.account_key(request.headers),
+            )
+            if waited > 0:
+                api_metrics.record_pacing(self.group_name, waited)
+            response = super().send(request, **kwargs)
+            rate_limiter.record_response(response)
+            if response.status_code != 429 or attempt == rate_limiter.MAX_RETRIES:
+                return response
+            response.close()
+            # Streamed bodies, like media uploads, have been read already
+            if hasattr(request.body, "read"):
+                requests.utils.rewind_body(request)
+
+
+def get_session(group_name=""):
+    """Return the session of a group, creating it on first use.
+
+    "group_name" handle of the group the requests are made for. Requests
+    that do not belong to a specific group use the default session."""
+    global _adapter
+    with _sessions_lock:
+        if _adapter is None:
+            _adapter = requests.adapters.HTTPAdapter(
+                pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE
+            )
+        if group_name not in _sessions:
+            session = PacedSession(group_name)
+            session.mount("http://", _adapter)
+            session.mount("https://", _adapter)
+            session.hooks["response"].append(api_metrics.response_hook(group_name))
+            _sessions[group_name] = session
+        return _sessions[group_name]
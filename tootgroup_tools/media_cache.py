@@ -0,0 +1,277 @@
+"""Content-addressed cache for media files that get reposted.
+
+Downloaded media files are stored under their SHA-256 hash in a cache
+directory next to the configuration. An index maps source URLs to these
+hashes, so the same attachment is never downloaded twice while it is
+cached. The least recently used files are removed as soon as the cache
+grows beyond its size budget.
+
+The cache also remembers which media IDs a group got from its server when
+uploading a file. As long as such an upload has not been attached to a
+status, the server accepts it for a new status. A retried repost can
+then reuse the upload instead of sending the file again. Uploads are
+marked as in use while a status is being posted with them, so the same
+upload is never handed out twice. Marks are only kept in memory."""
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from tootgroup_tools import state_files
+
+INDEX_FILE_NAME = "index.json"
+
+# Caches that have been opened by this process, by directory
+_media_caches = {}
+_media_caches_lock = threading.Lock()
+
+
+def get_media_cache(directory):
+    """Return the media cache stored in the given directory.
+
+    "directory" path of the cache directory including a trailing "/"
+
+    The cache is read only once per process and shared by all groups. If
+    the directory cannot be created, None is returned and media files will
+    simply not be cached."""
+    with _media_caches_lock:
+        if directory not in _media_caches:
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except Exception as ex:
+                print("Cannot create media cache directory: " + str(ex))
+                return None
+            _media_caches[directory] = load_media_cache(directory)
+        return _media_caches[directory]
+
+
+def load_media_cache(directory):
+    """Read the cache index and reconcile it with the files on disk.
+
+    Files that are missing from the index (e.g. because another process
+    wrote the index at the same time) are added again, index entries without
+    a file are dropped."""
+    index = state_files.read_json(directory + INDEX_FILE_NAME)
+    if not isinstance(index, dict):
+        index = {}
+    media_cache = {
+        "directory": directory,
+        "lock": threading.Lock(),
+        "urls": index.get("urls", {}),
+        "blobs": {},
+        "uploads": index.get("uploads", {}),
+    }
+    # Statuses that were being posted by an earlier process are done by now
+    for uploads in media_cache["uploads"].values():
+        for upload in uploads.values():
+            upload["in_use"] = False
+
+    stored_blobs = index.get("blobs", {})
+    for file_name in os.listdir(directory):
+        if len(file_name) != 64 or file_name.endswith(".tmp"):
+            continue  # not a cached media file
+        blob = stored_blobs.get(file_name)
+        if blob is None:
+            blob = {
+                "size": os.path.getsize(directory + file_name),
+                "last_used": os.path.getmtime(directory + file_name),
+                "mime_type": None,
+            }
+        media_cache["blobs"][file_name] = blob
+    media_cache["urls"] = {
+        url: entry
+        for url, entry in media_cache["urls"].items()
+        if entry.get("hash") in media_cache["blobs"]
+    }
+    return media_cache
+
+
+def save_media_cache(media_cache):
+    """Write the cache index to disk. Failing is not fatal."""
+    with media_cache["lock"]:
+        index = {
+            "urls": dict(media_cache["urls"]),
+            "blobs": dict(media_cache["blobs"]),
+            "uploads": {
+                group_name: dict(uploads)
+                for group_name, uploads in media_cache["uploads"].items()
+            },
+        }
+    try:
+        state_files.write_json(media_cache["directory"] + INDEX_FILE_NAME, index)
+    except Exception as ex:
+        print("Cannot write media cache index: " + str(ex))
+
+
+def lookup(media_cache, url):
+    """Find a cached media file by its source URL.
+
+    Returns a tuple of the content hash, the file's path and its mime type
+    or None if the URL is not cached."""
+    with media_cache["lock"]:
+        entry = media_cache["urls"].get(url)
+        if entry is None or entry["hash"] not in media_cache["blobs"]:
+            return None
+        content_hash = entry["hash"]
+        blob = media_cache["blobs"][content_hash]
+        blob["last_used"] = time.time()
+    return (content_hash, media_cache["directory"] + content_hash, blob["mime_type"])
+
+
+def store(media_cache, url, media_file, mime_type, max_size):
+    """Add a downloaded media file to the cache.
+
+    "url" the source URL the file has been downloaded from
+
+    "media_file" file object holding the media data. It is read from its
+    current position to the end.
+
+    "mime_type" the media file's type
+
+    "max_size" size budget of the whole cache in bytes. Least recently used
+    files are removed until everything fits in.
+
+    Returns the file's content hash."""
+    directory = media_cache["directory"]
+    content_hash = hashlib.sha256()
+    f_temp = tempfile.NamedTemporaryFile(dir=directory, suffix=".tmp", delete=False)
+    try:
+        with f_temp:
+            for chunk in iter(lambda: media_file.read(64 * 1024), b""):
+                content_hash.update(chunk)
+                f_temp.write(chunk)
+            size = f_temp.tell()
+        content_hash = content_hash.hexdigest()
+        if size > max_size:
+            os.unlink(f_temp.name)
+            return content_hash
+        os.replace(f_temp.name, directory + content_hash)
+    except Exception:
+        try:
+            os.unlink(f_temp.name)
+        except Exception:
+            pass  # cannot delete, probably non-existant anyway!
+        raise
+
+    with media_cache["lock"]:
+        media_cache["blobs"][content_hash] = {
+            "size": size,
+            "last_used": time.time(),
+            "mime_type": mime_type,
+        }
+        media_cache["urls"][url] = {"hash": content_hash}
+        evict(media_cache, max_size)
+    return content_hash
+
+
+def forget(media_cache, content_hash):
+    """Remove a media file from the cache, e.g. because it has been deleted
+    by another process meanwhile."""
+    with media_cache["lock"]:
+        media_cache["blobs"].pop(content_hash, None)
+        media_cache["urls"] = {
+            url: entry
+            for url, entry in media_cache["urls"].items()
+            if entry["hash"] != content_hash
+        }
+    try:
+        os.unlink(media_cache["directory"] + content_hash)
+    except Exception:
+        pass  # cannot delete, probably non-existant anyway!
+
+
+def evict(media_cache, max_size):
+    """Remove least recently used files until the cache fits into max_size.
+
+    Has to be called while holding the cache's lock."""
+    total_size = sum(blob["size"] for blob in media_cache["blobs"].values())
+    by_last_use = sorted(
+        media_cache["blobs"].items(), key=lambda item: item[1]["last_used"]
+    )
+    for content_hash, blob in by_last_use:
+        if total_size <= max_size:
+            break
+        try:
+            os.unlink(media_cache["directory"] + content_hash)
+        except Exception:
+            pass  # cannot delete, probably non-existant anyway!
+        del media_cache["blobs"][content_hash]
+        total_size -= blob["size"]
+
+    media_cache["urls"] = {
+        url: entry
+        for url, entry in media_cache["urls"].items()
+        if entry["hash"] in media_cache["blobs"]
+    }
+
+
+def upload_key(content_hash, description):
+    """Uploads carry their description, so both identify a reusable upload"""
+    return content_hash + ":" + (description or "")
+
+
+def get_upload(media_cache, group_name, content_hash, description, window):
+    """Return the media ID of a reusable earlier upload or None.
+
+    "group_name" handle of the group that uploaded the file
+
+    "content_hash", "description" what has been uploaded
+
+    "window" seconds an upload is considered to be accepted by the server
+
+    The returned upload is marked as in use until it is either forgotten or
+    released again."""
+    with media_cache["lock"]:
+        upload = (
+            media_cache["uploads"]
+            .get(group_name, {})
+            .get(upload_key(content_hash, description))
+        )
+        if upload is None or upload.get("in_use"):
+            return None
+        if time.time() - upload["uploaded"] > window:
+            return None
+        upload["in_use"] = True
+        return upload["media_id"]
+
+
+def remember_upload(media_cache, group_name, content_hash, description, media_id):
+    """Remember a group's upload so that it can be reused.
+
+    The upload is marked as in use by the status it has been made for."""
+    with media_cache["lock"]:
+        uploads = media_cache["uploads"].setdefault(group_name, {})
+        uploads[upload_key(content_hash, description)] = {
+            "media_id": str(media_id),
+            "uploaded": time.time(),
+            "in_use": True,
+        }
+
+
+def release_uploads(media_cache, group_name, media_ids):
+    """Make uploads reusable again after posting a status with them failed.
+
+    "media_ids" uploads that have not been attached to a status"""
+    media_ids = set(str(media_id) for media_id in media_ids)
+    with media_cache["lock"]:
+        for upload in media_cache["uploads"].get(group_name, {}).values():
+            if upload["media_id"] in media_ids:
+                upload["in_use"] = False
+
+
+def forget_uploads(media_cache, group_name, media_ids, window):
+    """Forget uploads that cannot be reused any more.
+
+    "media_ids" uploads that have been attached to a status right now
+
+    "window" seconds an upload is considered to be accepted by the server.
+    Older uploads are forgotten too."""
+    media_ids = set(str(media_id) for media_id in media_ids)
+    now = time.time()
+    with media_cache["lock"]:
+        uploads = media_cache["uploads"].get(group_name, {})
+        for key, upload in list(uploads.items()):
+            if upload["media_id"] in media_ids or now - upload["uploaded"] > window:
+                del uploads[key]
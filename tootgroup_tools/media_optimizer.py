@@ -0,0 +1,117 @@
+"""Shrinks images before they are uploaded again.
+
+Members often send photos straight from their phones, with many megapixels
+and several megabytes each. The server scales them down anyway, but only
+after the whole file has been uploaded and processed.
+
+optimize_image() scales images above a pixel budget down to fit it,
+encodes them again with the given quality and drops their metadata like
+EXIF and XMP. The EXIF orientation is applied to the pixels first and
+color profiles are kept. JPEG, PNG and WebP images are optimized, animated
+images and all other media are left alone. The result is only used if it
+is actually smaller than the original.
+
+This needs Pillow. Without it, all media files are uploaded unchanged:
+
+    pip install Pillow
+"""
+
+import os
+import tempfile
+import threading
+
+# Mime types that can be optimized and the format they are saved in
+_FORMATS = {"image/jpeg": "JPEG", "image/png": "PNG", "image/webp": "WEBP"}
+
+# Decoding is CPU bound and a decoded photo takes a few hundred MiB. Working
+# on more images at a time than there are CPUs would only cost memory.
+_decoders = threading.BoundedSemaphore(os.cpu_count() or 1)
+
+# EXIF orientations that need the pixels to be transposed
+_ORIENTATIONS = range(2, 9)
+
+_missing_pillow_reported = False
+_missing_pillow_lock = threading.Lock()
+
+
+def optimize_image(media_buffer, mime_type, max_pixels, quality, spool_size):
+    """Return a smaller copy of an image.
+
+    "media_buffer" file object holding the original image
+
+    "mime_type" the image's mime type, e.g. "image/jpeg"
+
+    "max_pixels" bigger images are scaled down to this number of pixels
+
+    "quality" quality of JPEG and WebP images, from 1 to 95
+
+    "spool_size" the copy is kept in memory up to this size in bytes
+
+    Returns the copy, positioned at its start, together with the sizes of
+    the original and the copy in bytes. None is returned if the image
+    cannot be made smaller. "media_buffer" is positioned at its start
+    again in any case."""
+    image_format = _FORMATS.get(mime_type)
+    if image_format is None:
+        return None
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        _report_missing_pillow()
+        return None
+
+    media_buffer.seek(0, 2)
+    original_size = media_buffer.tell()
+    media_buffer.seek(0)
+    optimized = tempfile.SpooledTemporaryFile(max_size=spool_size, mode="w+b")
+    try:
+        with _decoders, Image.open(media_buffer) as image:
+            if getattr(image, "is_animated", False):
+                raise ValueError("animated images are not optimized")
+            icc_profile = image.info.get("icc_profile")
+            pixels = image.width * image.height
+            if pixels > max_pixels:
+                # Scale down first, so only the smaller image is transposed
+                scale = (max_pixels / float(pixels)) ** 0.5
+                image.thumbnail(
+                    (
+                        max(1, int(image.width * scale)),
+                        max(1, int(image.height * scale)),
+                    ),
+                    Image.LANCZOS,
+                )
+            if image.getexif().get(0x0112) in _ORIENTATIONS:
+                image = ImageOps.exif_transpose(image)
+            options = {"optimize": True, "exif": b""}
+            if image_format in ("JPEG", "WEBP"):
+                options["quality"] = quality
+            if image_format == "JPEG":
+                options["progressive"] = True
+                if image.mode not in ("RGB", "L", "CMYK"):
+                    image = image.convert("RGB")
+            if icc_profile:
+                options["icc_profile"] = icc_profile
+            image.save(optimized, image_format, **options)
+    except Exception:
+        optimized.close()
+        media_buffer.seek(0)
+        return None
+
+    media_buffer.seek(0)
+    optimized_size = optimized.tell()
+    if optimized_size >= original_size:
+        optimized.close()
+        return None
+    optimized.seek(0)
+    return optimized, original_size, optimized_size
+
+
+def _report_missing_pillow():
+    """Tell the user once that images cannot be optimized"""
+    global _missing_pillow_reported
+    with _missing_pillow_lock:
+        if _missing_pillow_reported:
+            return
+        _missing_pillow_reported = True
+    print('"media_optimize" is enabled but Pillow is not installed. Images are')
+    print('uploaded unchanged. Install it with "pip install Pillow".')
@@ -0,0 +1,113 @@
+"""Keeps the IDs of a group's members in a file between runs.
+
+Group members are all accounts the group account is following. Fetching
+the complete list from the server is expensive for big groups, so it is
+only done after the cache has expired. Until then, senders that are not
+known yet are looked up in small batches via the relationships API."""
+
+import sys
+import time
+
+from tootgroup_tools import phase_profiler, state_files
+
+# Default time in seconds after which the whole member list is fetched again.
+# It can be overridden per group with "member_cache_ttl" in the config file.
+DEFAULT_TTL = 3600
+
+# Maximum number of accounts asked for in a single relationships request
+RELATIONSHIPS_BATCH_SIZE = 40
+
+
+def load_member_cache(config_store, group_name):
+    """Read a group's member cache from disk.
+
+    "config_store" dictionary containting config file name and path
+
+    "group_name" handle of the group
+
+    Returns a dictionary with the "member_ids" set and the time the list was
+    "updated" from the server. If there is no usable cache, the dictionary
+    is marked as outdated so it will be refreshed before use."""
+    stored = state_files.read_json(
+        state_files.state_file_name(config_store, group_name, "members")
+    )
+    try:
+        return {
+            "updated": float(stored["updated"]),
+            "member_ids": set(str(member) for member in stored["member_ids"]),
+        }
+    except Exception:
+        return {"updated": 0.0, "member_ids": set()}
+
+
+def save_member_cache(config_store, group_name, member_cache):
+    """Write a group's member cache to disk.
+
+    Failing to write the cache is not fatal, it will just be rebuilt on the
+    next run."""
+    try:
+        state_files.write_json(
+            state_files.state_file_name(config_store, group_name, "members"),
+            {
+                "updated": member_cache["updated"],
+                "member_ids": sorted(member_cache["member_ids"]),
+            },
+        )
+    except Exception as ex:
+        print("Cannot write member cache: " + str(ex))
+
+
+def is_expired(member_cache, ttl):
+    """Check if the member list has to be fetched from the server again"""
+    return time.time() - member_cache["updated"] > ttl
+
+
+@phase_profiler.timed("member fetch")
+def refresh_members(masto, account_id, member_cache):
+    """Replace the cached member IDs with the server's complete list.
+
+    "masto" connected Mastodon API instance of the group
+
+    "account_id" ID of the group account
+
+    "member_cache" dictionary as returned by load_member_cache()"""
+    # limit=sys.maxsize is set here because Pleroma only returns 20 Member if
+    # the standard limit=None value is used! Servers that return less than
+    # the whole list at once are paged through by fetch_remaining().
+    following = masto.fetch_remaining(
+        masto.account_following(account_id, limit=sys.maxsize)
+    )
+    member_cache["member_ids"] = set(str(member.id) for member in following)
+    member_cache["updated"] = time.time()
+
+
+@phase_profiler.timed("member fetch")
+def add_new_members(masto, member_cache, account_ids):
+    """Look up accounts that are not known as members yet.
+
+    "masto" connected Mastodon API instance of the group
+
+    "member_cache" dictionary as returned by load_member_cache()
+
+    "account_ids" IDs of accounts that sent notifications
+
+    All unknown accounts are checked in batches via the relationships API.
+    Those the group account is following are added to the cache.
+
+    Returns True if new members have been found."""
+    unknown_ids = []
+    for account_id in account_ids:
+        account_id = str(account_id)
+        if account_id not in member_cache["member_ids"] and (
+            account_id not in unknown_ids
+        ):
+            unknown_ids.append(account_id)
+
+    found_new_members = False
+    for start in range(0, len(unknown_ids), RELATIONSHIPS_BATCH_SIZE):
+        batch = unknown_ids[start : start + RELATIONSHIPS_BATCH_SIZE]
+        for relationship in masto.account_relationships(batch):
+            if relationship.following:
+                member_cache["member_ids"].add(str(relationship.id))
+                found_new_members = True
+    return found_new_members
@@ -0,0 +1,100 @@
+"""Compact records of notifications for draining a large backlog.
+
+Notifications arrive with the complete sending account and status, each
+with lots of fields tootgroup.py never looks at. Mastodon.py turns all of
+them into nested entities. This is fine for a few dozen notifications, but
+a group coming back after a long downtime can have thousands waiting.
+
+The records here only keep what tootgroup.py uses to classify a
+notification and to repost it. Their attributes are named like the ones of
+the original notifications, so they can be handed to the same functions.
+They use __slots__ and therefore do not need a dictionary per instance.
+
+    records = compact_notifications(pages)
+    for batch in batched(records, 100):
+        ...
+
+Both are generators. Only the page being converted and the batch being
+processed are kept in memory."""
+
+
+class AccountRecord:
+    """The sender of a notification"""
+
+    __slots__ = ("id", "acct")
+
+    def __init__(self, account):
+        self.id = account.id
+        self.acct = account.acct
+
+
+class MediaRecord:
+    """A media attachment of a status"""
+
+    __slots__ = ("url", "description")
+
+    def __init__(self, media):
+        self.url = media.url
+        self.description = media.description
+
+
+class StatusRecord:
+    """The status a mention has been sent with"""
+
+    __slots__ = (
+        "id",
+        "visibility",
+        "content",
+        "spoiler_text",
+        "sensitive",
+        "media_attachments",
+    )
+
+    def __init__(self, status):
+        self.id = status.id
+        self.visibility = status.visibility
+        self.content = status.content
+        self.spoiler_text = status.spoiler_text
+        self.sensitive = status.sensitive
+        self.media_attachments = [
+            MediaRecord(media) for media in status.media_attachments
+        ]
+
+
+class NotificationRecord:
+    """A notification with only the fields tootgroup.py needs"""
+
+    __slots__ = ("id", "type", "account", "status")
+
+    def __init__(self, notification):
+        self.id = notification.id
+        self.type = notification.type
+        self.account = AccountRecord(notification.account)
+        status = getattr(notification, "status", None)
+        self.status = None if status is None else StatusRecord(status)
+
+
+def compact_notifications(pages):
+    """Turn pages of notifications into compact records.
+
+    "pages" iterable of notification lists, oldest first
+
+    Yields a NotificationRecord for every notification. A page can be
+    freed as soon as the next one is requested."""
+    for page in pages:
+        for notification in page:
+            yield NotificationRecord(notification)
+
+
+def batched(records, batch_size):
+    """Group records into lists of up to "batch_size" records.
+
+    The last batch can be shorter. Nothing is yielded for no records."""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
@@ -0,0 +1,347 @@
+"""Keeps new posts that could not be published and retries them later.
+
+If a post from a direct message cannot be published, e.g. because the
+server is down or one of its media uploads fails, it is put into the
+group's outbox. Its notification counts as taken care of then. Every
+later run tries to publish the posts waiting there, oldest first, before
+it looks at new notifications. A post that still fails is tried again
+after an increasing waiting time. New posts are queued behind waiting
+ones, so the group's timeline keeps its order.
+
+Queued posts are kept in the group's state database (see state_store)
+together with their text, visibility, content warning and sensitivity.
+Their media files are kept in a "GROUP_outbox" directory next to the
+configuration. They are put there while they are transferred, before it
+is known whether the post needs them, see keep_media_file(). Retries
+upload these files instead of downloading them again.
+Uploads that have been made before the post failed are reused as long as
+the server accepts them."""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+# Appended to the group's name to get the directory media files are kept in
+DIRECTORY_SUFFIX = "_outbox/"
+
+# Seconds until a failed post is tried again the first time. The waiting
+# time doubles with every failure, up to "max_delay".
+DEFAULT_RETRY_DELAY = 60.0
+DEFAULT_MAX_DELAY = 6 * 3600.0
+
+# A post that has failed this often is given up
+DEFAULT_MAX_ATTEMPTS = 25
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    sequence INTEGER PRIMARY KEY,
+    group_name TEXT NOT NULL,
+    notification_id TEXT NOT NULL,
+    post TEXT NOT NULL,
+    queued REAL NOT NULL,
+    attempts INTEGER NOT NULL,
+    next_attempt REAL NOT NULL,
+    last_error TEXT
+);
+"""
+
+
+class QueuedMedia:
+    """A media attachment of a queued post.
+
+    Its attributes are named like the ones of the original attachment, so
+    it can be uploaded again like those. "file" is where the media file is
+    kept, or None if it has to be downloaded again."""
+
+    __slots__ = ("url", "description", "file", "mime_type")
+
+    def __init__(self, url, description, file=None, mime_type=None):
+        self.url = url
+        self.description = description
+        self.file = file
+        self.mime_type = mime_type
+
+
+def get_outbox(config_store, group_name, state_store):
+    """Return the outbox of a group.
+
+    "config_store" dictionary containting config file name and path
+
+    "group_name" handle of the group
+
+    "state_store" the group's state store as returned by get_state_store()"""
+    with state_store["lock"]:
+        state_store["connection"].executescript(_SCHEMA)
+    return {
+        "group_name": group_name,
+        "state_store": state_store,
+        "directory": config_store["directory"] + group_name + DIRECTORY_SUFFIX,
+    }
+
+
+def queue_post(outbox, notification_id, post, media, uploads, error, retry_delay):
+    """Put a new post into the outbox.
+
+    "notification_id" ID of the notification the post has been made for
+
+    "post" dictionary holding the post's "status", "visibility",
+    "spoiler_text" and "sensitive"
+
+    "media" list of tuples of the URL, description, file name and mime type
+    of each attachment. File name and mime type are None if the file is not
+    available locally. Available files are kept in the outbox's directory.
+
+    "uploads" media IDs of the post's attachments if they have been
+    uploaded already, None otherwise
+
+    "error" why the post could not be published, None if it only waits
+    behind older posts
+
+    "retry_delay" seconds until a failed post is tried again
+
+    The post is written to the state database right away."""
+    now = time.time()
+    kept_media = []
+    for i, (url, description, file_name, mime_type) in enumerate(media):
+        kept_file = None
+        if file_name is not None:
+            kept_file = _keep_file(outbox, notification_id, i, file_name)
+        kept_media.append(
+            {
+                "url": url,
+                "description": description,
+                "file": kept_file,
+                "mime_type": mime_type if kept_file is not None else None,
+            }
+        )
+    post = dict(post)
+    post["media"] = kept_media
+    post["uploads"] = (
+        None if uploads is None else [str(media_id) for media_id in uploads]
+    )
+    post["uploaded"] = now
+    state_store = outbox["state_store"]
+    with state_store["lock"]:
+        state_store["connection"].execute(
+            "INSERT INTO outbox (group_name, notification_id, post, queued, "
+            + "attempts, next_attempt, last_error) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                outbox["group_name"],
+                str(notification_id),
+                json.dumps(post),
+                now,
+                0 if error is None else 1,
+                now if error is None else now + retry_delay,
+                None if error is None else str(error),
+            ),
+        )
+
+
+def count_posts(outbox):
+    """Return the number of posts waiting in the outbox"""
+    state_store = outbox["state_store"]
+    with state_store["lock"]:
+        return (
+            state_store["connection"]
+            .execute(
+                "SELECT COUNT(*) FROM outbox WHERE group_name = ?",
+                (outbox["group_name"],),
+            )
+            .fetchone()[0]
+        )
+
+
+def queued_posts(outbox):
+    """Return the posts waiting in the outbox, oldest first.
+
+    Every post is a dictionary holding the fields given to queue_post().
+    Its "media" are QueuedMedia objects. "attempts" counts how often it has
+    failed, "next_attempt" is the time it may be tried again and
+    "last_error" why it failed last."""
+    state_store = outbox["state_store"]
+    with state_store["lock"]:
+        rows = (
+            state_store["connection"]
+            .execute(
+                "SELECT sequence, notification_id, post, queued, attempts, "
+                + "next_attempt, last_error FROM outbox WHERE group_name = ? "
+                + "ORDER BY sequence",
+                (outbox["group_name"],),
+            )
+            .fetchall()
+        )
+    posts = []
+    for row in rows:
+        post = json.loads(row[2])
+        post["media"] = [
+            QueuedMedia(
+                media["url"], media["description"], media["file"], media["mime_type"]
+            )
+            for media in post["media"]
+        ]
+        post.update(
+            sequence=row[0],
+            notification_id=row[1],
+            queued=row[3],
+            attempts=row[4],
+            next_attempt=row[5],
+            last_error=row[6],
+        )
+        posts.append(post)
+    return posts
+
+
+def keep_uploads(outbox, post, uploads):
+    """Remember the media IDs a queued post's attachments have been uploaded
+    with, so the next attempt can reuse them."""
+    post["uploads"] = [str(media_id) for media_id in uploads]
+    post["uploaded"] = time.time()
+    _update_post(outbox, post)
+
+
+def postpone(outbox, post, error, retry_delay, max_delay):
+    """Note that publishing a queued post has failed again.
+
+    "retry_delay", "max_delay" the waiting time starts with "retry_delay"
+    seconds and doubles with every failure up to "max_delay"
+
+    Returns the number of seconds until the post is tried again."""
+    post["attempts"] += 1
+    delay = min(max_delay, retry_delay * 2 ** max(0, post["attempts"] - 1))
+    post["next_attempt"] = time.time() + delay
+    post["last_error"] = str(error)
+    _update_post(outbox, post)
+    return delay
+
+
+def remove_post(outbox, post):
+    """Remove a post that has been published or given up, with its files"""
+    state_store = outbox["state_store"]
+    with state_store["lock"]:
+        state_store["connection"].execute(
+            "DELETE FROM outbox WHERE sequence = ?", (post["sequence"],)
+        )
+    for media in post["media"]:
+        if media.file is not None:
+            try:
+                os.unlink(media.file)
+            except Exception:
+                pass  # cannot delete, probably non-existant anyway!
+
+
+def _update_post(outbox, post):
+    stored = {
+        field: post[field]
+        for field in ("status", "visibility", "spoiler_text", "sensitive")
+    }
+    stored["media"] = [
+        {
+            "url": media.url,
+            "description": media.description,
+            "file": media.file,
+            "mime_type": media.mime_type,
+        }
+        for media in post["media"]
+    ]
+    stored["uploads"] = post["uploads"]
+    stored["uploaded"] = post["uploaded"]
+    state_store = outbox["state_store"]
+    with state_store["lock"]:
+        state_store["connection"].execute(
+            "UPDATE outbox SET post = ?, attempts = ?, next_attempt = ?, "
+            + "last_error = ? WHERE sequence = ?",
+            (
+                json.dumps(stored),
+                post["attempts"],
+                post["next_attempt"],
+                post["last_error"],
+                post["sequence"],
+            ),
+        )
+
+
+def media_file_name(outbox, notification_id, index):
+    """Return where a media file of a post is kept in the outbox's directory.
+
+    "notification_id" ID of the notification the post is made for
+
+    "index" position of the media file among the post's attachments"""
+    return outbox["directory"] + str(notification_id) + "-" + str(index)
+
+
+def keep_media_file(file_name, media_file):
+    """Keep a media file of a post that might end up in the outbox.
+
+    "file_name" where to keep it, see media_file_name()
+
+    "media_file" file object holding the media data. It is read from its
+    current position to the end. Files opened from disk, e.g. from the
+    media cache, are linked instead if possible.
+
+    Returns True if the file has been kept."""
+    source = getattr(media_file, "name", None)
+    f_temp = None
+    try:
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        if isinstance(source, str) and media_file.tell() == 0:
+            try:
+                os.unlink(file_name)
+            except FileNotFoundError:
+                pass
+            try:
+                os.link(source, file_name)
+                return True
+            except OSError:
+                pass  # copy it below
+        f_temp = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(file_name), suffix=".tmp", delete=False
+        )
+        with f_temp:
+            shutil.copyfileobj(media_file, f_temp)
+        os.replace(f_temp.name, file_name)
+    except Exception as ex:
+        if f_temp is not None:
+            try:
+                os.unlink(f_temp.name)
+            except Exception:
+                pass  # cannot delete, probably non-existant anyway!
+        print("Cannot keep media file in the outbox: " + str(ex))
+        return False
+    return True
+
+
+def discard_media_files(outbox, notification_id, count):
+    """Remove the media files kept for a post that has not been queued.
+
+    "count" number of the post's attachments"""
+    for index in range(count):
+        try:
+            os.unlink(media_file_name(outbox, notification_id, index))
+        except Exception:
+            pass  # cannot delete, probably non-existant anyway!
+
+
+def _keep_file(outbox, notification_id, index, file_name):
+    """Put a media file into the outbox's directory.
+
+    The file is linked if possible and copied otherwise. Returns the kept
+    file's name or None if it could not be kept."""
+    kept_file = media_file_name(outbox, notification_id, index)
+    if file_name == kept_file:
+        return kept_file
+    try:
+        os.makedirs(outbox["directory"], exist_ok=True)
+        try:
+            os.unlink(kept_file)
+        except FileNotFoundError:
+            pass
+        try:
+            os.link(file_name, kept_file)
+        except OSError:
+            shutil.copyfile(file_name, kept_file)
+    except Exception as ex:
+        print("Cannot keep media file in the outbox: " + str(ex))
+        return None
+    return kept_file
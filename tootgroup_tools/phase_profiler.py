@@ -0,0 +1,132 @@
+"""Measures how much time a run spends in each of its phases.
+
+Code marks its phases with phase() or the timed() decorator. As long as
+profiling has not been started, this costs a single check. Once started,
+wall clock time is summed up per phase and thread. Phases can be nested,
+the time of an inner phase is not counted for the outer one.
+
+With the asyncio engine, phases run in several threads at the same time.
+Their times then add up to more than the run's wall clock time.
+
+Optionally, the main thread is profiled with cProfile as well and the
+statistics are written to a file for analysis with pstats."""
+
+import contextlib
+import cProfile
+import functools
+import threading
+import time
+
+_enabled = False
+_started = 0.0
+_profile = None
+_profile_file = None
+_phases = {}
+_phases_lock = threading.Lock()
+_thread_state = threading.local()
+
+
+def start(profile_file=None):
+    """Start measuring phases.
+
+    "profile_file" if given, the main thread is profiled with cProfile and
+    its statistics are written to this file by finish()."""
+    global _enabled, _started, _profile, _profile_file
+    _enabled = True
+    _started = time.perf_counter()
+    if profile_file:
+        _profile_file = profile_file
+        _profile = cProfile.Profile()
+        _profile.enable()
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Count the time spent in the with block for the named phase"""
+    if not _enabled:
+        yield
+        return
+    stack = getattr(_thread_state, "stack", None)
+    if stack is None:
+        stack = _thread_state.stack = []
+    now = time.perf_counter()
+    if stack:
+        # The outer phase pauses while the inner one is running
+        _add(stack[-1][0], now - stack[-1][1])
+    stack.append([name, now])
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        _add(name, now - stack.pop()[1], count=1)
+        if stack:
+            stack[-1][1] = now
+
+
+def timed(name):
+    """Decorator counting the time spent in a function for the named phase"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _add(name, seconds, count=0):
+    with _phases_lock:
+        entry = _phases.setdefault(name, {"seconds": 0.0, "count": 0})
+        entry["seconds"] += seconds
+        entry["count"] += count
+
+
+def finish():
+    """Stop measuring and print the time spent per phase.
+
+    Everything that has not been marked as a phase is shown as "other". The
+    cProfile statistics are written now if they have been asked for."""
+    global _enabled, _profile
+    if not _enabled:
+        return
+    _enabled = False
+    wall_time = time.perf_counter() - _started
+    if _profile is not None:
+        _profile.disable()
+        try:
+            _profile.dump_stats(_profile_file)
+        except Exception as ex:
+            print("Cannot write profile statistics: " + str(ex))
+        _profile = None
+
+    with _phases_lock:
+        phases = dict(_phases)
+    measured = sum(entry["seconds"] for entry in phases.values())
+
+    print("")
+    print("tootgroup.py profile - time spent per phase:")
+    for name, entry in phases.items():
+        print(
+            "  %-22s %9.3f s %6.1f %%  %6d x"
+            % (
+                name,
+                entry["seconds"],
+                _percent(entry["seconds"], wall_time),
+                entry["count"],
+            )
+        )
+    if measured < wall_time:
+        print(
+            "  %-22s %9.3f s %6.1f %%"
+            % ("other", wall_time - measured, _percent(wall_time - measured, wall_time))
+        )
+    print("  %-22s %9.3f s" % ("wall clock time", wall_time))
+    if _profile_file:
+        print("Profile statistics have been written to " + _profile_file)
+
+
+def _percent(part, whole):
+    return 100.0 * part / whole if whole > 0 else 0.0
@@ -0,0 +1,218 @@
+"""Paces the requests sent to Fediverse servers to stay within rate limits.
+
+Mastodon allows a fixed number of API requests per period and announces
+how many are left with every response (X-RateLimit-Remaining and
+X-RateLimit-Reset). Without pacing, a busy group uses up its limit, gets
+rejected with HTTP 429 and then waits for the period to end.
+
+The numbers a server announces are counted per account. Here, every
+account of a server gets a bucket of request tokens, which is corrected
+with the numbers of every response for that account. Each API request
+takes a token before it is sent. While more than PACING_SHARE of the limit
+is left, requests are sent right away. Below that, the remaining tokens are
+spread evenly over the rest of the period, so requests keep flowing instead
+of stopping at the limit. Groups on the same server do not hold each other
+back, as each of them has its own account.
+
+Media uploads have a much tighter limit in Mastodon and get a bucket of
+their own. Requests outside of the API, like media downloads, are not
+paced at all.
+
+The server's clock can differ from the local one. Announced reset times
+are corrected with the server's Date header, and a new period is only
+assumed to have begun RESET_MARGIN seconds after that."""
+
+import email.utils
+import hashlib
+import threading
+import time
+import urllib.parse
+
+from tootgroup_tools import api_metrics
+
+# Mastodon's defaults, used until a server announces its own limits.
+# (requests per period, period in seconds)
+DEFAULT_LIMITS = {
+    "api": (300, 300.0),
+    "media": (30, 1800.0),
+}
+
+# Requests are spread evenly once less than this share of the limit is left
+PACING_SHARE = 0.5
+
+# Longest single wait, so waiting threads notice corrected limits
+MAX_WAIT = 10.0
+
+# Seconds to wait after a period should have ended before sending again.
+# Date headers are only precise to the second.
+RESET_MARGIN = 1.0
+
+# How often a request that has been rejected anyway is sent again
+MAX_RETRIES = 2
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def request_kind(method, url):
+    """Return which bucket a request takes its token from, or None if it
+    is not paced"""
+    path = urllib.parse.urlsplit(url).path
+    if not path.startswith("/api/"):
+        return None
+    if method == "POST" and path.rstrip("/") in ("/api/v1/media", "/api/v2/media"):
+        return "media"
+    return "api"
+
+
+def account_key(headers):
+    """Return what tells the accounts sending requests apart.
+
+    "headers" headers of a request
+
+    The access token is not kept, only a hash of it. Requests without one
+    all count for the same, anonymous account."""
+    authorization = headers.get("Authorization")
+    if not authorization:
+        return ""
+    return hashlib.sha256(authorization.encode()).hexdigest()[:16]
+
+
+def _bucket(key, kind, now):
+    """Return a bucket, refilled if its period is over.
+
+    "key" (host, kind, account) of the bucket
+
+    Must be called with _buckets_lock held."""
+    bucket = _buckets.get(key)
+    if bucket is None:
+        limit, period = DEFAULT_LIMITS[kind]
+        bucket = _buckets[key] = {
+            "limit": limit,
+            "period": period,
+            "remaining": limit,
+            "reset": now + period,
+            "next_request": now,
+            # True once the server has announced its own numbers
+            "announced": False,
+        }
+    if now >= bucket["reset"]:
+        bucket["remaining"] = bucket["limit"]
+        bucket["reset"] = now + bucket["period"]
+        bucket["next_request"] = now
+    return bucket
+
+
+def acquire(method, url, account=""):
+    """Wait until a request may be sent and take a token for it.
+
+    "method" HTTP method of the request
+
+    "url" full URL of the request
+
+    "account" who sends the request, see account_key()
+
+    This can be called from any thread. Returns the seconds waited."""
+    kind = request_kind(method, url)
+    if kind is None:
+        return 0.0
+    key = (urllib.parse.urlsplit(url).netloc, kind, account)
+    waited = 0.0
+    while True:
+        with _buckets_lock:
+            now = time.time()
+            bucket = _bucket(key, kind, now)
+            delay = _delay(bucket, now)
+            if delay <= 0:
+                bucket["remaining"] -= 1
+                # Spread the rest of the tokens over the rest of the period
+                bucket["next_request"] = now + (bucket["reset"] - now) / (
+                    bucket["remaining"] + 1
+                )
+                return waited
+        delay = min(max(delay, 0.01), MAX_WAIT)
+        time.sleep(delay)
+        waited += delay
+
+
+def _delay(bucket, now):
+    """Return the seconds until a bucket allows the next request"""
+    if bucket["remaining"] <= 0:
+        return bucket["reset"] - now
+    if bucket["remaining"] > bucket["limit"] * PACING_SHARE:
+        return 0.0
+    return bucket["next_request"] - now
+
+
+def record_response(response):
+    """Correct an account's bucket with the limits announced by a response.
+
+    The first numbers of an account replace the defaults. After that, they
+    are only trusted downwards within a period, as requests sent meanwhile
+    are not contained in them yet. A rejected request empties the bucket
+    until the server's period ends."""
+    request = response.request
+    kind = request_kind(request.method, request.url)
+    if kind is None:
+        return
+    rate_limit = api_metrics.rate_limit_headers(response.headers)
+    retry_after = _retry_after(response)
+    if rate_limit is None and retry_after is None:
+        return
+
+    host = urllib.parse.urlsplit(request.url).netloc
+    with _buckets_lock:
+        now = time.time()
+        bucket = _bucket((host, kind, account_key(request.headers)), kind, now)
+        if rate_limit is not None:
+            if rate_limit["limit"] > 0:
+                bucket["limit"] = rate_limit["limit"]
+            reset = rate_limit["reset"]
+            if reset is not None:
+                reset += _clock_offset(response, now) + RESET_MARGIN
+            if reset is not None and reset > now:
+                if (
+                    not bucket["announced"]
+                    or reset > bucket["reset"] + 2 * RESET_MARGIN
+                ):
+                    # The defaults were only a guess, or the server has
+                    # started a new period
+                    bucket["remaining"] = rate_limit["remaining"]
+                else:
+                    bucket["remaining"] = min(
+                        bucket["remaining"], rate_limit["remaining"]
+                    )
+                bucket["reset"] = reset
+            else:
+                bucket["remaining"] = min(bucket["remaining"], rate_limit["remaining"])
+            bucket["announced"] = True
+        if response.status_code == 429:
+            bucket["remaining"] = 0
+            if retry_after is not None:
+                bucket["reset"] = max(bucket["reset"], now + retry_after + RESET_MARGIN)
+
+
+def _clock_offset(response, now):
+    """Return how far the local clock is ahead of the server's"""
+    try:
+        return (
+            now
+            - email.utils.parsedate_to_datetime(response.headers["Date"]).timestamp()
+        )
+    except Exception:
+        return 0.0
+
+
+def _retry_after(response):
+    """Return the seconds a 429 response asks to wait, or None"""
+    if response.status_code != 429 or "Retry-After" not in response.headers:
+        return None
+    value = response.headers["Retry-After"]
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+    except Exception:
+        return None
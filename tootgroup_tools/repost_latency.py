@@ -0,0 +1,236 @@
+"""Traces how long members wait until their notifications are reposted.
+
+For every notification that is fetched, the time it has been created on
+the server and the time it has been fetched are kept. When its boost,
+post or reply is done, the three timestamps make up one trace:
+
+- "latency" from the notification's creation until the action is done,
+  which is what the member experiences
+- "fetch_delay" from its creation until tootgroup.py has fetched it,
+  mostly the polling interval
+- "processing" from the fetch until the action is done
+
+The "backlog_age" of a group is the age of the oldest notification at the
+time a pass over its notifications fetched it. It is 0 if there was
+nothing new.
+
+The numbers are exported together with the request statistics of
+api_metrics: as latency percentiles of the recent traces and the last
+backlog age per group for Prometheus, and as one JSON line per trace and
+a summary per group in the JSON lines file."""
+
+import collections
+import datetime
+import threading
+import time
+
+# Percentiles exported per group
+QUANTILES = (0.5, 0.9, 0.99)
+
+# Number of recent traces per group the percentiles are computed from
+SAMPLE_WINDOW = 1000
+
+_latency_lock = threading.Lock()
+# Notifications fetched by the current pass, by group and notification ID
+_fetched = {}
+# Recent traces by group
+_samples = {}
+# Number of traces and sums of their times since the process started, by
+# group
+_totals = {}
+# Backlog age of the last pass by group
+_backlog_ages = {}
+# Traces and backlog ages since the last JSON line
+_unreported_traces = []
+_unreported_backlog_ages = {}
+
+
+def record_fetch(group_name, notifications, fetched=None):
+    """Remember when notifications have been fetched.
+
+    "group_name" handle of the group
+
+    "notifications" the notifications as returned by the Fediverse server
+
+    "fetched" time they have been received, now if not given"""
+    if fetched is None:
+        fetched = time.time()
+    with _latency_lock:
+        pending = _fetched.setdefault(group_name, {})
+        for notification in notifications:
+            created = _timestamp(getattr(notification, "created_at", None))
+            if created is not None:
+                pending.setdefault(str(notification.id), (created, fetched))
+
+
+def record_action(group_name, notification_id, action_type, finished=None):
+    """Complete the trace of a notification whose action is done.
+
+    "group_name" handle of the group
+
+    "notification_id" ID of the notification the action has been taken for
+
+    "action_type" "reblog", "post" or "reply"
+
+    "finished" time the action has been done, now if not given
+
+    Nothing is traced for notifications record_fetch() has not seen."""
+    if finished is None:
+        finished = time.time()
+    with _latency_lock:
+        fetch = _fetched.get(group_name, {}).pop(str(notification_id), None)
+        if fetch is None:
+            return
+        created, fetched = fetch
+        trace = {
+            "group": group_name,
+            "notification_id": str(notification_id),
+            "action": action_type,
+            "created_at": created,
+            "fetched_at": fetched,
+            "finished_at": finished,
+            "latency": max(0.0, finished - created),
+            "fetch_delay": max(0.0, fetched - created),
+            "processing": max(0.0, finished - fetched),
+        }
+        samples = _samples.setdefault(
+            group_name, collections.deque(maxlen=SAMPLE_WINDOW)
+        )
+        samples.append(trace)
+        total = _totals.setdefault(
+            group_name, {"count": 0, "latency": 0.0, "fetch_delay": 0.0}
+        )
+        total["count"] += 1
+        total["latency"] += trace["latency"]
+        total["fetch_delay"] += trace["fetch_delay"]
+        _unreported_traces.append(trace)
+
+
+def finish_pass(group_name):
+    """Note the backlog age of a pass and forget its fetched notifications.
+
+    Has to be called after every pass over a group's notifications."""
+    with _latency_lock:
+        pending = _fetched.pop(group_name, {})
+        backlog_age = max(
+            (max(0.0, fetched - created) for created, fetched in pending.values()),
+            default=0.0,
+        )
+        _backlog_ages[group_name] = backlog_age
+        _unreported_backlog_ages[group_name] = max(
+            backlog_age, _unreported_backlog_ages.get(group_name, 0.0)
+        )
+
+
+def percentile(values, quantile):
+    """Return the quantile of a list of numbers by the nearest rank method"""
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    rank = min(len(values) - 1, max(0, int(quantile * len(values) + 0.999999) - 1))
+    return values[rank]
+
+
+def summary(traces):
+    """Return percentiles and maximum of the latencies of some traces"""
+    result = {"count": len(traces)}
+    for field in ("latency", "fetch_delay", "processing"):
+        values = [trace[field] for trace in traces]
+        result[field] = {
+            "p" + str(int(quantile * 100)): percentile(values, quantile)
+            for quantile in QUANTILES
+        }
+        result[field]["max"] = max(values, default=None)
+    return result
+
+
+def prometheus_lines(labels):
+    """Return the latency metrics in the Prometheus text exposition format.
+
+    "labels" function formatting labels, see api_metrics"""
+    with _latency_lock:
+        samples = {group: list(traces) for group, traces in _samples.items()}
+        totals = {group: dict(total) for group, total in _totals.items()}
+        backlog_ages = dict(_backlog_ages)
+
+    lines = []
+    for field, help_text in (
+        ("latency", "Time from a notification's creation until its action was done."),
+        ("fetch_delay", "Time from a notification's creation until it was fetched."),
+    ):
+        name = "tootgroup_repost_" + field + "_seconds"
+        lines.append("# HELP " + name + " " + help_text)
+        lines.append("# TYPE " + name + " summary")
+        for group, traces in sorted(samples.items()):
+            values = [trace[field] for trace in traces]
+            for quantile in QUANTILES:
+                lines.append(
+                    name
+                    + labels(group=group, quantile=quantile)
+                    + " "
+                    + repr(percentile(values, quantile))
+                )
+            lines.append(
+                name + "_sum" + labels(group=group) + " " + repr(totals[group][field])
+            )
+            lines.append(
+                name
+                + "_count"
+                + labels(group=group)
+                + " "
+                + str(totals[group]["count"])
+            )
+
+    lines.append(
+        "# HELP tootgroup_backlog_age_seconds Age of the oldest new notification "
+        + "when the last pass fetched it."
+    )
+    lines.append("# TYPE tootgroup_backlog_age_seconds gauge")
+    for group, backlog_age in sorted(backlog_ages.items()):
+        lines.append(
+            "tootgroup_backlog_age_seconds"
+            + labels(group=group)
+            + " "
+            + repr(backlog_age)
+        )
+    return lines
+
+
+def json_lines(now):
+    """Return the traces and a summary per group since the last call.
+
+    "now" time the lines are written"""
+    with _latency_lock:
+        traces = list(_unreported_traces)
+        del _unreported_traces[:]
+        backlog_ages = dict(_unreported_backlog_ages)
+        _unreported_backlog_ages.clear()
+
+    lines = []
+    by_group = {}
+    for trace in traces:
+        line = {"type": "repost", "time": now}
+        line.update(trace)
+        lines.append(line)
+        by_group.setdefault(trace["group"], []).append(trace)
+    for group in sorted(set(by_group) | set(backlog_ages)):
+        line = {"type": "repost_latency", "time": now, "group": group}
+        line.update(summary(by_group.get(group, [])))
+        line["backlog_age"] = backlog_ages.get(group)
+        lines.append(line)
+    return lines
+
+
+def _timestamp(value):
+    """Return a notification's "created_at" in seconds since the epoch.
+
+    Mastodon.py returns datetimes, the built-in REST client ISO 8601
+    strings. Returns None for anything else."""
+    try:
+        if isinstance(value, str):
+            value = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.timestamp()
+    except Exception:
+        return None
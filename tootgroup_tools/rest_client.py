@@ -0,0 +1,307 @@
+"""A minimal client for the few Mastodon API endpoints tootgroup.py uses.
+
+Mastodon.py covers the complete API and turns every response into typed
+entities. This makes it slow to import and to parse long notification or
+member lists, which is noticeable for runs started by cron every few
+minutes. This client only knows what tootgroup.py needs: verifying the
+group account, its following list and relationships, notifications,
+reblogs, new statuses and media uploads.
+
+Its methods are named and called like Mastodon.py's, so tootgroup.py can
+use either of them. Responses are returned as Entity dictionaries whose
+keys can be read as attributes, too. The streaming API and setting up new
+groups still need Mastodon.py.
+
+The client is used for a group if "api_client = builtin" is set in its
+section of the config file."""
+
+import os
+import re
+
+# Seconds to wait for a response, the same as Mastodon.py
+REQUEST_TIMEOUT = 300
+
+USER_AGENT = "tootgroup.py"
+
+_NEXT_LINK_PATTERN = re.compile(r'<([^>]+)>\s*;\s*rel="next"')
+
+# Characters escaped in names of form fields and files
+_QUOTED_CHARACTER_PATTERN = re.compile(r'["\x00-\x1a\x1c-\x1f]')
+
+
+class Entity(dict):
+    """A JSON object whose keys can also be read as attributes"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+class ApiError(Exception):
+    """The server answered a request with an error"""
+
+    def __init__(self, status_code, reason, message):
+        super().__init__("Mastodon API returned error", status_code, reason, message)
+        self.status_code = status_code
+
+
+class UnauthorizedError(ApiError):
+    """The server did not accept the group's access token"""
+
+
+class MultipartBody:
+    """A multipart/form-data request body that reads a file while it is sent.
+
+    "fields" dictionary of form fields sent before the file
+
+    "name", "file_name", "mime_type" form field, name and type of the file
+
+    "media_file" file object to upload, from its current position
+
+    requests builds bodies given as "files" in memory, so a big upload
+    needs its size in memory once more. This body only keeps the form
+    fields in memory. Its length is known up front, so it is sent with a
+    Content-Length header like any other upload. It can be rewound to send
+    it again."""
+
+    def __init__(self, fields, name, file_name, media_file, mime_type):
+        self.boundary = os.urandom(16).hex()
+        head = b""
+        for field, value in fields.items():
+            head += self._part_header(field)
+            head += b"\r\n\r\n" + str(value).encode() + b"\r\n"
+        head += self._part_header(name)
+        head += b'; filename="' + _quote(file_name).encode() + b'"\r\n'
+        head += b"Content-Type: " + (mime_type or "application/octet-stream").encode()
+        head += b"\r\n\r\n"
+        self.content_type = "multipart/form-data; boundary=" + self.boundary
+        self._head = head
+        self._tail = b"\r\n--" + self.boundary.encode() + b"--\r\n"
+        self._file = media_file
+        self._file_start = media_file.tell()
+        media_file.seek(0, os.SEEK_END)
+        self._file_size = media_file.tell() - self._file_start
+        self.seek(0)
+
+    def _part_header(self, field):
+        return (
+            b"--"
+            + self.boundary.encode()
+            + b'\r\nContent-Disposition: form-data; name="'
+            + _quote(field).encode()
+            + b'"'
+        )
+
+    def __len__(self):
+        return len(self._head) + self._file_size + len(self._tail)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(64 * 1024)
+            if not chunk:
+                return
+            yield chunk
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self._position
+        elif whence == os.SEEK_END:
+            position += len(self)
+        self._position = max(0, min(position, len(self)))
+        file_position = min(max(0, self._position - len(self._head)), self._file_size)
+        self._file.seek(self._file_start + file_position)
+        return self._position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self) - self._position
+        chunks = []
+        while size > 0 and self._position < len(self):
+            file_end = len(self._head) + self._file_size
+            if self._position < len(self._head):
+                chunk = self._head[self._position : self._position + size]
+            elif self._position < file_end:
+                chunk = self._file.read(min(size, file_end - self._position))
+                if not chunk:
+                    raise IOError("Media file got shorter while uploading it")
+            else:
+                start = self._position - file_end
+                chunk = self._tail[start : start + size]
+            chunks.append(chunk)
+            self._position += len(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+
+class Page(list):
+    """A page of results and the URL of the next one, or None"""
+
+    def __init__(self, items, next_url):
+        super().__init__(items)
+        self.next_url = next_url
+
+
+class RestClient:
+    """Sends requests to the Mastodon API for one group account.
+
+    "api_base_url" URL of the group's server
+
+    "access_token" the group's access token or the name of a file holding
+    it in its first line, like the ones written by Mastodon.py
+
+    "session" requests.Session to send the requests with"""
+
+    def __init__(self, api_base_url, access_token, session):
+        if "://" not in api_base_url:
+            api_base_url = "https://" + api_base_url
+        self.api_base_url = api_base_url.rstrip("/")
+        try:
+            with open(access_token, "r") as token_file:
+                access_token = token_file.readline().rstrip()
+        except OSError:
+            pass  # the token itself has been given
+        self.session = session
+        self.headers = {
+            "Authorization": "Bearer " + access_token,
+            "User-Agent": USER_AGENT,
+        }
+
+    def _request(
+        self,
+        method,
+        path,
+        params=None,
+        data=None,
+        headers=None,
+        timeout=REQUEST_TIMEOUT,
+    ):
+        url = path if "://" in path else self.api_base_url + path
+        if headers is not None:
+            headers = dict(self.headers, **headers)
+        response = self.session.request(
+            method,
+            url,
+            params=params,
+            data=data,
+            headers=headers or self.headers,
+            timeout=timeout,
+        )
+        if not response.ok:
+            try:
+                message = response.json()["error"]
+            except Exception:
+                message = None
+            if response.status_code == 401:
+                raise UnauthorizedError(response.status_code, response.reason, message)
+            raise ApiError(response.status_code, response.reason, message)
+        return response
+
+    def _get(self, path, params=None):
+        return self._request("GET", path, params).json(object_hook=Entity)
+
+    def _post(self, path, data=None, headers=None, timeout=REQUEST_TIMEOUT):
+        return self._request(
+            "POST", path, data=data, headers=headers, timeout=timeout
+        ).json(object_hook=Entity)
+
+    def account_verify_credentials(self):
+        return self._get("/api/v1/accounts/verify_credentials")
+
+    def instance(self):
+        return self._get("/api/v1/instance")
+
+    def account_following(self, id, limit=None):
+        params = {} if limit is None else {"limit": limit}
+        response = self._request("GET", "/api/v1/accounts/%s/following" % id, params)
+        return Page(response.json(object_hook=Entity), _next_url(response))
+
+    def account_relationships(self, id):
+        return self._get("/api/v1/accounts/relationships", {"id[]": id})
+
+    def fetch_remaining(self, first_page):
+        """Return the items of the given page and all pages after it"""
+        items = list(first_page)
+        next_url = first_page.next_url
+        while next_url is not None:
+            response = self._request("GET", next_url)
+            items.extend(response.json(object_hook=Entity))
+            next_url = _next_url(response)
+        return items
+
+    def notifications(self, min_id=None, limit=None, types=None, exclude_types=None):
+        params = {}
+        if min_id is not None:
+            params["min_id"] = min_id
+        if limit is not None:
+            params["limit"] = limit
+        if types is not None:
+            params["types[]"] = types
+        if exclude_types is not None:
+            params["exclude_types[]"] = exclude_types
+        return self._get("/api/v1/notifications", params)
+
+    def status_reblog(self, id):
+        return self._post("/api/v1/statuses/%s/reblog" % id)
+
+    def status_post(
+        self,
+        status,
+        in_reply_to_id=None,
+        media_ids=None,
+        sensitive=False,
+        visibility=None,
+        spoiler_text=None,
+    ):
+        data = {"status": status}
+        if in_reply_to_id is not None:
+            data["in_reply_to_id"] = in_reply_to_id
+        if media_ids:
+            data["media_ids[]"] = [
+                media["id"] if isinstance(media, dict) else media for media in media_ids
+            ]
+        if sensitive:
+            data["sensitive"] = "true"
+        if visibility:
+            data["visibility"] = visibility
+        if spoiler_text:
+            data["spoiler_text"] = spoiler_text
+        return self._post("/api/v1/statuses", data=data)
+
+    def media_post(
+        self,
+        media_file,
+        mime_type=None,
+        description=None,
+        file_name=None,
+        timeout=REQUEST_TIMEOUT,
+    ):
+        fields = {}
+        if description is not None:
+            fields["description"] = description
+        body = MultipartBody(
+            fields, "file", file_name or "media", media_file, mime_type
+        )
+        return self._post(
+            "/api/v2/media",
+            data=body,
+            headers={"Content-Type": body.content_type},
+            timeout=timeout,
+        )
+
+
+def _quote(value):
+    """Escape a name for a Content-Disposition header like requests does"""
+    return _QUOTED_CHARACTER_PATTERN.sub(
+        lambda match: "%%%02X" % ord(match.group()), value
+    )
+
+
+def _next_url(response):
+    """Return the URL of the next page a response links to, or None"""
+    match = _NEXT_LINK_PATTERN.search(response.headers.get("Link", ""))
+    return match.group(1) if match else None
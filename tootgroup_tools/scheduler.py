@@ -0,0 +1,61 @@
+"""Adaptive polling schedule for serving many groups from one process.
+
+Every group gets a schedule entry holding its current polling interval.
+Groups with new notifications are polled more often, idle groups back
+off until they reach their maximum interval. This way quiet groups cost
+almost nothing while busy groups see a low repost latency."""
+
+import time
+
+# Default polling intervals in seconds. They can be overridden per group
+# with "poll_interval_min" and "poll_interval_max" in the config file.
+DEFAULT_MIN_INTERVAL = 60.0
+DEFAULT_MAX_INTERVAL = 900.0
+
+# Factor by which the interval of an idle group grows after each poll
+BACKOFF_FACTOR = 1.5
+
+
+def new_schedule_entry(group_name, min_interval, max_interval):
+    """Create the schedule entry for a group.
+
+    "group_name" handle of the group this entry belongs to
+
+    "min_interval", "max_interval" bounds for the polling interval in seconds
+
+    New entries start with the shortest interval and are due immediately."""
+    min_interval = max(1.0, min_interval)
+    max_interval = max(min_interval, max_interval)
+    return {
+        "group_name": group_name,
+        "min_interval": min_interval,
+        "max_interval": max_interval,
+        "interval": min_interval,
+        "next_run": time.monotonic(),
+    }
+
+
+def next_due(schedule):
+    """Return the schedule entry that has to be polled next"""
+    return min(schedule, key=lambda entry: entry["next_run"])
+
+
+def reschedule(entry, activity):
+    """Adapt a group's polling interval after it has been polled.
+
+    "entry" the group's schedule entry
+
+    "activity" number of new notifications found during the last poll
+
+    Every new notification shortens the interval, down to the configured
+    minimum. If nothing happened, the interval grows by BACKOFF_FACTOR up
+    to the configured maximum."""
+    if activity > 0:
+        entry["interval"] = max(
+            entry["min_interval"], entry["interval"] / (1 + activity)
+        )
+    else:
+        entry["interval"] = min(
+            entry["max_interval"], entry["interval"] * BACKOFF_FACTOR
+        )
+    entry["next_run"] = time.monotonic() + entry["interval"]
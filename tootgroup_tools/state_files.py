@@ -0,0 +1,60 @@
+"""Reads and writes small JSON files holding state between runs.
+
+Files are always replaced atomically. An interrupted write can therefore
+never leave a broken state file behind."""
+
+import json
+import os
+import tempfile
+
+
+def state_file_name(config_store, group_name, kind):
+    """Return the file name for a group's state of the given kind.
+
+    State files are stored next to the configuration file and named like
+    the group's credential files, e.g. "GROUP_members.json"."""
+    return config_store["directory"] + group_name + "_" + kind + ".json"
+
+
+def read_json(file_name):
+    """Return the content of a JSON file or None if it cannot be read"""
+    try:
+        with open(file_name, "r", encoding="utf-8") as statefile:
+            return json.load(statefile)
+    except Exception:
+        return None
+
+
+def write_json(file_name, data):
+    """Atomically replace a JSON file with new data"""
+    write_text(file_name, json.dumps(data))
+
+
+def write_text(file_name, text):
+    """Atomically replace a text file with new content.
+
+    The content is written to a temporary file in the same directory first,
+    which is then moved over the old file."""
+    f_temp = tempfile.NamedTemporaryFile(
+        mode="w",
+        encoding="utf-8",
+        dir=os.path.dirname(file_name) or ".",
+        prefix=os.path.basename(file_name) + ".",
+        suffix=".tmp",
+        delete=False,
+    )
+    try:
+        with f_temp:
+            f_temp.write(text)
+        try:
+            # Keep the permissions of the file being replaced
+            os.chmod(f_temp.name, os.stat(file_name).st_mode & 0o7777)
+        except OSError:
+            pass  # new file, it stays readable by its owner only
+        os.replace(f_temp.name, file_name)
+    except Exception:
+        try:
+            os.unlink(f_temp.name)
+        except Exception:
+            pass  # cannot delete, probably non-existant anyway!
+        raise
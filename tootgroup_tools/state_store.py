@@ -0,0 +1,279 @@
+"""Keeps the progress of a group in a small SQLite database.
+
+For every group, the database holds the ID of the last notification that
+has been seen and the IDs of the notifications that have been taken care
+of after it. Processed notifications are recorded in batches, every batch
+is written in a single transaction. An interrupted run therefore never
+leaves a half written state behind, and the next run skips everything the
+interrupted one has already done. Notifications whose actions failed are
+counted, so they can be given up after some attempts.
+
+Every group has a database of its own, "GROUP_state.sqlite" next to the
+configuration file. Runs for different groups therefore never touch the
+same file and a run only reads its own group's progress, no matter how
+many groups are configured. Up to tootgroup.py 1.5, the last seen ID was
+kept in the config file, which had to be rewritten by every run. It is
+taken over from there the first time a group's progress is loaded."""
+
+import sqlite3
+import sys
+import threading
+import time
+
+import tootgroup_tools
+
+# Appended to the group's name to get its database's file name
+DATABASE_FILE_SUFFIX = "_state.sqlite"
+
+# Default number of processed notifications that are written in one
+# transaction. It can be overridden per group with "state_commit_batch".
+DEFAULT_COMMIT_BATCH = 20
+
+# Seconds to wait for another process that is writing the database
+LOCK_TIMEOUT = 30.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS groups (
+    group_name TEXT PRIMARY KEY,
+    last_seen_id TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS processed (
+    group_name TEXT NOT NULL,
+    notification_id TEXT NOT NULL,
+    processed REAL NOT NULL,
+    PRIMARY KEY (group_name, notification_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS failures (
+    group_name TEXT NOT NULL,
+    notification_id TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    PRIMARY KEY (group_name, notification_id)
+) WITHOUT ROWID;
+"""
+
+# Stores that have been opened by this process, by file name
+_state_stores = {}
+_state_stores_lock = threading.Lock()
+
+
+def get_state_store(config_store, group_name):
+    """Return the state store of a group.
+
+    "config_store" dictionary containting config file name and path
+
+    "group_name" handle of the group
+
+    The database is opened only once per process. tootgroup.py cannot keep
+    track of its progress without it, so failing to open it is fatal."""
+    file_name = config_store["directory"] + group_name + DATABASE_FILE_SUFFIX
+    with _state_stores_lock:
+        if file_name not in _state_stores:
+            try:
+                _state_stores[file_name] = open_state_store(file_name)
+            except Exception as ex:
+                print("")
+                print("\n##################################################")
+                print("tootgroup.py cannot open its state database " + file_name)
+                print(ex)
+                print("##################################################\n")
+                sys.exit(0)
+        return _state_stores[file_name]
+
+
+def open_state_store(file_name):
+    """Open the database and create its tables if needed.
+
+    The database is used in write-ahead log mode. Readers then never block
+    the writer and a crash can only lose transactions that have not been
+    committed yet."""
+    connection = sqlite3.connect(
+        file_name,
+        timeout=LOCK_TIMEOUT,
+        isolation_level=None,  # transactions are started explicitly
+        check_same_thread=False,  # access is serialized by the store's lock
+    )
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(_SCHEMA)
+    return {
+        "file_name": file_name,
+        "connection": connection,
+        "lock": threading.Lock(),
+        # Changes not written yet, by group name
+        "pending": {},
+    }
+
+
+def load_last_seen_id(state_store, group_name, group_config):
+    """Return the ID of the last notification a group has seen.
+
+    "state_store" dictionary as returned by get_state_store()
+
+    "group_name" handle of the group
+
+    "group_config" the group's section of the configuration. If the group
+    has no progress in the database yet, its "last_seen_id" is taken from
+    here. Without it, "catch-up" is returned."""
+    with state_store["lock"]:
+        row = (
+            state_store["connection"]
+            .execute(
+                "SELECT last_seen_id FROM groups WHERE group_name = ?", (group_name,)
+            )
+            .fetchone()
+        )
+    if row is not None:
+        return row[0]
+    # Upgrade from tootgroup.py 1.5 and earlier
+    return group_config.get("last_seen_id", "") or "catch-up"
+
+
+def processed_ids(state_store, group_name, notification_ids):
+    """Return which of the given notifications have been processed already.
+
+    "notification_ids" IDs of notifications that have just been fetched
+
+    Returns the set of processed IDs, as strings."""
+    notification_ids = [str(notification_id) for notification_id in notification_ids]
+    if len(notification_ids) == 0:
+        return set()
+    with state_store["lock"]:
+        pending = state_store["pending"].get(group_name)
+        found = set()
+        if pending is not None:
+            found.update(pending["processed"])
+        found.intersection_update(notification_ids)
+        rows = state_store["connection"].execute(
+            "SELECT notification_id FROM processed WHERE group_name = ? "
+            + "AND notification_id IN ("
+            + ",".join("?" * len(notification_ids))
+            + ")",
+            [group_name] + notification_ids,
+        )
+        found.update(row[0] for row in rows)
+    return found
+
+
+def mark_processed(
+    state_store, group_name, notification_id, batch_size=DEFAULT_COMMIT_BATCH
+):
+    """Record that a notification has been taken care of.
+
+    "state_store" dictionary as returned by get_state_store()
+
+    "group_name" handle of the group
+
+    "notification_id" ID of the processed notification
+
+    "batch_size" the pending changes are written as soon as this many
+    notifications have been recorded. Call commit() for the rest.
+
+    This can be called from any thread."""
+    with state_store["lock"]:
+        pending = _pending(state_store, group_name)
+        pending["processed"].append(str(notification_id))
+        full = len(pending["processed"]) >= batch_size
+    if full:
+        commit(state_store)
+
+
+def count_failure(state_store, group_name, notification_id):
+    """Record that the action of a notification has failed once more.
+
+    "state_store" dictionary as returned by get_state_store()
+
+    "group_name" handle of the group
+
+    "notification_id" ID of the notification whose action failed
+
+    The count is written right away, so it survives a run that gets killed.
+    It is removed once the group's last seen ID has moved past the
+    notification.
+
+    Returns how often the action has failed so far."""
+    with state_store["lock"]:
+        connection = state_store["connection"]
+        connection.execute(
+            "INSERT OR IGNORE INTO failures VALUES (?, ?, 0)",
+            (group_name, str(notification_id)),
+        )
+        connection.execute(
+            "UPDATE failures SET attempts = attempts + 1 WHERE group_name = ? "
+            + "AND notification_id = ?",
+            (group_name, str(notification_id)),
+        )
+        return connection.execute(
+            "SELECT attempts FROM failures WHERE group_name = ? "
+            + "AND notification_id = ?",
+            (group_name, str(notification_id)),
+        ).fetchone()[0]
+
+
+def set_last_seen_id(state_store, group_name, last_seen_id):
+    """Remember a group's new last seen notification ID.
+
+    Notifications up to this one are never fetched again. It is written
+    with the next commit."""
+    with state_store["lock"]:
+        _pending(state_store, group_name)["last_seen_id"] = str(last_seen_id)
+
+
+def _pending(state_store, group_name):
+    return state_store["pending"].setdefault(
+        group_name, {"processed": [], "last_seen_id": None}
+    )
+
+
+def commit(state_store):
+    """Write all pending changes in a single transaction.
+
+    Processed notifications up to a group's last seen ID are not needed any
+    more and get removed. Failing to write is not fatal, the changes are
+    kept and written with the next commit."""
+    with state_store["lock"]:
+        if len(state_store["pending"]) == 0:
+            return
+        connection = state_store["connection"]
+        now = time.time()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for group_name, pending in state_store["pending"].items():
+                connection.executemany(
+                    "INSERT OR IGNORE INTO processed VALUES (?, ?, ?)",
+                    [
+                        (group_name, notification_id, now)
+                        for notification_id in pending["processed"]
+                    ],
+                )
+                if pending["last_seen_id"] is not None:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO groups VALUES (?, ?, ?)",
+                        (group_name, pending["last_seen_id"], now),
+                    )
+                    _forget_processed(connection, group_name, pending["last_seen_id"])
+            connection.execute("COMMIT")
+        except Exception as ex:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            print("Cannot write state database: " + str(ex))
+            return
+        state_store["pending"].clear()
+
+
+def _forget_processed(connection, group_name, last_seen_id):
+    """Remove processed and failed notifications that will never be
+    fetched again"""
+    for table in ("processed", "failures"):
+        rows = connection.execute(
+            "SELECT notification_id FROM " + table + " WHERE group_name = ?",
+            (group_name,),
+        ).fetchall()
+        connection.executemany(
+            "DELETE FROM " + table + " WHERE group_name = ? AND notification_id = ?",
+            [
+                (group_name, row[0])
+                for row in rows
+                if not tootgroup_tools.compare_ids(row[0], last_seen_id)
+            ],
+        )
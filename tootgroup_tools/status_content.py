@@ -0,0 +1,70 @@
+"""Converts the HTML content of statuses to plain text.
+
+Statuses arrive as HTML. To repost a direct message, its text is needed
+with line breaks and paragraphs kept but without any markup. This is done
+with three precompiled patterns whose replacements are plain strings, so
+all the work is done by the regular expression engine without calling
+back into Python for every tag: paragraph changes become two newlines,
+line breaks one and all other tags are removed. Paragraphs go first, so a
+line break between two paragraphs does not count as a paragraph change.
+
+HTML entities are decoded afterwards. Servers escape only a few
+characters, which are replaced directly. Anything else is left to
+html.unescape()."""
+
+import html
+import re
+
+# Servers send sanitized, lower case HTML, so case is not ignored here.
+# This keeps the patterns fast.
+_PARAGRAPH_BREAK_PATTERN = re.compile(r"</p>\s*<p\b[^>]*>")
+_LINE_BREAK_PATTERN = re.compile(r"<br\b[^>]*>")
+_TAG_PATTERN = re.compile(r"<[^>]*>")
+
+# Finds any "&" that does not start one of the entities servers escape with
+_OTHER_ENTITY_PATTERN = re.compile(r"&(?!(?:amp|lt|gt|quot|#39);)")
+
+
+def to_plain_text(content):
+    """Return the plain text of a status' HTML content.
+
+    "content" the status' content as sent by the Fediverse server
+
+    Line breaks and paragraphs are turned into newlines, all other tags are
+    removed and HTML entities are decoded."""
+    text = _PARAGRAPH_BREAK_PATTERN.sub("\n\n", content)
+    text = _LINE_BREAK_PATTERN.sub("\n", text)
+    return _unescape(_TAG_PATTERN.sub("", text))
+
+
+def _unescape(text):
+    """Decode HTML entities like html.unescape(), but faster for the few
+    ones servers use"""
+    if "&" not in text:
+        return text
+    if _OTHER_ENTITY_PATTERN.search(text) is not None:
+        return html.unescape(text)
+    # "&amp;" goes last, so escaped entities are not decoded twice
+    return (
+        text.replace("&lt;", "<")
+        .replace("&gt;", ">")
+        .replace("&quot;", '"')
+        .replace("&#39;", "'")
+        .replace("&amp;", "&")
+    )
+
+
+def strip_leading_mention(content, username):
+    """Return the plain text of a status without its leading mention.
+
+    "content" the status' content as sent by the Fediverse server
+
+    "username" the mentioned account's username, without any "@"
+
+    Only a mention at the very beginning of the text is removed. Returns
+    None if the text does not start with "@username"."""
+    text = to_plain_text(content)
+    mention = "@" + username
+    if not text.startswith(mention):
+        return None
+    return text[len(mention) :]
@@ -0,0 +1,114 @@
+"""Listens to the Fediverse server's streaming API for new notifications.
+
+Instead of asking the server for new notifications periodically, the
+server pushes them to tootgroup.py as soon as they arrive. Lost
+connections are re-established with an increasing waiting time and a
+catch-up callback is run on every (re)connect so that nothing gets lost
+while no connection was open."""
+
+import threading
+import time
+
+import mastodon
+
+# Waiting time bounds in seconds before reconnecting to the streaming API.
+RECONNECT_MIN_WAIT = 1.0
+RECONNECT_MAX_WAIT = 300.0
+
+
+class NotificationListener(mastodon.StreamListener):
+    """Passes every "notification" event on to a callback function.
+
+    All other events like new statuses in the home timeline are ignored.
+    The "receiving" attribute tells if anything at all has been received
+    on the current connection."""
+
+    def __init__(self, notification_callback, lock):
+        super().__init__()
+        self.notification_callback = notification_callback
+        self.lock = lock
+        self.receiving = False
+        self.error = None
+
+    def on_notification(self, notification):
+        self.receiving = True
+        try:
+            with self.lock:
+                self.notification_callback(notification)
+        except Exception as ex:
+            # Do not tear down the connection because of a single
+            # notification that could not be processed.
+            print(
+                "Could not process streamed notification ID "
+                + str(notification.id)
+                + ": "
+                + str(ex)
+            )
+
+    def handle_heartbeat(self):
+        self.receiving = True
+
+    def on_abort(self, err):
+        self.error = err
+
+
+def connected(handle, listener):
+    """Tell if a stream handle has got its connection.
+
+    Mastodon.py before 2.0 connects before stream_user() returns. Later
+    versions connect in the listening thread and keep trying there until
+    the server accepts the connection."""
+    return listener.receiving or getattr(handle, "connection", None) is not None
+
+
+def listen(masto, notification_callback, catch_up_callback):
+    """Process streamed notifications until interrupted.
+
+    "masto" connected Mastodon API instance of the group
+
+    "notification_callback" is called with every streamed notification
+
+    "catch_up_callback" is called without arguments after a connection has
+    been opened. It is meant to poll for everything that happened while
+    there was no connection.
+
+    Both callbacks are never run at the same time. If the connection breaks,
+    the waiting time before reconnecting starts at RECONNECT_MIN_WAIT and is
+    doubled on every failed attempt up to RECONNECT_MAX_WAIT."""
+    lock = threading.Lock()
+    wait = RECONNECT_MIN_WAIT
+
+    while True:
+        listener = NotificationListener(notification_callback, lock)
+        handle = None
+        try:
+            handle = masto.stream_user(listener, run_async=True)
+            # Only catch up once connected, or whatever arrives in between
+            # would get lost.
+            while handle.is_alive() and not connected(handle, listener):
+                time.sleep(0.1)
+            if handle.is_alive():
+                print("Connected to the streaming API, waiting for notifications...")
+                with lock:
+                    catch_up_callback()
+            while handle.is_alive():
+                time.sleep(1)
+            if listener.error is not None:
+                print("Streaming connection lost: " + str(listener.error))
+            else:
+                print("Streaming connection closed by the server.")
+        except KeyboardInterrupt:
+            # The listening thread is a daemon thread and will end together
+            # with tootgroup.py. Closing its connection here could block
+            # until the server sends the next event.
+            raise
+        except Exception as ex:
+            print("Could not use the streaming API: " + str(ex))
+            if handle is not None:
+                handle.close()
+
+        if listener.receiving:
+            wait = RECONNECT_MIN_WAIT
+        print("Reconnecting in " + str(int(wait)) + " seconds...")
+        time.sleep(wait)
+        wait = min(wait * 2, RECONNECT_MAX_WAIT)
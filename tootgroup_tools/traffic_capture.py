@@ -0,0 +1,264 @@
+"""Records the responses of a run and replays them offline.
+
+A slow or wrong run is hard to reproduce, as the notifications that caused
+it are gone by the next run. With --record, every response to a GET request
+of the group's session is written to a capture file: notifications, member
+lists, relationships and media downloads. Together with them, the capture
+holds what the run knew beforehand, i.e. the group's options, identity,
+member cache and progress. Access tokens are never recorded.
+
+With --replay, a capture is run through the regular notification handling
+again, without a configuration and without any network access. GET requests
+are answered from the capture. Everything else, like boosts, new posts and
+media uploads, is not sent but answered with a made up response, so all
+actions take their usual course. Replays are not rate limited and run at
+full speed, which makes them useful as regression tests and as realistic
+workloads for profiling.
+
+Captures are gzip compressed JSON lines. The first line is a header, every
+further line holds one response in the order they have been received.
+Recording reads every response completely before it is passed on, so media
+files are not streamed while a run is recorded."""
+
+import base64
+import datetime
+import gzip
+import http.client
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+import requests
+
+CAPTURE_FORMAT = "tootgroup.py capture"
+CAPTURE_VERSION = 1
+
+# Response headers kept in captures. Link is needed to turn pages.
+RECORDED_HEADERS = ("Content-Type", "Link")
+
+_MEDIA_UPLOAD = re.compile(r"/api/v[12]/media/?$")
+
+
+class RecordingAdapter(requests.adapters.BaseAdapter):
+    """Passes requests on to another adapter and records the responses"""
+
+    def __init__(self, adapter, capture):
+        super().__init__()
+        self.adapter = adapter
+        self.capture = capture
+
+    def send(self, request, **kwargs):
+        response = self.adapter.send(request, **kwargs)
+        if request.method == "GET":
+            record_response(self.capture, request, response)
+        return response
+
+    def close(self):
+        pass  # the wrapped adapter is shared with other sessions
+
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+    """Answers requests from a capture without any network access"""
+
+    def __init__(self, capture):
+        super().__init__()
+        self.capture = capture
+
+    def send(self, request, **kwargs):
+        if request.method != "GET":
+            return stub_response(self.capture, request)
+        key = (request.method, request.url)
+        with self.capture["lock"]:
+            recorded = self.capture["responses"].get(key)
+            if not recorded:
+                raise requests.exceptions.ConnectionError(
+                    "Not in the capture: GET " + request.url, request=request
+                )
+            # Requests sent more often than recorded get the last answer again
+            entry = recorded.pop(0) if len(recorded) > 1 else recorded[0]
+            self.capture["served"] += 1
+        if "data" in entry:
+            content = base64.b64decode(entry["data"])
+        else:
+            content = entry["text"].encode("utf-8")
+        return make_response(request, entry["status"], entry["headers"], content)
+
+    def close(self):
+        pass
+
+
+def start_recording(file_name, session):
+    """Record the responses a session receives from now on.
+
+    "file_name" name of the capture file, it is replaced if it exists
+
+    "session" requests.Session of the group, see http_session.get_session()
+
+    Responses are kept in memory until write_header() has been called.
+    Returns the capture, which has to be given to stop_recording()."""
+    capture = {
+        "file_name": file_name,
+        "file": None,
+        "pending": [],
+        "lock": threading.Lock(),
+        "session": session,
+        "adapters": dict(session.adapters),
+        "recorded": 0,
+    }
+    for prefix, adapter in capture["adapters"].items():
+        session.mount(prefix, RecordingAdapter(adapter, capture))
+    return capture
+
+
+def write_header(capture, header):
+    """Create the capture file and write everything recorded so far.
+
+    "header" JSON serializable dictionary describing the run. It is written
+    to the capture's first line and returned by load_capture() later on."""
+    header = dict(header)
+    header["format"] = CAPTURE_FORMAT
+    header["version"] = CAPTURE_VERSION
+    header["recorded"] = time.time()
+    with capture["lock"]:
+        capture["file"] = gzip.open(
+            capture["file_name"], "wt", encoding="utf-8", compresslevel=6
+        )
+        capture["file"].write(json.dumps(header) + "\n")
+        for line in capture["pending"]:
+            capture["file"].write(line)
+        capture["pending"] = None
+
+
+def record_response(capture, request, response):
+    """Append a response to the capture. Its content is read completely."""
+    content = response.content
+    entry = {
+        "method": request.method,
+        "url": request.url,
+        "status": response.status_code,
+        "headers": {
+            name: response.headers[name]
+            for name in RECORDED_HEADERS
+            if name in response.headers
+        },
+    }
+    try:
+        entry["text"] = content.decode("utf-8")
+    except UnicodeDecodeError:
+        entry["data"] = base64.b64encode(content).decode("ascii")
+    line = json.dumps(entry) + "\n"
+    with capture["lock"]:
+        if capture["file"] is not None:
+            capture["file"].write(line)
+        elif capture["pending"] is not None:
+            capture["pending"].append(line)
+        else:
+            return  # recording has been stopped
+        capture["recorded"] += 1
+
+
+def stop_recording(capture):
+    """Stop recording, restore the session and close the capture file.
+
+    Nothing is written if write_header() has not been called. Returns the
+    number of responses that have been recorded."""
+    for prefix, adapter in capture["adapters"].items():
+        capture["session"].mount(prefix, adapter)
+    with capture["lock"]:
+        if capture["file"] is not None:
+            capture["file"].close()
+        capture["file"] = capture["pending"] = None
+    return capture["recorded"]
+
+
+def load_capture(file_name):
+    """Read a capture file written by start_recording().
+
+    Returns a dictionary with the capture's "header" and its "responses" by
+    request method and URL. A ValueError is raised if the file is not a
+    capture this version of tootgroup.py can replay."""
+    responses = {}
+    with gzip.open(file_name, "rt", encoding="utf-8") as capture_file:
+        try:
+            header = json.loads(capture_file.readline())
+        except (OSError, ValueError):
+            header = None
+        if not isinstance(header, dict) or header.get("format") != CAPTURE_FORMAT:
+            raise ValueError(file_name + " is not a tootgroup.py capture")
+        if header.get("version") != CAPTURE_VERSION:
+            raise ValueError(
+                file_name + " has been recorded by another version of tootgroup.py"
+            )
+        for line in capture_file:
+            entry = json.loads(line)
+            responses.setdefault((entry["method"], entry["url"]), []).append(entry)
+    return {
+        "header": header,
+        "responses": responses,
+        "lock": threading.Lock(),
+        "served": 0,
+        "stubbed": 0,
+    }
+
+
+def start_replay(capture, session):
+    """Answer all requests of a session from a capture.
+
+    "capture" dictionary as returned by load_capture()
+
+    "session" requests.Session of the group, see http_session.get_session()
+
+    The session is no longer paced by the rate limiter."""
+    replay_adapter = ReplayAdapter(capture)
+    for prefix in ("http://", "https://"):
+        session.mount(prefix, replay_adapter)
+    session.paced = False
+
+
+def stub_response(capture, request):
+    """Make up the answer to a request that changes something.
+
+    Uploads get a media attachment, everything else a status."""
+    with capture["lock"]:
+        capture["stubbed"] += 1
+        stub_id = "replay-" + str(capture["stubbed"])
+    if _MEDIA_UPLOAD.search(urllib.parse.urlsplit(request.url).path):
+        data = {
+            "id": stub_id,
+            "type": "image",
+            "url": None,
+            "preview_url": None,
+            "description": None,
+        }
+    else:
+        data = {
+            "id": stub_id,
+            "created_at": datetime.datetime.now(datetime.timezone.utc).strftime(
+                "%Y-%m-%dT%H:%M:%S.000Z"
+            ),
+            "content": "",
+            "visibility": "public",
+        }
+    return make_response(
+        request,
+        200,
+        {"Content-Type": "application/json; charset=utf-8"},
+        json.dumps(data).encode("utf-8"),
+    )
+
+
+def make_response(request, status, headers, content):
+    """Build a complete requests.Response without a connection behind it"""
+    response = requests.Response()
+    response.status_code = status
+    response.reason = http.client.responses.get(status, "")
+    response.headers = requests.structures.CaseInsensitiveDict(headers)
+    response.headers["Content-Length"] = str(len(content))
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response._content = content
+    response._content_consumed = True
+    response.url = request.url
+    response.request = request
+    return response
@@ -0,0 +1,163 @@
+"""Receives the Web Push messages a Fediverse server sends for new notifications.
+
+With Web Push, tootgroup.py neither has to poll the server for new
+notifications nor keep a streaming connection open. A push subscription is
+registered for the group account and a small HTTP endpoint is run to
+receive it. For every new mention or follow, the server sends an encrypted
+message there. It holds the ID of the notification, which is then fetched
+and handled right away. Idle groups cost no requests at all.
+
+The server has to reach the endpoint under the group's "push_url", usually
+through a reverse proxy that takes care of TLS. A new key pair is created
+every time the receiver is started and the subscription is removed again
+when it stops.
+
+Pushes get lost while tootgroup.py is not running or the server cannot
+reach it. Everything missed is caught up with a regular poll when the
+receiver starts and every "poll_interval" seconds after that.
+
+Decrypting push messages needs the "webpush" extra of Mastodon.py:
+
+    pip install "Mastodon.py[webpush]"
+"""
+
+import http.server
+import threading
+import time
+
+# Defaults, they can be overridden per group with "push_listen" and
+# "push_poll_interval" in the config file.
+DEFAULT_LISTEN_ADDRESS = "127.0.0.1:8181"
+DEFAULT_POLL_INTERVAL = 900.0
+
+# Notification types the subscription asks the server to push
+PUSHED_TYPES = ("mention", "follow")
+
+
+class SubscriptionError(Exception):
+    """The server has not accepted the push subscription"""
+
+
+def make_handler(masto, decrypt_params, notification_callback, lock):
+    """Return a request handler class receiving push messages.
+
+    "masto" connected Mastodon API instance of the group
+
+    "decrypt_params" private key and auth secret of the subscription
+
+    "notification_callback" is called with every pushed notification
+
+    "lock" held while the callback runs"""
+
+    class PushHandler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass  # only pushes that cannot be handled are reported
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            try:
+                push = masto.push_subscription_decrypt_push(
+                    body,
+                    decrypt_params,
+                    self.headers.get("Encryption", ""),
+                    self.headers.get("Crypto-Key", ""),
+                )
+            except Exception:
+                # Not encrypted for this subscription
+                self.respond(400)
+                return
+            # Answer first, the server does not need to wait for the result.
+            self.respond(201)
+
+            if push.notification_type not in PUSHED_TYPES:
+                return
+            try:
+                with lock:
+                    notification_callback(masto.notifications(id=push.notification_id))
+            except Exception as ex:
+                print(
+                    "Could not process pushed notification ID "
+                    + str(push.notification_id)
+                    + ": "
+                    + str(ex)
+                )
+
+        def respond(self, status):
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    return PushHandler
+
+
+def listen(
+    masto,
+    push_url,
+    notification_callback,
+    catch_up_callback,
+    listen_address=DEFAULT_LISTEN_ADDRESS,
+    poll_interval=DEFAULT_POLL_INTERVAL,
+):
+    """Process pushed notifications until interrupted.
+
+    "masto" connected Mastodon API instance of the group
+
+    "push_url" URL under which the server reaches the endpoint
+
+    "notification_callback" is called with every pushed notification
+
+    "catch_up_callback" is called without arguments when the receiver has
+    been started and then every "poll_interval" seconds. It is meant to
+    poll for anything that has not been pushed.
+
+    "listen_address" host and port the endpoint listens on, e.g.
+    "127.0.0.1:8181"
+
+    Both callbacks are never run at the same time. A failing catch-up is
+    reported and tried again after "poll_interval" seconds.
+    SubscriptionError is raised if the server rejects the subscription.
+    KeyboardInterrupt is passed on after the subscription has been
+    removed."""
+    host, port = listen_address.rsplit(":", 1)
+    lock = threading.Lock()
+    decrypt_params, encrypt_params = masto.push_subscription_generate_keys()
+    server = http.server.ThreadingHTTPServer(
+        (host, int(port)),
+        make_handler(masto, decrypt_params, notification_callback, lock),
+    )
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        try:
+            masto.push_subscription_set(
+                push_url,
+                encrypt_params,
+                mention_events=True,
+                follow_events=True,
+                favourite_events=False,
+                reblog_events=False,
+                poll_events=False,
+                follow_request_events=False,
+                status_events=False,
+                update_events=False,
+            )
+        except Exception as ex:
+            raise SubscriptionError(str(ex)) from ex
+        print(
+            "Subscribed to Web Push at " + push_url + ", waiting for notifications..."
+        )
+        while True:
+            try:
+                with lock:
+                    catch_up_callback()
+            except Exception as ex:
+                # Pushes keep being received, the next poll tries again.
+                print("Polling for missed notifications failed: " + str(ex))
+            time.sleep(poll_interval)
+    finally:
+        server.shutdown()
+        server.server_close()
+        try:
+            masto.push_subscription_delete()
+        except Exception:
+            pass  # it is replaced by the next subscription anyway